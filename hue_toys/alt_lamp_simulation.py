@@ -17,11 +17,11 @@
 
 import math
 from random import choice, randint, normalvariate
-import threading
 import time
 
 from hue_toys.base import (BaseProgram, default_run)
-from hue_toys.phue_helper import decisleep
+from hue_toys.phue_helper import (
+    DEFAULT_TRANSITION_TIME, clock, merge_timeline, sleep_until)
 
 
 class LampSimulationProgram(BaseProgram):
@@ -42,8 +42,6 @@ class LampSimulationProgram(BaseProgram):
 
         BaseProgram.__init__(self, *args, **kwargs)
 
-        self.bridge_lock = threading.Lock()
-
     def add_light_state_opt(self):
         self.add_restore_opt()
 
@@ -67,22 +65,48 @@ class LampSimulationProgram(BaseProgram):
 
         self.add_power_fail_opt()
 
-    def run_stages(self, stages, light_id):
-        """Send a sequence of light commands (parameter dicts to send to
-        phue[_helper].Bridge.set_light()), waiting for each transition
-        to complete before sending the next one
+    def build_timeline(self, light_stages):
+        """Return the timeline (see phue_helper.merge_timeline) of the given
+        sequence of (light ID, stages) pairs, where stages is a sequence
+        of light commands (parameter dicts for
+        phue[_helper].Bridge.set_light()), each to be sent once the
+        previous one's transition has completed. Stages that differ
+        from the previous one only in transition time are left out, as
+        they don't change the light, and only add to the time until the
+        next one.
+        """
+        commands = []
+        for light, stages in light_stages:
+            time_ = 0
+            last_params = None
+            for stage in stages:
+                params = stage.copy()
+                real_trans_time = round(
+                    params.pop('transitiontime', 40) * (1 / self.opts.time_rate))
+                if params and params != last_params:
+                    last_params = params
+                    commands.append((
+                        time_ / 10, light,
+                        dict(params, transitiontime=real_trans_time)))
+                time_ += real_trans_time + 1
+        return merge_timeline(commands)
+
+    @staticmethod
+    def timeline_end(timeline):
+        """Return the time in seconds at which the transitions of the last
+        command of every light in a timeline (see
+        phue_helper.merge_timeline) have all completed
         """
-        for stage in stages:
-            stage = stage.copy()
-            real_trans_time = round(
-                stage.get('transitiontime', 40) * (1 / self.opts.time_rate))
-            stage['transitiontime'] = real_trans_time
-            with self.bridge_lock:
-                self.bridge.set_light(light_id, stage)
-            decisleep(real_trans_time + 1)
-
-    def simulate_2700k(self, light_id):
-        """Run a 2700K CFL simulation using the given light_id"""
+        end_times = {}
+        for time_, params, light_ids in timeline:
+            end_time = time_ + params.get(
+                'transitiontime', DEFAULT_TRANSITION_TIME) / 10
+            for light in light_ids:
+                end_times[light] = end_time
+        return max(end_times.values() or [0])
+
+    def simulate_2700k(self):
+        """Return the stages of a 2700K CFL simulation"""
         stages = [{'on': True, 'transitiontime': 0}]
         if self.opts.warmup_type == 'random':
             deep_warmup = randint(0, 1)
@@ -115,10 +139,10 @@ class LampSimulationProgram(BaseProgram):
             stages.append({'bri': 254,
                            'transitiontime': randint(1000, 2000)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_3500k(self, light_id):
-        """Run a 3500K CFL simulation using the given light_id"""
+    def simulate_3500k(self):
+        """Return the stages of a 3500K CFL simulation"""
         stages = [{'on': True, 'transitiontime': 0}]
         if self.opts.warmup_type == 'random':
             deep_warmup = randint(0, 1)
@@ -153,10 +177,10 @@ class LampSimulationProgram(BaseProgram):
             stages.append({'bri': 254,
                            'transitiontime': randint(800, 1600)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_4100k(self, light_id):
-        """Run a 4100K CFL simulation using the given light_id"""
+    def simulate_4100k(self):
+        """Return the stages of a 4100K CFL simulation"""
         stages = [{'on': True, 'transitiontime': 0}]
         if self.opts.warmup_type == 'random':
             deep_warmup = randint(0, 1)
@@ -191,10 +215,10 @@ class LampSimulationProgram(BaseProgram):
             stages.append({'bri': 254,
                            'transitiontime': randint(800, 1600)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_sbm(self, light_id):
-        """Run a self-ballasted mercury lamp simulation using the given light_id"""
+    def simulate_sbm(self):
+        """Return the stages of a self-ballasted mercury lamp simulation"""
         stages = []
 
         stages.append({'on': True,
@@ -219,10 +243,10 @@ class LampSimulationProgram(BaseProgram):
                        'sat': 34,
                        'transitiontime': randint(500, 800)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_lps_like(self, light_id):
-        """Run a low-pressure-sodium-light warmup simulation using given light_id"""
+    def simulate_lps_like(self):
+        """Return the stages of a low-pressure-sodium-light warmup simulation"""
         stages = []
 
         stages.append({'on': True,
@@ -235,10 +259,10 @@ class LampSimulationProgram(BaseProgram):
                        'ctk': 1600,
                        'transitiontime': randint(4800, 9000)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_lps_like_sat(self, light_id):
-        """Run a low-pressure-sodium-like warmup simulation using given light_id"""
+    def simulate_lps_like_sat(self):
+        """Return the stages of a low-pressure-sodium-like warmup simulation"""
         stages = []
         total_warmup_time = randint(4800, 9000)
 
@@ -256,11 +280,11 @@ class LampSimulationProgram(BaseProgram):
                        'ctk': 4000,
                        'transitiontime': math.ceil(total_warmup_time / 2)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
-    def simulate_mh_like_warm(self, light_id):
-        """Run a warm-CCT (~2800–3000K) metal-halide-like warmup simulation
-        using given light_id
+    def simulate_mh_like_warm(self):
+        """Return the stages of a warm-CCT (~2800–3000K) metal-halide-like
+        warmup simulation
         """
         stages = []
 
@@ -278,22 +302,25 @@ class LampSimulationProgram(BaseProgram):
                        'sat': 80,
                        'transitiontime': randint(125, 250)})
 
-        self.run_stages(stages, light_id)
+        return stages
 
     def main(self):
-        threads = []
         if self.opts.models is not None:
             models = self.opts.models
         else:
             models = self.default_model_seq
-        for light in self.lights:
-            thread = threading.Thread(
-                target=self.models[choice(models)], args=(light,), daemon=True)
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        light_stages = [(light, self.models[choice(models)]())
+                        for light in self.lights]
+        timeline = self.build_timeline(light_stages)
+        self.log.info('%d stages reduced to %d commands',
+                      sum(len(stages) for _, stages in light_stages),
+                      len(timeline))
+
+        start_time = clock.monotonic()
+        self.bridge.play_timeline(timeline, start_time)
+        # Let the last transitions finish before the lights are restored
+        # or power-fail mode is enabled again
+        sleep_until(start_time + self.timeline_end(timeline) + .1)
 
 
 def main():
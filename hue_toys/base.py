@@ -20,17 +20,24 @@ Hue smart lights
 """
 
 import argparse
+from collections import OrderedDict
 import logging
 import signal
 import sys
 import textwrap
-from time import sleep
 
-from hue_toys.phue_helper import ExtendedBridge
+from hue_toys.phue_helper import (
+    DEFAULT_AIRTIME_BUDGET, AirtimeBudget, ExtendedBridge, SimulatedBridge,
+    clock)
+from hue_toys.inventory import Inventory
 
 LOG_FORMAT = '%(asctime)s [%(module)s] %(message)s'
 SHUTDOWN_EXIT_CODE = 99
 
+CONFIG_WRITE_INTERVAL = .1
+"""Seconds to wait after each light config write when commands aren't
+paced by an airtime budget, to avoid overloading Zigbee bandwidth"""
+
 
 class BaseProgram():
     """A sample CLI program for the Philips Hue system that takes
@@ -38,6 +45,16 @@ class BaseProgram():
     on the specified lights
     """
 
+    defer_light_validation = False
+    """If true, lights given only by ID are not checked against the
+    bridge's light list at startup, saving a request; commands sent to
+    nonexistent lights will fail later instead"""
+
+    multiple_bridges = False
+    """If true, several bridges may be given with -B, and the program's
+    lights are then hue_toys.multi_bridge.BridgeLight objects spanning
+    all of them"""
+
     usage_first_run_msg = '''The first time this script is run on a system, it may be necessary to
 press the button on the bridge before running the script so that it can
 be registered to access the bridge and lighting system.'''
@@ -47,6 +64,12 @@ be registered to access the bridge and lighting system.'''
     usage_no_lights_msg = '''If no lights are specified, all lights found on the bridge will be
 used.'''
 
+    usage_multiple_bridges_msg = '''Several bridges may be given with -B to control the lights of all of
+them, using the credentials stored for each in the config file.
+Commands to different bridges are sent at the same time. Lights are then
+given as BRIDGE:LIGHT-NUM, or by name (qualified as BRIDGE:LIGHT-NAME if
+the name is used on more than one bridge).'''
+
     def __init__(self, raw_arguments=None, bridge_retries=10,
                  bridge_retry_wait=1):
         """Parse raw arguments and initialize connection to Hue bridge
@@ -66,6 +89,15 @@ used.'''
         self.init_arg_parser()
         self.opts = self.opt_parser.parse_args(raw_arguments)
 
+        time_warp = getattr(self.opts, 'time_warp', None)
+        if time_warp is not None:
+            # The bridge layer runs on the same clock, so pacing and
+            # retry waits would be warped too against a real bridge
+            if not getattr(self.opts, 'simulated_lights', None):
+                self.opt_parser.error(
+                    '--time-warp can only be used with -Bs/--simulated-bridge')
+            clock.warp(time_warp)
+
         self.bridge = self.get_bridge()
         self.lights = self.get_lights()
         if not self.lights:
@@ -161,6 +193,25 @@ used.'''
 
         return positive_float_validator
 
+    @staticmethod
+    def non_negative_float():
+        """Return a function that converts a string to a float, raising
+        argparse.ArgumentTypeError on failure or if the resulting value
+        is less than zero.
+        """
+        def non_negative_float_validator(str_):
+            try:
+                float_ = float(str_)
+            except ValueError:
+                raise argparse.ArgumentTypeError(
+                    'invalid floating point value: %s' % str_)
+            if float_ < 0:
+                raise argparse.ArgumentTypeError(
+                    'value must be 0 or greater: %s' % float_)
+            return float_
+
+        return non_negative_float_validator
+
     def relative_int(self, min_limit, max_limit):
         """Return a function that accepts a string representing an int within
         min_limit and max_limit (works as with self.int_within_range),
@@ -188,10 +239,16 @@ used.'''
 
     def add_bridge_opts(self):
         """Add generic bridge arguments to argument parser"""
-        self.opt_parser.add_argument(
-            '-B', '--bridge',
-            dest='bridge_address',
-            help='Hue bridge IP or hostname')
+        if self.multiple_bridges:
+            self.opt_parser.add_argument(
+                '-B', '--bridge',
+                dest='bridge_address', nargs='+', metavar='BRIDGE',
+                help='Hue bridge IP(s) or hostname(s)')
+        else:
+            self.opt_parser.add_argument(
+                '-B', '--bridge',
+                dest='bridge_address',
+                help='Hue bridge IP or hostname')
         self.opt_parser.add_argument(
             '-Bu', '--bridge-username',
             dest='bridge_username',
@@ -200,12 +257,61 @@ used.'''
             '-Bc', '--bridge-config',
             dest='bridge_config',
             help='path of config file for bridge connection parameters')
+        self.opt_parser.add_argument(
+            '-Bs', '--simulated-bridge',
+            dest='simulated_lights', type=self.int_within_range(1, None),
+            metavar='NUM-LIGHTS',
+            help='''use a local simulated bridge with %(metavar)s lights instead of a
+                 real one''')
+        self.opt_parser.add_argument(
+            '--record',
+            dest='record_file', metavar='FILE',
+            help='append a log of all light commands sent to the bridge to %(metavar)s')
+        self.opt_parser.add_argument(
+            '--refresh-inventory',
+            dest='refresh_inventory', action='store_true',
+            help='fetch the list of lights from the bridge instead of using the cached copy')
+        self.opt_parser.add_argument(
+            '--airtime-budget',
+            dest='airtime_budget', type=self.int_within_range(0, 1000),
+            metavar='MS',
+            help='''pace commands so their estimated ZigBee radio airtime stays within
+                 %%(metavar)s milliseconds per second, or send them right away
+                 if %%(metavar)s is 0 (default: based on the rate measured by
+                 bridge_stress, or %d)''' % round(DEFAULT_AIRTIME_BUDGET * 1000))
+        self.add_state_table_opt()
+
+    def add_state_table_opt(self):
+        """Add option to read light states from a state table"""
+        self.opt_parser.add_argument(
+            '--state-table',
+            dest='state_table', nargs='?', const='', metavar='PATH',
+            help='''read light states from the table kept up to date by
+                 state_publisher in the file at %(metavar)s (default: in
+                 $XDG_RUNTIME_DIR or the temporary directory) instead of
+                 the bridge, while the table is up to date''')
+
+    @staticmethod
+    def light_id(str_):
+        """Convert a light ID argument to an int, or leave it as a string to
+        be looked up in the light index if it is qualified with a bridge
+        name (BRIDGE:LIGHT-NUM)
+        """
+        try:
+            return int(str_)
+        except ValueError:
+            pass
+        bridge_name, _, light_id = str_.rpartition(':')
+        if bridge_name and light_id.isdigit():
+            return str_
+        raise argparse.ArgumentTypeError('invalid light ID: %s' % str_)
 
     def add_light_opts(self):
         """Add generic light-listing arguments to argument parser"""
         self.opt_parser.add_argument(
             '-l', '--light-id',
-            dest='lights', action='append', type=int, metavar='LIGHT-NUM',
+            dest='lights', action='append', type=self.light_id,
+            metavar='LIGHT-NUM',
             nargs='+',
             help='use light(s) with ID number %(metavar)s')
         self.opt_parser.add_argument(
@@ -222,6 +328,33 @@ used.'''
             help='''output extra informational messages (and debug messages if specified
                  more than once)''')
 
+    @staticmethod
+    def time_warp_rate(str_):
+        """Convert a --time-warp argument to a Clock.warp rate: a float greater
+        than zero, or 'max' for Clock.JUMP
+        """
+        if str_ == 'max':
+            return clock.JUMP
+        try:
+            rate = float(str_)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "invalid time rate (must be a number or 'max'): %s" % str_)
+        if not 0 < rate < clock.JUMP:
+            raise argparse.ArgumentTypeError(
+                'time rate must be greater than 0: %s' % str_)
+        return rate
+
+    def add_time_warp_opt(self):
+        """Add option to run with simulated time"""
+        self.opt_parser.add_argument(
+            '--time-warp',
+            dest='time_warp', type=self.time_warp_rate, metavar='RATE',
+            help="""run in simulated time passing %(metavar)s times as fast as real time,
+                 or, if %(metavar)s is 'max', skipping straight to each point in
+                 time the program is waiting for (requires
+                 -Bs/--simulated-bridge; mostly useful with --record)""")
+
     def add_restore_opt(self):
         """Add option to restore lights; default action will be not to restore"""
         self.opt_parser.add_argument(
@@ -253,44 +386,162 @@ used.'''
         """Add program's command arguments to argument parser"""
         self.add_verbose_opt()
         self.add_bridge_opts()
+        self.add_time_warp_opt()
         self.add_light_opts()
         self.add_light_state_opt()
 
-    def init_arg_parser(self):
-        """Set up the command argument parser"""
-        self.opt_parser = argparse.ArgumentParser(
+    def init_arg_parser(self, parser_class=argparse.ArgumentParser):
+        """Set up the command argument parser as an instance of
+        parser_class
+        """
+        self.opt_parser = parser_class(
             formatter_class=argparse.RawDescriptionHelpFormatter,
             description=self.get_description(),
             epilog=self.get_usage_epilog())
         self.add_opts()
 
+    def get_recorder(self):
+        """Return a command log writer for the --record option, or None if
+        commands are not to be recorded
+        """
+        record_file = getattr(self.opts, 'record_file', None)
+        if record_file is None:
+            return None
+        from hue_toys.command_log import CommandLogError, CommandLogWriter
+        try:
+            return CommandLogWriter(record_file, clock=clock.monotonic)
+        except (OSError, CommandLogError) as e:
+            self.opt_parser.error("can't open record file: %s" % e)
+
     def get_bridge(self):
-        """Establish and return a phue Bridge object to use"""
-        return ExtendedBridge(ip=self.opts.bridge_address,
-                              username=self.opts.bridge_username,
-                              config_file_path=self.opts.bridge_config)
+        """Establish and return a phue Bridge object to use, or a
+        MultiBridge if several bridges were given
+        """
+        addresses = self.opts.bridge_address
+        if not isinstance(addresses, list):
+            addresses = [addresses]
+        if len(addresses) == 1:
+            return self.make_bridge(addresses[0], self.get_recorder())
+
+        if len(set(addresses)) < len(addresses):
+            self.opt_parser.error('duplicate bridge given')
+        if getattr(self.opts, 'record_file', None) is not None:
+            self.opt_parser.error('--record can only be used with one bridge')
+        if self.opts.bridge_username is not None:
+            self.opt_parser.error(
+                '-Bu/--bridge-username can only be used with one bridge')
+        from hue_toys.multi_bridge import MultiBridge
+        return MultiBridge(OrderedDict(
+            (address, self.make_bridge(address)) for address in addresses))
+
+    def make_bridge(self, address, recorder=None):
+        """Establish and return an ExtendedBridge for the bridge at the given
+        address (or the configured one if None), with its own airtime
+        budget
+        """
+        simulated_lights = getattr(self.opts, 'simulated_lights', None)
+        if simulated_lights:
+            kwargs = {} if address is None else {'ip': address}
+            bridge = SimulatedBridge(num_lights=simulated_lights,
+                                     recorder=recorder, **kwargs)
+        else:
+            bridge = ExtendedBridge(ip=address,
+                                    username=self.opts.bridge_username,
+                                    config_file_path=self.opts.bridge_config,
+                                    recorder=recorder)
+            bridge.inventory = Inventory.for_bridge(bridge)
+            if self.opts.refresh_inventory:
+                bridge.inventory.invalidate()
+
+        state_table_path = getattr(self.opts, 'state_table', None)
+        if state_table_path is not None:
+            from hue_toys import state_table
+            bridge.state_table = state_table.StateTableReader(
+                state_table_path or state_table.default_path(), bridge.ip)
+
+        budget_ms = getattr(self.opts, 'airtime_budget', None)
+        if budget_ms is None:
+            bridge.airtime_budget = AirtimeBudget(
+                bridge.default_airtime_budget())
+        elif budget_ms:
+            bridge.airtime_budget = AirtimeBudget(budget_ms / 1000)
+        return bridge
+
+    def warn_no_such_light(self, light):
+        """Print a warning that the given light argument was not found"""
+        print("%s: warning: no such light: %s" % (sys.argv[0], light),
+              file=sys.stderr)
+
+    @staticmethod
+    def _resolve_light(light, index):
+        """Return the ID of the light with the given ID (int) or name (str)
+        using the given name-to-ID index, or None if it isn't there
+        """
+        if isinstance(light, int):
+            return light if light in index.values() else None
+        return index.get(light)
 
     def get_lights(self):
         """Find and return a list of light IDs representing the lights
         specified by the user, in the order specified
         """
-        if self.opts.lights:
+        return self.resolve_lights(self.opts.lights)
+
+    def resolve_lights(self, light_lists, index=None):
+        """Return a list of light IDs for the lights given in light_lists (a
+        list of lists of light IDs and names, as collected by the light
+        options), in the order given, or all lights if it is empty.
+
+        If index (a dict mapping light names to IDs) is given, lights
+        are looked up in it without any requests. Otherwise, the light
+        list is taken from the light inventory cache if possible, or
+        else fetched from the bridge at most once. If
+        self.defer_light_validation is set and all lights were given by
+        ID, they are checked only if the cached light list is available.
+        """
+        given_index = index is not None
+        if light_lists:
+            light_args = [light for sublist in light_lists
+                          for light in sublist]
+            if given_index:
+                pass
+            elif (self.defer_light_validation
+                    and all(isinstance(light, int) for light in light_args)):
+                index = self.bridge.cached_light_index()
+            else:
+                index = self.bridge.get_light_index()
+            if (index is not None and not given_index
+                    and self.bridge.inventory is not None
+                    and any(self._resolve_light(light, index) is None
+                            for light in light_args)):
+                # Lights may have been added or renamed since the light
+                # list was cached
+                index = self.bridge.get_light_index(refresh=True)
+            elif (index is not None and not given_index
+                    and self.bridge.inventory is not None
+                    and not self.bridge.check_light_names(
+                        [light for light in light_args
+                         if not isinstance(light, int)], index)):
+                # A name may have moved to another light
+                index = self.bridge.get_light_index(refresh=True)
+
             lights = []
-            for light in [light for sublist in self.opts.lights
-                          for light in sublist]:
-                try:
-                    light_id = self.bridge[light].light_id
-                except KeyError:
-                    print("%s: warning: no such light: %s" %
+            for light in light_args:
+                if index is None:
+                    light_id = light
+                else:
+                    light_id = self._resolve_light(light, index)
+                if light_id is None:
+                    self.warn_no_such_light(light)
+                elif light_id in lights:
+                    print("%s: warning: duplicate light: %s" %
                           (sys.argv[0], light), file=sys.stderr)
                 else:
-                    if light_id in lights:
-                        print("%s: warning: duplicate light: %s" %
-                              (sys.argv[0], light), file=sys.stderr)
-                    else:
-                        lights.append(light_id)
+                    lights.append(light_id)
         else:
-            lights = [o.light_id for o in self.bridge.get_light_objects()]
+            if not given_index:
+                index = self.bridge.get_light_index()
+            lights = sorted(set(index.values()))
         return lights
 
     def turn_on_lights(self):
@@ -308,10 +559,10 @@ used.'''
             print(self.bridge[light].name)
         print('\nThe lights will now be turned on.')
         self.turn_on_lights()
-        sleep(5)
+        clock.sleep(5)
         print('\nThe lights will now be turned off.')
         self.turn_off_lights()
-        sleep(5)
+        clock.sleep(5)
         print('\nHave a nice day!')
 
     def run(self):
@@ -350,9 +601,22 @@ used.'''
         original power-on mode so it can be restored when
         enable_power_fail is called.
         """
+        lights = []
         for light in self.lights:
+            info = self.bridge.light_info(light)
+            if info is not None and not info['startup']:
+                self.log.info('Startup config not supported for light %s', light)
+            else:
+                lights.append(light)
+        if not lights:
+            return
+
+        # The current startup modes must be read fresh, as they aren't
+        # cached; get them all in one request
+        light_data = self.bridge.get_light()
+        for light in lights:
             try:
-                startup_config = self.bridge.api('lights/%s' % light)['config']['startup']
+                startup_config = light_data[str(light)]['config']['startup']
             except KeyError:
                 self.log.info('Startup config not supported for light %s', light)
             else:
@@ -360,7 +624,7 @@ used.'''
                 if startup_mode in ['powerfail', 'lastonstate']:
                     self.log.info('Disabling light %s power-fail recovery mode', light)
                     self.light_startup_mode[light] = startup_mode
-                    self.bridge.api('lights/%s/config' % light, {
+                    self.write_light_config(light, {
                         'startup': {
                             'mode': 'custom',
                             'customsettings': {
@@ -369,8 +633,6 @@ used.'''
                             }
                         }
                     })
-                    # Delay a bit to avoid overloading Zigbee bandwidth
-                    sleep(.1)
                 else:
                     self.log.info('Light %s startup mode not powerfail or lastonstate; leaving alone',
                                   light)
@@ -382,10 +644,45 @@ used.'''
         for light, mode in self.light_startup_mode.items():
             self.log.info('Restoring startup mode for light %s to "%s"',
                           light, mode)
-            self.bridge.api('lights/%s/config' % light,
-                            {'startup': {'mode': mode}})
-            # Delay a bit to avoid overloading Zigbee bandwidth
-            sleep(.1)
+            self.write_light_config(light, {'startup': {'mode': mode}})
+
+    def write_light_config(self, light, config):
+        """Write a light's config, pausing afterwards if the bridge doesn't
+        pace commands by an airtime budget
+        """
+        self.bridge.api('lights/%s/config' % light, config)
+        if getattr(self.bridge, 'airtime_budget', None) is None:
+            clock.sleep(CONFIG_WRITE_INTERVAL)
+
+
+class ArgumentParserExit(Exception):
+    """Exception raised by NonExitingArgumentParser in place of exiting.
+    Attributes are the exit status and the error message, if any.
+    """
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, status, message)
+        self.status = status
+        self.message = message
+
+
+class NonExitingArgumentParser(argparse.ArgumentParser):
+    """An argument parser that raises ArgumentParserExit with the exit
+    status instead of exiting the program after printing help or an
+    error message, for parsing commands that don't come from the
+    program's own command line
+    """
+
+    def exit(self, status=0, message=None):
+        if message:
+            self._print_message(message, sys.stderr)
+        raise ArgumentParserExit(status, message)
+
+    def error(self, message):
+        self.print_usage(sys.stderr)
+        self._print_message('%s: error: %s\n' % (self.prog, message),
+                            sys.stderr)
+        raise ArgumentParserExit(2, message)
 
 
 class Shutdown(Exception):
@@ -397,12 +694,24 @@ def _start_shutdown(signum, frame):
     raise Shutdown()
 
 
+def _resume(signum, frame):
+    # Not needed to wake a sleep: under PEP 475, time.sleep carries on
+    # after a signal handler returns. Having a handler makes SIGCONT
+    # interrupt a sleep in the main thread, though, and time.sleep then
+    # recomputes the time left from its monotonic deadline, so time
+    # spent stopped counts toward the sleep even on platforms where
+    # the sleep itself is timed relative to its start.
+    pass
+
+
 def default_run(prog_class):
     """Create an instance of prog_class, displaying command argument errors
     if they occur, and supply a return code for this condition or keyboard
     interrupts.
     """
     signal.signal(signal.SIGTERM, _start_shutdown)
+    if hasattr(signal, 'SIGCONT'):
+        signal.signal(signal.SIGCONT, _resume)
     prog = prog_class()
     try:
         prog.run()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import heapq
+import http.server
+import itertools
+import json
+import socketserver
+import threading
+from urllib.parse import urlsplit
+
+from phue import PhueRequestTimeout
+
+from hue_toys.base import BaseProgram, default_run
+from hue_toys.phue_helper import MAX, MIN, clock
+
+
+BROKER_USERNAME = 'hue_toys'
+"""Username given to clients that register with the broker. Clients may
+use any username; it only serves to identify them for --priority."""
+
+DEFAULT_PORT = 8080
+
+DEFAULT_CACHE_TIME = 1.0
+"""Default seconds for which the light states fetched from the bridge are
+used to answer reads"""
+
+BROKER_BRIDGE_RETRIES = 2
+"""Number of times a failed bridge request is retried before the client's
+connection is closed without a response, so that its own retries
+apply"""
+
+BRIDGE_BUSY = 901
+"""Hue API error type returned when the bridge is overloaded"""
+
+BUSY_RETRIES = 3
+BUSY_RETRY_WAIT = .5
+"""Number of times and seconds after which a command is resent when the
+bridge reports being busy"""
+
+COALESCED_ADDRESS_PARTS = ('state', 'action')
+"""Last address parts of commands that may be merged with a pending
+command to the same address"""
+
+COLOR_MODE_PARAMS = (('xy', 'xy_inc'), ('ct', 'ct_inc'),
+                     ('hue', 'sat', 'hue_inc', 'sat_inc'))
+"""Parameters setting each of the bridge's color modes; a command setting
+one mode replaces the parameters of the others in a pending command"""
+
+FOLDED_INCREMENTS = {'bri': False, 'sat': False, 'ct': False, 'hue': True}
+"""Parameters whose increments can be added to a pending absolute value,
+mapped to whether the value wraps around instead of being clamped to
+its range"""
+
+
+class BrokerCommand:
+    """A write request waiting to be sent to the bridge on behalf of one or
+    more clients
+    """
+
+    def __init__(self, method, resource, body, priority):
+        self.method = method
+        self.resource = resource
+        self.body = body
+        self.priority = priority
+        self.clients = 1
+        self.taken = False
+        self.done = threading.Event()
+        self.response = None
+
+    def merge(self, body, priority):
+        """Merge the body of a later command to the same address into this
+        one, so that it has the same effect as sending both in turn.
+        Increments are added together or to a pending absolute value;
+        other values replace earlier ones, as does a different color
+        mode. Return whether the command could be merged; if not, this
+        one is left unchanged.
+        """
+        merged = dict(self.body)
+        for params in COLOR_MODE_PARAMS:
+            if not any(param in body for param in params):
+                continue
+            others = [param for other in COLOR_MODE_PARAMS
+                      if other is not params for param in other]
+            if (any(param in body for param in params
+                    if param.endswith('_inc'))
+                    and any(param in merged for param in others
+                            if not param.endswith('_inc'))):
+                # Relative to a color the pending command sets in
+                # another mode
+                return False
+            for param in others:
+                merged.pop(param, None)
+        for param, value in body.items():
+            if not param.endswith('_inc'):
+                merged.pop(param + '_inc', None)
+                merged[param] = value
+                continue
+            base = param[:-len('_inc')]
+            if base in merged:
+                if base not in FOLDED_INCREMENTS:
+                    return False
+                value += merged[base]
+                if FOLDED_INCREMENTS[base]:
+                    value %= MAX[base] + 1
+                else:
+                    value = min(max(value, MIN[base]), MAX[base])
+                merged[base] = value
+            elif param in merged:
+                merged[param] += value
+            else:
+                merged[param] = value
+        self.body = merged
+        self.priority = max(self.priority, priority)
+        self.clients += 1
+        return True
+
+
+class BrokerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answer one client's Hue API requests over a kept-alive connection"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.broker.handle_request(self, 'GET')
+
+    def do_PUT(self):
+        self.server.broker.handle_request(self, 'PUT')
+
+    def do_POST(self):
+        self.server.broker.handle_request(self, 'POST')
+
+    def do_DELETE(self):
+        self.server.broker.handle_request(self, 'DELETE')
+
+    def log_message(self, format, *args):
+        self.server.broker.log.debug('%s: %s', self.address_string(),
+                                     format % args)
+
+
+class BrokerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class BridgeBrokerProgram(BaseProgram):
+    """Share one Hue bridge among several programs by serving a local
+    Hue-compatible API that passes their commands on to the bridge at a
+    pace it can sustain."""
+
+    usage_broker_msg = '''Point other programs at the broker with "-B HOST:PORT" (for instance,
+"-B 127.0.0.1:%d"). The broker answers their registration itself; the
+username is stored in their config file under the broker's address,
+next to the bridge's own. Any username they use identifies them for
+--priority (it can be given with -Bu). All writes are sent over a
+single kept-alive connection to the bridge, paced by the broker's
+airtime budget; programs using the broker may be given
+"--airtime-budget 0" to leave pacing to it. A pending command is merged
+with later ones to the same light or group, and waiting commands are
+sent in order of priority, then arrival. Light states are read from the
+bridge at most once per cache time, kept up to date with the commands
+sent, and used to answer reads of lights; other reads are passed
+straight to the bridge.''' % DEFAULT_PORT
+
+    def get_usage_epilog(self):
+        return '\n\n'.join([self.usage_broker_msg, self.usage_first_run_msg])
+
+    @staticmethod
+    def client_priority(str_):
+        """Convert a CLIENT=LEVEL argument to a tuple (client, level)"""
+        client, sep, level = str_.rpartition('=')
+        try:
+            if not (client and sep):
+                raise ValueError
+            return client, int(level)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'must be CLIENT=LEVEL with an integer LEVEL: %s' % str_)
+
+    def add_opts(self):
+        self.add_verbose_opt()
+        self.add_bridge_opts()
+
+        self.opt_parser.add_argument(
+            '--listen',
+            dest='listen_address', default='127.0.0.1', metavar='ADDRESS',
+            help='address to accept clients on (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '-p', '--port',
+            dest='port', type=self.int_within_range(1, 65535),
+            default=DEFAULT_PORT,
+            help='port to accept clients on (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '--priority',
+            dest='priorities', nargs='+', type=self.client_priority,
+            default=[], metavar='CLIENT=LEVEL',
+            help='''send the commands of the client using username CLIENT ahead of
+                 those of clients with lower levels (default level: 0)''')
+        self.opt_parser.add_argument(
+            '--cache-time',
+            dest='cache_time', type=self.positive_float(),
+            default=DEFAULT_CACHE_TIME, metavar='SECONDS',
+            help='''maximum age of the light states used to answer reads
+                 (default: %(default)s)''')
+
+    def get_lights(self):
+        # The broker serves all lights; fetching them here also checks
+        # the bridge connection at startup
+        return self.resolve_lights(None)
+
+    def main(self):
+        self.bridge.keep_alive = True
+        self.bridge.retries = BROKER_BRIDGE_RETRIES
+        self.priorities = dict(self.opts.priorities)
+
+        self.queue = []
+        self.pending = {}
+        self.sequence = itertools.count()
+        self.queue_cond = threading.Condition()
+        self.cache = None
+        self.cache_time = None
+        self.cache_lock = threading.Lock()
+
+        server = BrokerServer((self.opts.listen_address, self.opts.port),
+                              BrokerRequestHandler)
+        server.broker = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.log.info('Listening on %s port %d', self.opts.listen_address,
+                      self.opts.port)
+        try:
+            self.send_commands()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @staticmethod
+    def error_response(error_type, address, description):
+        return [{'error': {'type': error_type, 'address': address,
+                           'description': description}}]
+
+    def handle_request(self, handler, method):
+        """Answer a client's API request"""
+        length = int(handler.headers.get('Content-Length') or 0)
+        data = handler.rfile.read(length) if length else b''
+        path = urlsplit(handler.path).path
+        parts = [part for part in path.split('/') if part]
+
+        if parts == ['api'] and method == 'POST':
+            response = [{'success': {'username': BROKER_USERNAME}}]
+        elif len(parts) < 2 or parts[0] != 'api':
+            response = self.error_response(
+                4, path, 'method, %s, not available for resource, %s'
+                % (method, path))
+        else:
+            client, resource = parts[1], parts[2:]
+            try:
+                body = json.loads(data.decode('utf-8')) if data else None
+            except ValueError:
+                response = self.error_response(
+                    2, path, 'body contains invalid json')
+            else:
+                response = self.api_request(client, method, resource, body)
+        if response is None:
+            # Fail the connection like an unreachable bridge would
+            handler.close_connection = True
+            return
+
+        reply = json.dumps(response).encode('utf-8')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(reply)))
+        handler.end_headers()
+        handler.wfile.write(reply)
+
+    def api_request(self, client, method, resource, body):
+        """Carry out a client's request for the given list of resource
+        address parts and return the response, or None if the bridge
+        couldn't be reached
+        """
+        if method == 'GET':
+            if resource[:1] == ['lights']:
+                response = self.cached_read(resource)
+                if response is not None:
+                    return response
+            return self.bridge_request('GET', resource, None)
+
+        command = self.queue_command(
+            method, resource, body, self.priorities.get(client, 0))
+        command.done.wait()
+        return command.response
+
+    def bridge_request(self, method, resource, body):
+        """Send a request to the bridge and return its response, or None if
+        the bridge can't be reached
+        """
+        address = '/api/%s/%s' % (self.bridge.username, '/'.join(resource))
+        try:
+            return self.bridge.request(method, address, body)
+        except (ConnectionError, OSError, PhueRequestTimeout) as e:
+            self.log.warning('Bridge request failed: %s', e)
+            return None
+
+    def get_cache(self):
+        """Return the cached light descriptions, fetching them if they are
+        older than the cache time
+        """
+        with self.cache_lock:
+            if (self.cache is not None and clock.monotonic() - self.cache_time
+                    <= self.opts.cache_time):
+                return self.cache
+        lights = self.bridge_request('GET', ['lights'], None)
+        if not isinstance(lights, dict):
+            return None
+        with self.cache_lock:
+            self.cache = lights
+            self.cache_time = clock.monotonic()
+        return lights
+
+    def cached_read(self, resource):
+        """Return the part of the cached light descriptions at the given
+        address parts (starting with 'lights'), or None if it isn't
+        cached
+        """
+        cache = self.get_cache()
+        if cache is None:
+            return None
+        with self.cache_lock:
+            node = cache
+            for part in resource[1:]:
+                if not isinstance(node, dict) or part not in node:
+                    return None
+                node = node[part]
+            return json.loads(json.dumps(node))
+
+    def update_cache(self, command):
+        """Apply the successful changes reported in the response to a light
+        state command to the cached light states
+        """
+        resource = command.resource
+        if not (resource[:1] == ['lights'] and len(resource) == 3
+                and resource[2] == 'state' and command.response is not None):
+            if resource[:1] == ['lights']:
+                # Renamed, deleted, etc., or a failed command that may
+                # still have been carried out
+                with self.cache_lock:
+                    self.cache = None
+            return
+        with self.cache_lock:
+            if self.cache is None or resource[1] not in self.cache:
+                return
+            state = self.cache[resource[1]]['state']
+            for item in command.response:
+                if not isinstance(item, dict):
+                    continue
+                for address, value in item.get('success', {}).items():
+                    param = address.rsplit('/', 1)[-1]
+                    if param in state:
+                        state[param] = value
+
+    def queue_command(self, method, resource, body, priority):
+        """Queue a write request to be sent to the bridge, merging it into a
+        pending command to the same light or group if there is one.
+        Return the BrokerCommand whose response will answer it.
+        """
+        key = None
+        if (method == 'PUT' and isinstance(body, dict) and resource
+                and resource[-1] in COALESCED_ADDRESS_PARTS):
+            key = tuple(resource)
+        with self.queue_cond:
+            command = self.pending.get(key)
+            if command is not None and command.merge(body, priority):
+                self.log.debug('Merged into pending %s: %s',
+                               '/'.join(resource), command.body)
+            else:
+                # Sent after the pending command it couldn't be merged
+                # into, which later commands are merged into instead
+                command = BrokerCommand(method, resource, body, priority)
+                if key is not None:
+                    self.pending[key] = command
+            # A command raised in priority by a merge is queued again;
+            # its earlier entry is skipped when it comes up
+            heapq.heappush(self.queue, (-command.priority,
+                                        next(self.sequence), command))
+            self.queue_cond.notify()
+        return command
+
+    def next_command(self):
+        """Wait for and return the next command to send"""
+        with self.queue_cond:
+            while True:
+                while not self.queue:
+                    self.queue_cond.wait()
+                _, _, command = heapq.heappop(self.queue)
+                if command.taken:
+                    continue
+                command.taken = True
+                key = tuple(command.resource)
+                if self.pending.get(key) is command:
+                    del self.pending[key]
+                return command
+
+    def send_commands(self):
+        """Send queued commands to the bridge one at a time, forever"""
+        while True:
+            command = self.next_command()
+            for attempt in range(BUSY_RETRIES + 1):
+                response = self.bridge_request(
+                    command.method, command.resource, command.body)
+                busy = isinstance(response, list) and any(
+                    isinstance(item, dict)
+                    and item.get('error', {}).get('type') == BRIDGE_BUSY
+                    for item in response)
+                if not busy or attempt == BUSY_RETRIES:
+                    break
+                self.log.info('Bridge busy; resending %s in %ss',
+                              '/'.join(command.resource), BUSY_RETRY_WAIT)
+                clock.sleep(BUSY_RETRY_WAIT)
+            command.response = response
+            self.log.debug('Sent %s %s for %d client(s): %s', command.method,
+                           '/'.join(command.resource), command.clients,
+                           command.body)
+            self.update_cache(command)
+            command.done.set()
+
+
+def main():
+    default_run(BridgeBrokerProgram)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import itertools
+import threading
+import time
+
+from phue import PhueRequestTimeout
+
+from hue_toys.base import BaseProgram, default_run
+from hue_toys.phue_helper import Scheduler, clock
+
+
+MIXES = ['light', 'group', 'config']
+
+# A step is sustainable if at least this fraction of the target command
+# rate was actually achieved
+MIN_ACHIEVED_FRACTION = .95
+
+# Give up ramping a test after this many unsustainable steps in a row
+MAX_FAILED_STEPS = 2
+
+
+def percentile(values, fraction):
+    """Return the value at the given fraction (0 to 1) of the way through
+    the sorted sequence values, or None if it is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[round(fraction * (len(values) - 1))]
+
+
+class StepResult:
+    """Measurements taken during one step of a stress test"""
+
+    def __init__(self, target_rate):
+        self.target_rate = target_rate
+        self.latencies = []
+        self.errors = 0
+        self.busy_errors = 0
+        self.elapsed = 0
+
+    @property
+    def num_cmds(self):
+        return len(self.latencies)
+
+    @property
+    def achieved_rate(self):
+        if not self.elapsed:
+            return 0
+        return self.num_cmds / self.elapsed
+
+    @property
+    def error_rate(self):
+        if not self.num_cmds:
+            return 0
+        return self.errors / self.num_cmds
+
+    def is_sustainable(self, max_error_rate, max_latency):
+        """Return whether the bridge kept up with the target rate within the
+        given error rate and 90th-percentile latency limits
+        """
+        return (self.achieved_rate >= self.target_rate * MIN_ACHIEVED_FRACTION
+                and self.error_rate <= max_error_rate
+                and percentile(self.latencies, .9) <= max_latency)
+
+
+class BridgeStressProgram(BaseProgram):
+    """Find the maximum rate of commands the Hue bridge and lighting
+    system can sustain, by sending harmless commands at increasing rates
+    while measuring latency and errors."""
+
+    usage_mix_msg = '''Command mixes:
+
+light   Light state commands that resend each light's current brightness
+        (or on/off state for lights that are off or not dimmable)
+group   Group action commands to all lights (group 0) that cancel any
+        alert effect; the number of lights does not apply
+config  Light config commands that rewrite each light's current
+        power-on (startup) setting
+
+Each combination of mix and light count is tested at the starting rate,
+which is then multiplied by the rate factor for each subsequent step
+until the bridge falls behind, returns too many errors, or becomes too
+slow to respond. The highest rate that kept up is reported as the
+maximum sustainable rate. Unless --no-save is given, it is stored with
+the bridge's credentials in the config file, where other programs will
+use it to pace their commands.'''
+
+    def get_usage_epilog(self):
+        return '\n\n'.join(
+            [self.usage_mix_msg, self.usage_no_lights_msg,
+             self.usage_first_run_msg])
+
+    @staticmethod
+    def rate_factor(str_):
+        """Convert a string to a rate step factor, which must exceed 1"""
+        value = BaseProgram.positive_float()(str_)
+        if value <= 1:
+            raise argparse.ArgumentTypeError('must be greater than 1')
+        return value
+
+    def add_opts(self):
+        BaseProgram.add_opts(self)
+
+        self.opt_parser.add_argument(
+            '-m', '--mix',
+            dest='mixes', nargs='+', choices=MIXES, default=['light'],
+            help='command mixes to test (default: light)')
+        self.opt_parser.add_argument(
+            '-n', '--light-counts',
+            dest='light_counts', nargs='+',
+            type=self.int_within_range(1, None), metavar='N',
+            help='numbers of lights to spread commands over (default: all)')
+        self.opt_parser.add_argument(
+            '-r', '--rate-range',
+            dest='rate_range', nargs=2, type=self.positive_float(),
+            metavar=('START', 'MAX'), default=[2.0, 40.0],
+            help='range of command rates to test, in commands per second (default: 2 40)')
+        self.opt_parser.add_argument(
+            '-g', '--rate-factor',
+            dest='rate_factor', type=self.rate_factor, default=1.5,
+            metavar='FACTOR',
+            help='multiply the rate by this much at each step (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '-d', '--step-time',
+            dest='step_time', type=self.positive_float(), default=10.0,
+            metavar='SECONDS',
+            help='duration of each test step (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '-j', '--connections',
+            dest='connections', type=self.int_within_range(1, None),
+            default=4, metavar='NUM',
+            help='maximum number of requests in progress at once (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '-e', '--max-error-rate',
+            dest='max_error_rate', type=self.fractional_float(), default=.01,
+            metavar='FRACTION',
+            help='highest tolerable fraction of failed commands (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '-p', '--max-latency',
+            dest='max_latency', type=self.positive_float(), default=1.0,
+            metavar='SECONDS',
+            help='highest tolerable 90th-percentile command latency (default: %(default)s)')
+        self.opt_parser.add_argument(
+            '--no-save',
+            dest='save', action='store_false',
+            help="report the results without storing them in the config file")
+
+    def get_bridge(self):
+        bridge = BaseProgram.get_bridge(self)
+        # Failures and the bridge's own pace are what is being
+        # measured; don't hide them
+        bridge.retries = 0
+        bridge.airtime_budget = None
+        return bridge
+
+    def get_commands(self, mix, lights, light_data):
+        """Return a list of (address, body) pairs of harmless commands of the
+        given mix for the given lights, using light_data (as returned by
+        a bulk get_light call) to find their current settings
+        """
+        if mix == 'group':
+            return [('groups/0/action', {'alert': 'none'})]
+
+        commands = []
+        for light in lights:
+            data = light_data[str(light)]
+            if mix == 'light':
+                state = data['state']
+                if state['on'] and 'bri' in state:
+                    body = {'bri': state['bri']}
+                else:
+                    body = {'on': state['on']}
+                commands.append(('lights/%s/state' % light, body))
+            elif mix == 'config':
+                try:
+                    startup = data['config']['startup']
+                except KeyError:
+                    self.log.info('Startup config not supported for light %s',
+                                  light)
+                    continue
+                startup = {k: v for k, v in startup.items()
+                           if k in ('mode', 'customsettings')}
+                commands.append(('lights/%s/config' % light,
+                                 {'startup': startup}))
+        return commands
+
+    def send_command(self, address, body, scheduled_time, result):
+        """Send a command and add the outcome to StepResult result. Latency is
+        measured from scheduled_time, so it includes time spent waiting
+        for a free connection.
+        """
+        try:
+            response = self.bridge.api(address, body)
+        except (ConnectionError, OSError, PhueRequestTimeout) as e:
+            self.log.info('%s: %s', address, e)
+            response = [{'error': {'type': None, 'description': str(e)}}]
+        latency = clock.monotonic() - scheduled_time
+
+        errors = [item['error'] for item in response
+                  if isinstance(item, dict) and 'error' in item]
+        with self.result_lock:
+            result.latencies.append(latency)
+            if errors:
+                self.log.info('%s: %s', address, errors[0]['description'])
+                result.errors += 1
+                if any(error['type'] == 901 for error in errors):
+                    result.busy_errors += 1
+
+    def run_step(self, commands, rate):
+        """Send the given commands round-robin at the given rate for one step
+        and return the StepResult
+        """
+        result = StepResult(rate)
+        executor = ThreadPoolExecutor(max_workers=self.opts.connections)
+        scheduler = Scheduler()
+        start_time = clock.monotonic()
+        end_time = start_time + self.opts.step_time
+        for (address, body), _ in zip(itertools.cycle(commands),
+                                      scheduler.every(10 / rate)):
+            if clock.monotonic() >= end_time:
+                break
+            executor.submit(self.send_command, address, body,
+                            scheduler.deadline, result)
+        executor.shutdown(wait=True)
+        result.elapsed = clock.monotonic() - start_time
+        return result
+
+    def print_result(self, mix, num_lights, result):
+        def ms(seconds):
+            return '-' if seconds is None else '%.0f' % (seconds * 1000)
+        print('%-7s %6s %9.1f %9.1f %7s %7s %7s %6.1f%% %6d' % (
+            mix, num_lights, result.target_rate, result.achieved_rate,
+            ms(percentile(result.latencies, .5)),
+            ms(percentile(result.latencies, .9)),
+            ms(percentile(result.latencies, .99)),
+            result.error_rate * 100, result.busy_errors))
+
+    def find_max_rate(self, mix, commands, num_lights):
+        """Ramp the command rate for the given commands, printing the result
+        of each step. Return the highest sustainable rate, or None if
+        even the starting rate was not sustainable.
+        """
+        rate, max_rate = self.opts.rate_range
+        max_sustained = None
+        failed_steps = 0
+        while rate <= max_rate:
+            result = self.run_step(commands, rate)
+            self.print_result(mix, num_lights, result)
+            if result.is_sustainable(self.opts.max_error_rate,
+                                     self.opts.max_latency):
+                max_sustained = rate
+                failed_steps = 0
+            else:
+                failed_steps += 1
+                if failed_steps >= MAX_FAILED_STEPS:
+                    break
+            rate *= self.opts.rate_factor
+        return max_sustained
+
+    def main(self):
+        self.result_lock = threading.Lock()
+        light_data = self.bridge.get_light()
+        light_counts = sorted(set(
+            min(n, len(self.lights))
+            for n in (self.opts.light_counts or [len(self.lights)])))
+
+        print('%-7s %6s %9s %9s %7s %7s %7s %7s %6s' % (
+            'mix', 'lights', 'target/s', 'actual/s', 'p50 ms', 'p90 ms',
+            'p99 ms', 'errors', '901s'))
+        max_rates = {}
+        for mix in self.opts.mixes:
+            counts = ['all'] if mix == 'group' else light_counts
+            for num_lights in counts:
+                lights = self.lights if num_lights == 'all' \
+                    else self.lights[:num_lights]
+                commands = self.get_commands(mix, lights, light_data)
+                if not commands:
+                    self.log.warning('No lights support the %s mix; skipping',
+                                     mix)
+                    break
+                max_rate = self.find_max_rate(mix, commands, num_lights)
+                max_rates.setdefault(mix, {})[str(num_lights)] = max_rate
+
+        print()
+        for mix, rates in max_rates.items():
+            for num_lights, max_rate in rates.items():
+                if max_rate is None:
+                    print('%s, %s lights: starting rate not sustainable'
+                          % (mix, num_lights))
+                else:
+                    print('%s, %s lights: max sustainable rate %.1f commands/s'
+                          % (mix, num_lights, max_rate))
+
+        settings = {'max_command_rates': max_rates,
+                    'measured': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+        light_rates = max_rates.get('light', {})
+        if light_rates:
+            # Rate for the most lights is the most representative of
+            # effects that cycle through all of them
+            max_rate = light_rates[str(max(light_counts))]
+            if max_rate is not None:
+                settings['max_command_rate'] = max_rate
+        if self.opts.save:
+            self.bridge.save_settings(settings)
+            if 'max_command_rate' in settings:
+                print('Saved max command rate of %.1f commands/s'
+                      % settings['max_command_rate'])
+
+
+def main():
+    default_run(BridgeStressProgram)
@@ -15,12 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import deque
 import random
 import time
 
 from hue_toys.base import (BaseProgram, default_run)
 from hue_toys.fading_colors import FadingColorsProgram
-from hue_toys.phue_helper import decisleep
+from hue_toys.phue_helper import clock
+
+DEFAULT_CONNECTIONS = 4
 
 
 class ChasingColorsProgram(FadingColorsProgram):
@@ -29,33 +32,73 @@ class ChasingColorsProgram(FadingColorsProgram):
     def get_usage_epilog(self):
         return '\n\n'.join(
             [self.usage_light_order_msg, self.usage_no_lights_msg,
-             self.usage_first_run_msg])
+             self.usage_multiple_bridges_msg, self.usage_first_run_msg])
 
     def add_opts(self):
         BaseProgram.add_opts(self)
 
         self.add_cycle_time_opt(default=10)
+        self.add_adaptive_opt()
+        self.add_sync_opts()
         self.add_range_parse_opts()
         self.add_power_fail_opt()
 
+    def add_connections_opt(self):
+        """Append option for the number of commands sent at once"""
+        self.opt_parser.add_argument(
+            '-cn', '--connections',
+            dest='connections', type=self.int_within_range(1, None),
+            default=DEFAULT_CONNECTIONS, metavar='NUM',
+            help='''send commands to up to %(metavar)s lights at the same time, over
+                 separate connections; with fewer connections than lights,
+                 they can't all switch together (default: %(default)s)''')
+
+    def add_sync_opts(self):
+        """Append options for sending commands to switch lights together"""
+        self.add_connections_opt()
+        self.opt_parser.add_argument(
+            '-sm', '--smoothing',
+            dest='smoothing', type=self.int_within_range(0, None),
+            default=0, metavar='DECISECONDS',
+            help='''switch lights with a fade of %(metavar)s tenths of a second,
+                 hiding differences in when they respond (default:
+                 %(default)s)''')
+
+    def send_synchronized(self, frame, optimized=False):
+        """Send a frame of commands timed so that the lights all switch
+        together, as soon as the slowest of them can be reached over the
+        --connections connections (see ExtendedBridge.send_frame_at)
+        """
+        lights = [light for light, _ in frame]
+        deadline = clock.monotonic() + self.bridge.frame_dispatch_time(
+            lights, self.opts.connections)
+        return self.send_frame(frame, optimized, self.opts.connections,
+                               deadline, self.opts.smoothing)
+
     def main(self):
         self.turn_on_lights()
 
         # Get light states from bridge once and then keep track of them
         # ourself thereafter to reduce bridge requests and avoid weird
-        # effects due to network/state update delays
+        # effects due to network/state update delays. Each step, every
+        # light takes on the command of the light before it, so the
+        # commands are kept in order along the lights and rotated by
+        # one, with the new random state entering at the front.
         light_state = self.bridge.collect_light_states(self.lights)
+        commands = deque(
+            (self.make_command(light_state[light]) for light in self.lights),
+            maxlen=len(self.lights))
+
+        self.bridge.keep_alive = True
+        for _ in self.cycle_steps():
+            commands.appendleft(self.make_command(self.get_random_parms()))
+            self.send_synchronized(list(zip(self.lights, commands)),
+                                   optimized=True)
 
-        while True:
-            new_state = self.get_random_parms()
-            for light in self.lights:
-                orig_state = light_state[light]
-                self.bridge.set_light_optimized(
-                    light, self.bridge.normalized_light_state(new_state),
+    def make_command(self, state):
+        """Return the command setting a light to the given state at once"""
+        return dict(self.bridge.normalized_light_state(state),
                     transitiontime=0)
-                light_state[light] = new_state
-                new_state = orig_state
-            decisleep(self.opts.cycle_time)
 
 
 def main():
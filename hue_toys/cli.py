@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Single front end for all the hue_toys programs
+
+Only the module of the program that is asked for is imported, so running
+"hue_toys lightctl ..." costs no more than running lightctl itself. Keep
+this module's own imports to the standard library basics.
+"""
+
+import argparse
+from collections import OrderedDict
+import importlib
+import sys
+
+
+PROGRAMS = OrderedDict([
+    # name, (module, summary)
+    ('alt_lamp_simulation', ('hue_toys.alt_lamp_simulation',
+                             'simulate non-LED lamps warming up')),
+    ('bridge_broker', ('hue_toys.bridge_broker',
+                       'share one bridge among several programs')),
+    ('bridge_stress', ('hue_toys.bridge_stress',
+                       "measure the bridge's sustainable command rate")),
+    ('chasing_colors', ('hue_toys.chasing_colors',
+                        'random color chasing effect')),
+    ('coded_clock', ('hue_toys.coded_clock',
+                     'blink out the time as color-coded digits')),
+    ('coded_digits', ('hue_toys.coded_digits',
+                      'blink out digits encoded using colors')),
+    ('coded_stopwatch', ('hue_toys.coded_stopwatch',
+                         'blink out elapsed time as color-coded digits')),
+    ('fading_colors', ('hue_toys.fading_colors',
+                       'random color fade effect')),
+    ('flashing_colors', ('hue_toys.flashing_colors',
+                         'flash lights on and off with different colors')),
+    ('incandescent_fade', ('hue_toys.incandescent_fade',
+                           'simulate an incandescent dimmer fade')),
+    ('lightctl', ('hue_toys.lightctl_client',
+                  'control lights from the command line')),
+    ('lightctl_curses', ('hue_toys.lightctl_curses',
+                         'control lights from a curses interface')),
+    ('power_fail_restore', ('hue_toys.power_fail_restore',
+                            'restore light state after power failures')),
+    ('replay', ('hue_toys.replay',
+                'replay a log of recorded light commands')),
+    ('state_publisher', ('hue_toys.state_publisher',
+                         'share polled light states with local programs')),
+])
+
+STARTUP_TIMES_CMD = 'startup-times'
+
+DEFAULT_TIMING_RUNS = 5
+
+
+def run_program(name, args):
+    """Import the module of the named program and run it with the given
+    argument list
+    """
+    module_name = PROGRAMS[name][0]
+    sys.argv = ['hue_toys %s' % name] + args
+    importlib.import_module(module_name).main()
+
+
+def time_startup(name, runs):
+    """Return a list of the wall-clock times in seconds taken to start the
+    named program through this front end, print its help and exit, in
+    each of the given number of runs in a fresh interpreter
+    """
+    import subprocess
+    import time
+
+    cmd = [sys.executable, '-m', 'hue_toys.cli', name, '--help']
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def startup_times(args):
+    """Run the startup-times command with the given argument list"""
+    # Only this command needs these; see the module docstring
+    import json
+    import statistics
+    import time
+
+    parser = argparse.ArgumentParser(
+        prog='hue_toys %s' % STARTUP_TIMES_CMD,
+        description='''Measure how long each program takes to start up (import its modules
+and build its argument parser) in a fresh interpreter.''')
+    parser.add_argument(
+        '-n', '--runs',
+        dest='runs', type=int, default=DEFAULT_TIMING_RUNS,
+        help='number of runs to take the median of (default: %(default)s)')
+    parser.add_argument(
+        '--save',
+        dest='save_file', metavar='FILE',
+        help='''append the results to %(metavar)s as a line of JSON, for tracking
+             startup times over time''')
+    parser.add_argument(
+        'programs', nargs='*', metavar='PROGRAM',
+        help='programs to time (default: all)')
+    opts = parser.parse_args(args)
+
+    for name in opts.programs:
+        if name not in PROGRAMS:
+            parser.error('unknown program: %s' % name)
+    if opts.runs < 1:
+        parser.error('number of runs must be at least 1')
+
+    results = OrderedDict()
+    print('%-20s %10s %10s' % ('program', 'median ms', 'min ms'))
+    for name in opts.programs or PROGRAMS:
+        times = time_startup(name, opts.runs)
+        results[name] = round(statistics.median(times) * 1000, 1)
+        print('%-20s %10.1f %10.1f' % (name, results[name], min(times) * 1000))
+
+    if opts.save_file:
+        record = OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+            ('python', sys.version.split()[0]),
+            ('runs', opts.runs),
+            ('median_ms', results),
+        ])
+        with open(opts.save_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='hue_toys',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Run one of the hue_toys programs.',
+        epilog='programs:\n' + '\n'.join(
+            '  %-20s %s' % (name, summary)
+            for name, (_, summary) in PROGRAMS.items())
+        + '\n  %-20s %s' % (STARTUP_TIMES_CMD,
+                            'measure the startup time of each program')
+        + '\n\nRun "hue_toys PROGRAM --help" for help on each program.')
+    parser.add_argument(
+        'program', metavar='PROGRAM',
+        choices=list(PROGRAMS) + [STARTUP_TIMES_CMD],
+        help='program to run')
+    parser.add_argument(
+        'args', nargs=argparse.REMAINDER, metavar='ARGS',
+        help="the program's arguments")
+    opts = parser.parse_args()
+
+    if opts.program == STARTUP_TIMES_CMD:
+        startup_times(opts.args)
+    else:
+        run_program(opts.program, opts.args)
+
+
+if __name__ == '__main__':
+    main()
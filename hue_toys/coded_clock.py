@@ -19,6 +19,7 @@ import time
 
 from hue_toys.base import default_run
 from hue_toys.coded_digits import CodedDigitsProgram
+from hue_toys.phue_helper import clock
 
 
 class CodedClockProgram(CodedDigitsProgram):
@@ -31,7 +32,7 @@ class CodedClockProgram(CodedDigitsProgram):
 
     def main(self):
         while True:
-            digits = time.strftime('%H%M')
+            digits = time.strftime('%H%M', clock.localtime())
             CodedDigitsProgram.flash_digits(self, digits)
 
 
@@ -15,12 +15,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+from collections import Counter
+import itertools
 import math
+import os
+import queue
+import stat
+import sys
+import threading
 import time
 
 from hue_toys.base import (BaseProgram, default_run)
 from hue_toys.chasing_colors import ChasingColorsProgram
-from hue_toys.phue_helper import decisleep
+from hue_toys.phue_helper import Scheduler, clock
 
 
 ## Light parameters used to encode each character/digit ##
@@ -62,6 +70,23 @@ DIGITS = {
     },
 }
 
+STREAM_BUFFER = 16
+"""Number of digit groups read ahead from --stream input. Reading stops
+while the buffer is full, so that a fast writer is held back instead of
+the buffer growing without bound."""
+
+STREAM_REPORT_INTERVAL = 60
+"""Seconds between reports of the digit rate achieved with --stream"""
+
+STREAM_SEEN_GROUPS = 1024
+"""Number of digit groups without a scene that --stream --scenes
+remembers, so as to create a scene for any of them that comes up
+again. When full, it is emptied."""
+
+STREAM_SCENE_SAVE_INTERVAL = 16
+"""Number of scenes taken into use with --stream --scenes after which the
+scene cache file is written; it is also written when the input ends"""
+
 
 class CodedDigitsProgram(ChasingColorsProgram):
     """Blink out a series of digits encoded using colors."""
@@ -70,6 +95,12 @@ class CodedDigitsProgram(ChasingColorsProgram):
 
     default_scheme = DIGITS_DEFAULT
 
+    scene_cache = None
+
+    # Number of times each digit group has been shown with --scenes (see
+    # prepare_scenes)
+    shown_counts = None
+
     @property
     def _powerfail_brightness(self):
         return self.schemes[self.opts.scheme]['0']['bri']
@@ -110,14 +141,50 @@ transmit''')
             '-c', '--scheme',
             dest='scheme', type=str, choices=sorted(DIGITS.keys()), default=DIGITS_DEFAULT,
             help='use the chosen color scheme (default: %(default)s)')
+        self.add_sync_opts()
+        self.opt_parser.add_argument(
+            '--scenes',
+            dest='scenes', action='store_true',
+            help='''show each group of digits by recalling a bridge scene, which takes
+                 a single command however many lights there are; the scenes
+                 are created before the digits are flashed and kept on the
+                 bridge for later runs''')
 
         self.add_power_fail_opt()
 
+    def get_bridge(self):
+        # Scenes are kept per bridge, and a scene recall only reaches the
+        # lights of one
+        addresses = self.opts.bridge_address
+        if (self.opts.scenes and isinstance(addresses, list)
+                and len(addresses) > 1):
+            self.opt_parser.error('--scenes can only be used with one bridge')
+        return ChasingColorsProgram.get_bridge(self)
+
     def add_opts(self):
         self.add_main_opts()
-        self.opt_parser.add_argument(
-            'digits', type=str,
+        digits_group = self.opt_parser.add_mutually_exclusive_group(
+            required=True)
+        digits_group.add_argument(
+            'digits', type=str, nargs='?',
             help='the sequence of digits to flash')
+        digits_group.add_argument(
+            '--stream',
+            dest='stream', nargs='?', const='-', metavar='FILE',
+            type=self.stream_path,
+            help='''flash lines of digits as they are read from %(metavar)s (a FIFO,
+                 for instance, which is opened again whenever its writer
+                 closes it) or standard input, one after another, until the
+                 input ends''')
+
+    @staticmethod
+    def stream_path(str_):
+        """Check that the --stream file exists ('-' stands for standard
+        input)
+        """
+        if str_ != '-' and not os.path.exists(str_):
+            raise argparse.ArgumentTypeError('no such file: %s' % str_)
+        return str_
 
     @staticmethod
     def group_digits(digits, num_lights):
@@ -130,15 +197,84 @@ transmit''')
                         for i in range(0, size_with_pad, num_lights)]
         return digit_groups
 
-    def flash_digits(self, digits):
-        """Flash the lights in the code designated by the digit string “digits”."""
+    def digits_frame(self, digit_group, digit_cmds):
+        """Return the frame of commands showing the digit string digit_group
+        on the lights, with lights past its end set to the "blank"
+        color
+        """
+        return [(light, dict(digit_cmds.get(digit, digit_cmds[None]),
+                             transitiontime=0))
+                for digit, light in itertools.zip_longest(
+                    digit_group, self.lights)
+                if light is not None]
+
+    def scene_for(self, digit_group, digit_cmds, create=True):
+        """Return the ID of the bridge scene showing the digit string
+        digit_group, creating it if there isn't one and create is true,
+        or None if there is none
+        """
+        if self.scene_cache is None:
+            from hue_toys.scene_cache import SceneCache
+            self.scene_cache = SceneCache.for_bridge(self.bridge)
+        lightstates = dict(self.digits_frame(digit_group, digit_cmds))
+        if create:
+            return self.scene_cache.get(lightstates)
+        return self.scene_cache.find(lightstates)
+
+    def prepare_scenes(self, shown_groups, digit_cmds):
+        """Find the bridge scenes showing the digit groups in the sequence
+        shown_groups, and create those that aren't already there for
+        groups shown more than once (counting earlier calls, as for
+        coded_clock), most often shown first. Return a dict mapping each
+        digit group to its scene ID. Groups without a scene, such as
+        those for which there was no more room, are left out; their
+        frames are sent instead.
+        """
+        if self.shown_counts is None:
+            self.shown_counts = Counter()
+        self.shown_counts.update(shown_groups)
+        scenes = {}
+        for digit_group in sorted(set(shown_groups),
+                                  key=self.shown_counts.get, reverse=True):
+            scene_id = self.scene_for(
+                digit_group, digit_cmds,
+                create=self.shown_counts[digit_group] > 1)
+            if scene_id is not None:
+                scenes[digit_group] = scene_id
+        self.scene_cache.save()
+        return scenes
+
+    def show_digits(self, digit_group, digit_cmds, scenes, frame=None):
+        """Show the digit string digit_group on the lights, recalling its
+        scene if scenes (see prepare_scenes) has one, or else sending
+        frame (by default, its digits_frame)
+        """
+        scene_id = scenes.get(digit_group)
+        if scene_id is not None:
+            result = self.bridge.set_group(0, {'scene': scene_id})
+            if not any('error' in item for item in result[0]):
+                return
+            # Deleted since it was checked
+            self.log.warning('Recalling scene %s failed: %s', scene_id,
+                             result[0])
+            self.scene_cache.forget(scene_id)
+            del scenes[digit_group]
+        if frame is None:
+            frame = self.digits_frame(digit_group, digit_cmds)
+        self.send_synchronized(frame)
+
+    def digits_sequence(self, digits):
+        """Return the sequence of digit groups to show for the digit string
+        “digits”, as a list of (digit group, deciseconds to show it)
+        tuples, with the blank group '' for switch and pad flashes
+        """
         digit_groups = self.group_digits(digits, len(self.lights))
-        digit_cmds = self.schemes[self.opts.scheme]
         have_multiple_groups = len(digit_groups) > 1
         use_padding = self.opts.padded
         if use_padding is None:
             use_padding = have_multiple_groups
 
+        sequence = []
         last_digit_group = ''
         for digit_group in digit_groups:
 
@@ -150,27 +286,152 @@ transmit''')
             if ((have_multiple_groups or self.opts.force_switch) and
                     self.opts.switch_time >= 0 and
                     digit_group == last_digit_group):
-                self.bridge.set_light(
-                    self.lights, digit_cmds[None], transitiontime=0)
-                decisleep(self.opts.switch_time)
+                sequence.append(('', self.opts.switch_time))
 
             # Now flash the actual digits
-            for digit, light in zip(digit_group, self.lights):
-                cmd = digit_cmds.get(digit, digit_cmds[None])
-                self.bridge.set_light(
-                    light, cmd, transitiontime=0)
+            sequence.append((digit_group, self.opts.cycle_time))
             last_digit_group = digit_group
-            decisleep(self.opts.cycle_time)
 
         # Now, handle the final pad flash if this is turned on
         if use_padding:
-            self.bridge.set_light(
-                self.lights, digit_cmds[None], transitiontime=0)
-            decisleep(self.opts.cycle_time)
+            sequence.append(('', self.opts.cycle_time))
+        return sequence
+
+    def flash_digits(self, digits):
+        """Flash the lights in the code designated by the digit string “digits”."""
+        sequence = self.digits_sequence(digits)
+        digit_cmds = self.schemes[self.opts.scheme]
+        scenes = {}
+        if self.opts.scenes:
+            scenes = self.prepare_scenes(
+                [digit_group for digit_group, _ in sequence], digit_cmds)
+
+        scheduler = Scheduler()
+        for digit_group, deciseconds in sequence:
+            self.show_digits(digit_group, digit_cmds, scenes)
+            scheduler.wait(deciseconds)
+
+    def read_stream(self, path, groups):
+        """Read lines of digits from the file at path ('-' for standard
+        input) and put their digit groups into the queue groups, as
+        tuples (digit group, number of digits), followed by None when
+        the input ends. A FIFO is opened again whenever its writer
+        closes it, and so never ends.
+        """
+        try:
+            while True:
+                if path == '-':
+                    stream = sys.stdin
+                else:
+                    stream = open(path)
+                with stream:
+                    for line in iter(stream.readline, ''):
+                        digits = line.rstrip('\r\n')
+                        if not digits:
+                            continue
+                        for digit_group in self.group_digits(
+                                digits, len(self.lights)):
+                            groups.put((digit_group,
+                                        len(digit_group.lstrip(' '))))
+                if path == '-' or not stat.S_ISFIFO(os.stat(path).st_mode):
+                    break
+        except OSError as e:
+            self.log.error("Can't read %s: %s", path, e)
+        finally:
+            groups.put(None)
+
+    def report_rate(self, num_digits, start_time, groups):
+        elapsed_time = clock.monotonic() - start_time
+        self.log.info('Flashed %d digits in %.1f seconds (%.2f digits/s); '
+                      '%d groups buffered', num_digits, elapsed_time,
+                      num_digits / elapsed_time if elapsed_time else 0,
+                      groups.qsize())
+
+    def flash_stream(self, path):
+        """Flash the lines of digits read from the file at path ('-' for
+        standard input) back to back, as they come in, preparing the
+        commands of each group of digits while the one before it is
+        shown
+
+        With --scenes, a group is shown with a scene if there already is
+        one for it, and a scene is created for a group only when it
+        comes up again; until then, its frame is sent. This keeps a
+        stream of ever new digits from replacing the bridge's scenes one
+        by one.
+        """
+        groups = queue.Queue(STREAM_BUFFER)
+        threading.Thread(target=self.read_stream, args=(path, groups),
+                         daemon=True).start()
+        digit_cmds = self.schemes[self.opts.scheme]
+        use_padding = self.opts.padded is not False
+        scenes = {}
+        seen_groups = set()
+        if self.opts.scenes:
+            # The blank group comes up with every repeated group and at
+            # the end
+            scenes = self.prepare_scenes(['', ''], digit_cmds)
+
+        def prepare(item):
+            if item is None:
+                return None
+            digit_group = item[0]
+            if self.opts.scenes and digit_group not in scenes:
+                scene_id = self.scene_for(digit_group, digit_cmds,
+                                          create=digit_group in seen_groups)
+                if scene_id is not None:
+                    scenes[digit_group] = scene_id
+                    if len(scenes) % STREAM_SCENE_SAVE_INTERVAL == 0:
+                        self.scene_cache.save()
+                else:
+                    if len(seen_groups) >= STREAM_SEEN_GROUPS:
+                        seen_groups.clear()
+                    seen_groups.add(digit_group)
+            return item + (self.digits_frame(digit_group, digit_cmds),)
+
+        try:
+            # The first group is waited for before the rate is timed
+            item = prepare(groups.get())
+            start_time = report_time = clock.monotonic()
+            num_digits = 0
+            scheduler = Scheduler()
+            last_digit_group = None
+            while item is not None:
+                digit_group, group_digits, frame = item
+                if (self.opts.switch_time >= 0
+                        and digit_group == last_digit_group):
+                    self.show_digits('', digit_cmds, scenes)
+                    scheduler.wait(self.opts.switch_time)
+                self.show_digits(digit_group, digit_cmds, scenes, frame)
+                last_digit_group = digit_group
+                num_digits += group_digits
+
+                # Get the next group ready while this one is shown. If
+                # none has come in by the time this one is done, it
+                # stays on the lights until one does.
+                item = prepare(groups.get())
+                if clock.monotonic() >= report_time + STREAM_REPORT_INTERVAL:
+                    self.report_rate(num_digits, start_time, groups)
+                    report_time = clock.monotonic()
+                scheduler.wait(self.opts.cycle_time)
+        finally:
+            # Also when interrupted, so the scenes created aren't lost
+            # track of
+            if self.scene_cache is not None:
+                self.scene_cache.save()
+
+        self.report_rate(num_digits, start_time, groups)
+        if use_padding:
+            self.show_digits('', digit_cmds, scenes)
+            scheduler.wait(self.opts.cycle_time)
 
     def main(self):
-        """Call self.flash_digits with digit string given on command line"""
-        self.flash_digits(self.opts.digits)
+        """Flash the digit string given on the command line, or the digits
+        read with --stream
+        """
+        if self.opts.stream is not None:
+            self.flash_stream(self.opts.stream)
+        else:
+            self.flash_digits(self.opts.digits)
 
 
 def main():
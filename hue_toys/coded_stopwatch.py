@@ -15,10 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from time import time
-
 from hue_toys.base import default_run
 from hue_toys.coded_digits import CodedDigitsProgram
+from hue_toys.phue_helper import clock
 
 
 class CodedStopwatchProgram(CodedDigitsProgram):
@@ -29,9 +28,9 @@ class CodedStopwatchProgram(CodedDigitsProgram):
         self.add_main_opts()
 
     def main(self):
-        start = time()
+        start = clock.monotonic()
         while True:
-            elapsed_secs = int(time() - start)
+            elapsed_secs = int(clock.monotonic() - start)
             hrs, mins = elapsed_secs // 3600, (elapsed_secs // 60) % 60
             if hrs:
                 digits = '{}{:02}'.format(hrs, mins)
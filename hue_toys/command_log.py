@@ -0,0 +1,244 @@
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact, append-only binary log of light commands sent to a Hue
+bridge
+
+File layout:
+
+- A file header: MAGIC followed by the format version as a
+  little-endian uint16.
+
+- A sequence of records, each consisting of a RECORD_HEADER (timestamp,
+  record kind, target ID, field mask, transition time) followed by the
+  packed values of the fields whose bit is set in the field mask, in
+  FIELDS order. The transition time in the header is only meaningful
+  if the TRANSITION_TIME bit is set. If the EXTRA_FIELDS bit is set, a
+  uint16 length and a UTF-8 JSON object holding any parameters that
+  have no fixed encoding (including a transition time that doesn't fit
+  in the header) follow the fixed fields.
+
+Each time a CommandLogWriter is opened, a SESSION record is appended
+whose timestamp is the wall-clock time the session started. The
+timestamps of the command records that follow it are in seconds
+relative to the start of that session.
+"""
+
+import json
+import mmap
+import struct
+import threading
+import time
+
+MAGIC = b'HUETOYS\x00'
+VERSION = 1
+FILE_HEADER = struct.Struct('<%dsH' % len(MAGIC))
+
+RECORD_HEADER = struct.Struct('<dBHHH')
+"""timestamp, kind, target ID, field mask, transition time"""
+
+SESSION, LIGHT, GROUP = 0, 1, 2
+"""Record kinds: start of a recording session, light state command,
+group action command
+"""
+
+FIELDS = [
+    # parameter, struct format
+    ('on', '?'),
+    ('bri', 'B'),
+    ('hue', 'H'),
+    ('sat', 'B'),
+    ('xy', '2f'),
+    ('ct', 'H'),
+    ('bri_inc', 'h'),
+    ('hue_inc', 'i'),
+    ('sat_inc', 'h'),
+    ('ct_inc', 'i'),
+]
+FIELD_STRUCTS = [(name, struct.Struct('<' + fmt)) for name, fmt in FIELDS]
+
+TRANSITION_TIME = 1 << 14
+TRANSITION_TIME_MAX = 0xffff
+EXTRA_FIELDS = 1 << 15
+EXTRA_LENGTH = struct.Struct('<H')
+
+
+class CommandLogError(Exception):
+    """Exception raised for unreadable or corrupt command logs"""
+    pass
+
+
+def encode_record(timestamp, kind, target, params):
+    """Return the packed bytes of a log record for a command with the
+    given parameter dict (which may include 'transitiontime') sent to
+    light or group ID target
+    """
+    params = params.copy()
+    mask = 0
+    transitiontime = params.get('transitiontime')
+    if transitiontime is None:
+        params.pop('transitiontime', None)
+        transitiontime = 0
+    elif (type(transitiontime) is int
+          and 0 <= transitiontime <= TRANSITION_TIME_MAX):
+        mask |= TRANSITION_TIME
+        del params['transitiontime']
+    else:
+        # Doesn't fit the header; leave it for the extra fields
+        transitiontime = 0
+
+    values = []
+    for bit, (name, struct_) in enumerate(FIELD_STRUCTS):
+        if name in params:
+            value = params[name]
+            try:
+                if name == 'xy':
+                    values.append(struct_.pack(*value))
+                else:
+                    values.append(struct_.pack(value))
+            except struct.error:
+                # Out of range or wrong type for the fixed encoding;
+                # leave it for the extra fields
+                continue
+            mask |= 1 << bit
+            del params[name]
+    if params:
+        mask |= EXTRA_FIELDS
+        extra = json.dumps(params, separators=(',', ':')).encode('utf-8')
+        values.append(EXTRA_LENGTH.pack(len(extra)))
+        values.append(extra)
+
+    return b''.join(
+        [RECORD_HEADER.pack(timestamp, kind, target, mask, transitiontime)]
+        + values)
+
+
+class CommandLogWriter:
+    """Append light commands to a command log file"""
+
+    def __init__(self, path, clock=time.monotonic):
+        """Open (creating if necessary) the log at path and start a new
+        recording session. clock is the function used to timestamp
+        commands.
+        """
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        else:
+            self._check_header(path)
+        self.start_time = self.clock()
+        self._write(RECORD_HEADER.pack(time.time(), SESSION, 0, 0, 0))
+
+    def _check_header(self, path):
+        """Raise CommandLogError if the existing file at path is not a log of
+        the current version, which records can be appended to
+        """
+        with open(path, 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+        try:
+            magic, version = FILE_HEADER.unpack(header)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != VERSION:
+            self.file.close()
+            raise CommandLogError(
+                "%s: not a command log of version %d; can't append to it"
+                % (path, VERSION))
+
+    def _write(self, data):
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+
+    def record(self, kind, target, params):
+        """Log a command of the given record kind (LIGHT or GROUP) sent to
+        light or group ID target with parameter dict params
+        """
+        self._write(encode_record(
+            self.clock() - self.start_time, kind, target, params))
+
+    def record_light(self, light_id, params):
+        """Log a light state command"""
+        self.record(LIGHT, light_id, params)
+
+    def record_group(self, group_id, params):
+        """Log a group action command"""
+        self.record(GROUP, group_id, params)
+
+    def close(self):
+        self.file.close()
+
+
+class CommandLogReader:
+    """Read the records of a command log through a memory map of the file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise CommandLogError('%s: empty command log' % path)
+        try:
+            magic, version = FILE_HEADER.unpack_from(self.map)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC:
+            raise CommandLogError('%s: not a command log' % path)
+        if version != VERSION:
+            raise CommandLogError('%s: unsupported command log version %s'
+                                  % (path, version))
+        self.path = path
+
+    def __iter__(self):
+        """Yield a tuple (timestamp, kind, target, params) for each record in
+        the log. For SESSION records, params is an empty dict.
+        """
+        buf = self.map
+        offset = FILE_HEADER.size
+        end = len(buf)
+        while offset < end:
+            record_offset = offset
+            try:
+                timestamp, kind, target, mask, transitiontime = (
+                    RECORD_HEADER.unpack_from(buf, offset))
+                offset += RECORD_HEADER.size
+                params = {}
+                for bit, (name, struct_) in enumerate(FIELD_STRUCTS):
+                    if mask & (1 << bit):
+                        value = struct_.unpack_from(buf, offset)
+                        offset += struct_.size
+                        if name == 'xy':
+                            # Undo float32 noise; the API uses 4 places
+                            params[name] = [round(v, 4) for v in value]
+                        else:
+                            params[name] = value[0]
+                if mask & EXTRA_FIELDS:
+                    length, = EXTRA_LENGTH.unpack_from(buf, offset)
+                    offset += EXTRA_LENGTH.size
+                    params.update(json.loads(
+                        bytes(buf[offset:offset+length]).decode('utf-8')))
+                    offset += length
+            except (struct.error, ValueError):
+                raise CommandLogError(
+                    '%s: truncated or corrupt record at offset %d'
+                    % (self.path, record_offset))
+            if mask & TRANSITION_TIME:
+                params['transitiontime'] = transitiontime
+            yield timestamp, kind, target, params
+
+    def close(self):
+        self.map.close()
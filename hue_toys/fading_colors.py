@@ -19,12 +19,23 @@ import random
 import time
 
 from hue_toys.base import (BaseProgram, default_run)
-from hue_toys.phue_helper import MIN, MAX, decisleep, random_hue
+from hue_toys.phue_helper import (
+    MIN, MAX, AdaptiveCycle, Scheduler, clock, random_hue)
 
 
 class FadingColorsProgram(BaseProgram):
     """Produce a Philips Hue lighting random color fade effect."""
 
+    multiple_bridges = True
+
+    adaptive = None
+    """AdaptiveCycle following the load on the bridge with --adaptive"""
+
+    def get_usage_epilog(self):
+        return '\n\n'.join(
+            [self.usage_no_lights_msg, self.usage_multiple_bridges_msg,
+             self.usage_first_run_msg])
+
     def add_range_parse_opts(self):
         """Append hue/saturation/brightness range options to parser"""
         hue_group = self.opt_parser.add_mutually_exclusive_group()
@@ -77,6 +88,14 @@ class FadingColorsProgram(BaseProgram):
             metavar='DECISECONDS', default=default,
             help='cycle time in tenths of a second (default: %(default)s)')
 
+    def add_adaptive_opt(self):
+        """Append adaptive cycle time option to parser"""
+        self.opt_parser.add_argument(
+            '-a', '--adaptive',
+            dest='adaptive', action='store_true',
+            help='''lengthen the cycle time while the bridge can't keep up with it, and
+                 shorten it again (down to the given cycle time) when it can''')
+
     def get_random_hue(self):
         """Generate and return a random hue value according to passed program arguments"""
         if self.opts.normalized_random_hue:
@@ -118,6 +137,12 @@ class FadingColorsProgram(BaseProgram):
             '-gb', '--group-brightness',
             dest='group_bri', action='store_true',
             help='match the same brightness among all lights')
+        self.opt_parser.add_argument(
+            '-st', '--stagger',
+            dest='stagger', action='store_true',
+            help='''send each light's command at its own point in the cycle, spread
+                 evenly across it, instead of all at the start''')
+        self.add_adaptive_opt()
 
         self.add_range_parse_opts()
 
@@ -130,14 +155,70 @@ class FadingColorsProgram(BaseProgram):
     def main(self):
         self.turn_on_lights()
 
-        while True:
+        if self.opts.stagger:
+            self.run_staggered()
+            return
+
+        for _, cycle_time in self.cycle_steps():
+            transitiontime = round(cycle_time)
             parms = self.get_random_parms()
+            frame = []
             for light in self.lights:
-                self.bridge.set_light(
-                    light, parms,
-                    transitiontime=self.opts.cycle_time)
+                frame.append((light, dict(parms, transitiontime=transitiontime)))
                 parms = self.get_random_parms(parms)
-            decisleep(self.opts.cycle_time)
+            self.send_frame(frame)
+
+    def run_staggered(self):
+        """Run the effect with the lights' commands spread evenly over each
+        cycle on a fixed schedule, so that the bridge gets a steady
+        stream of commands rather than a burst every cycle. Each light
+        starts its transition at its own phase of the cycle, and the
+        transition lasts a whole cycle, as without staggering.
+        """
+        parms = None
+        for i, cycle_time in self.cycle_steps(len(self.lights)):
+            if i == 0:
+                # New cycle; grouped parameters change too
+                parms = None
+            parms = self.get_random_parms(parms)
+            self.send_frame([(self.lights[i],
+                              dict(parms, transitiontime=round(cycle_time)))])
+
+    def cycle_steps(self, steps=1):
+        """Return an iterator that yields a tuple (step, cycle time in
+        deciseconds) the given number of times per cycle, on a fixed
+        schedule spreading them evenly over each cycle. With
+        --adaptive, the cycle time is adjusted after each cycle to the
+        load measured by send_frame.
+        """
+        if self.opts.adaptive:
+            self.adaptive = AdaptiveCycle(self.opts.cycle_time)
+        scheduler = Scheduler()
+        while True:
+            cycle_time = (self.opts.cycle_time if self.adaptive is None
+                          else self.adaptive.cycle_time)
+            for step in range(steps):
+                yield step, cycle_time
+                scheduler.wait(cycle_time / steps)
+            if self.adaptive is not None:
+                self.adaptive.end_cycle()
+
+    def send_frame(self, frame, optimized=False, max_connections=1,
+                   deadline=None, smoothing=0):
+        """Send a frame of commands with the bridge's send_frame, or if a
+        deadline is given, its send_frame_at, reporting how long it took
+        to the AdaptiveCycle with --adaptive
+        """
+        start = clock.monotonic()
+        if deadline is None:
+            results = self.bridge.send_frame(frame, optimized,
+                                             max_connections)
+        else:
+            results = self.bridge.send_frame_at(
+                deadline, frame, optimized, max_connections, smoothing)
+        if self.adaptive is not None:
+            self.adaptive.record(clock.monotonic() - start, results)
+        return results
 
 
 def main():
@@ -15,13 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import heapq
 from random import choice, randint, normalvariate
-import threading
 import time
 
 from hue_toys.base import BaseProgram, default_run
 from hue_toys.chasing_colors import ChasingColorsProgram
-from hue_toys.phue_helper import MIN, MAX, decisleep
+from hue_toys.phue_helper import MIN, MAX, clock, sleep_until
 
 # Average and standard deviation of on/off times to use in deciseconds
 DEFAULT_ON_TIME_AVG = 8
@@ -33,15 +33,11 @@ DEFAULT_OFF_TIME_SD = 6
 class FlashingColorsProgram(ChasingColorsProgram):
     """Flash lights on and off with different colors"""
 
-    def __init__(self, *args, **kwargs):
-        ChasingColorsProgram.__init__(self, *args, **kwargs)
-
-        self.bridge_lock = threading.Lock()
-
     def add_opts(self):
         BaseProgram.add_opts(self)
 
         self.add_range_parse_opts()
+        self.add_connections_opt()
 
         self.opt_parser.add_argument(
             '-navg', '--on-time-avg',
@@ -70,35 +66,56 @@ class FlashingColorsProgram(ChasingColorsProgram):
         # Use generic epilog; don't display info about sequencing order
         # like chasing_colors does since it's not applicable to this
         # program
-        return BaseProgram.get_usage_epilog(self)
-
-    def set_light(self, *args, **kwargs):
-        """Wrapper for bridge set_light method, using proper locking for thread
-        safety
-        """
-        with self.bridge_lock:
-            self.bridge.set_light(*args, **kwargs)
+        return '\n\n'.join(
+            [self.usage_no_lights_msg, self.usage_multiple_bridges_msg,
+             self.usage_first_run_msg])
 
-    def do_light_flash(self, light_id):
-        """Flash the light with id “light_id” different colors"""
-        while True:
-            params = self.get_random_parms()
-            params['on'] = True
-            self.set_light(light_id, params, transitiontime=0)
-            decisleep(normalvariate(self.opts.on_time_avg, self.opts.on_time_sd))
-            self.set_light(light_id, 'on', False, transitiontime=0)
-            decisleep(normalvariate(self.opts.off_time_avg, self.opts.off_time_sd))
+    def flash_time(self, avg, sd):
+        """Return a random “on” or “off” time in seconds"""
+        return max(0, normalvariate(avg, sd)) / 10
 
     def main(self):
-        threads = []
-        for light in self.lights:
-            thread = threading.Thread(
-                target=self.do_light_flash, args=(light,), daemon=True)
-            threads.append(thread)
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        # A heap of (time, light index, turn on?) events, one per light.
+        # Each light's next event is scheduled from the time of its
+        # last one rather than from when its command was answered, so
+        # timing doesn't drift however long sending takes. An event that
+        # fell so far behind while the bridge lagged that the next one
+        # would already be due is resynced to the current time instead,
+        # so they aren't sent in a burst, as with Scheduler. Events that
+        # come due together are sent as one frame, which holds at most
+        # one command per light, as its commands may be sent in any
+        # order.
+        start_time = clock.monotonic()
+        events = [(start_time, i, True) for i in range(len(self.lights))]
+        self.bridge.keep_alive = True
+
+        while True:
+            sleep_until(events[0][0])
+            now = clock.monotonic()
+            frame = []
+            in_frame = set()
+            while events[0][0] <= now and events[0][1] not in in_frame:
+                event_time, i, turn_on = heapq.heappop(events)
+                in_frame.add(i)
+                if turn_on:
+                    params = self.get_random_parms()
+                    params['on'] = True
+                    interval = self.flash_time(
+                        self.opts.on_time_avg, self.opts.on_time_sd)
+                else:
+                    params = {'on': False}
+                    interval = self.flash_time(
+                        self.opts.off_time_avg, self.opts.off_time_sd)
+                next_time = event_time + interval
+                if next_time < now:
+                    self.log.debug('Light %s overran by %.3fs; resyncing',
+                                   self.lights[i], now - event_time)
+                    next_time = now + interval
+                heapq.heappush(events, (next_time, i, not turn_on))
+                frame.append((self.lights[i],
+                               dict(params, transitiontime=0)))
+            self.bridge.send_frame(frame,
+                                   max_connections=self.opts.connections)
 
 
 def main():
@@ -15,15 +15,231 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from math import copysign
-from time import time, sleep
+import argparse
+from math import ceil, copysign, hypot
 
 from hue_toys.base import BaseProgram, default_run
-from hue_toys.phue_helper import MIN, MAX
+from hue_toys.phue_helper import (MIN, MAX, clock, kelvin_to_xy, merge_timeline,
+                                  sleep_until, tungsten_cct)
 
 
 MIN_BRIDGE_CMD_INTERVAL = .3
-"""Minimum number of seconds between commands sent to bridge"""
+"""Minimum number of seconds between commands sent to bridge, if its
+maximum command rate hasn't been measured with bridge_stress"""
+
+DEFAULT_MAX_COLOR_ERROR = .002
+"""Default greatest distance in CIE xy allowed between the color of a
+planned fade and that of the incandescent curve at the same level"""
+
+MAX_BRI_ERROR = 1
+"""Greatest difference in brightness levels allowed between a planned
+fade and the incandescent levels at the same times, unless the
+step-by-step fade differs more"""
+
+PLAN_RETRIES = 3
+"""Number of times a fade that strays too far from the incandescent
+levels is planned again, with half the color error each time, before
+the step-by-step fade is used instead"""
+
+MAX_TRANSITION_TIME = 65535
+"""Longest transition time in deciseconds the bridge accepts"""
+
+CURRENT = 'current'
+"""Starting level argument that fades lights from their present levels"""
+
+
+def inc_xy(level):
+    """Return the CIE [x,y] color of the incandescent brightness level"""
+    return kelvin_to_xy(tungsten_cct(level))
+
+
+def _lerp(a, b, fraction):
+    return a + (b - a) * fraction
+
+
+def _chord_error(begin, end, xys):
+    """Return the greatest distance in xy between the colors of the levels
+    between begin and end and the straight line from the color of
+    begin to that of end, given a dict mapping levels to colors
+    """
+    (x0, y0), (x1, y1) = xys[begin], xys[end]
+    error = 0
+    step = 1 if end > begin else -1
+    for level in range(begin + step, end, step):
+        fraction = (level - begin) / (end - begin)
+        x, y = xys[level]
+        error = max(error, hypot(x - _lerp(x0, x1, fraction),
+                                 y - _lerp(y0, y1, fraction)))
+    return error
+
+
+def level_params(level):
+    """Return the light parameters of the given incandescent brightness
+    level, or of turning the light off if the level is one less than the
+    minimum value normally considered valid on the Hue bridge
+    """
+    if level >= MIN['inc']:
+        return {'on': True, 'inc': level}
+    return {'on': False}
+
+
+def _keyframe_params(bri, xy):
+    if bri < MIN['bri']:
+        return {'on': False}
+    return {'on': True, 'bri': round(bri), 'xy': xy}
+
+
+def plan_fade(start_bri, final_bri, fade_time,
+              max_error=DEFAULT_MAX_COLOR_ERROR, min_interval=0):
+    """Return the commands of an incandescent-like dimmer fade from
+    brightness level start_bri to final_bri over fade_time seconds, as
+    a list of (time, params) pairs: the number of seconds after the
+    start of the fade at which to send the light parameter dict params.
+
+    The bridge's transitions change brightness and xy color linearly
+    between commands. Brightness follows the fade exactly, so each
+    command covers as many levels as it can while its color stays within
+    max_error (a distance in CIE xy) of that of every level it passes
+    through, and lasts at least min_interval seconds. Commands whose
+    transitions would be too long for the bridge are split.
+    """
+    if start_bri == final_bri:
+        return []
+    step = 1 if final_bri > start_bri else -1
+    first = max(start_bri, MIN['inc'])
+    last = max(final_bri, MIN['inc'])
+    xys = {level: inc_xy(level)
+           for level in range(first, last + step, step)}
+
+    def level_time(level):
+        return fade_time * (level - start_bri) / (final_bri - start_bri)
+
+    # Points the light passes through, as (time, bri, xy); bri 0 is off
+    keyframes = []
+    if start_bri < MIN['inc']:
+        keyframes.append((0, 0, xys[first]))
+    level = first
+    keyframes.append((level_time(level), level, xys[level]))
+    while level != last:
+        end = level + step
+        while end != last:
+            if (_chord_error(level, end + step, xys) > max_error
+                    and level_time(end) - level_time(level) >= min_interval):
+                break
+            end += step
+        level = end
+        keyframes.append((level_time(level), level, xys[level]))
+    if final_bri < MIN['inc']:
+        keyframes.append((fade_time, 0, xys[last]))
+
+    commands = []
+    for (time0, bri0, xy0), (time1, bri1, xy1) in zip(keyframes,
+                                                       keyframes[1:]):
+        pieces = max(1, ceil((time1 - time0) * 10 / MAX_TRANSITION_TIME))
+        for piece in range(pieces):
+            fraction = (piece + 1) / pieces
+            time_ = _lerp(time0, time1, piece / pieces)
+            end_time = _lerp(time0, time1, fraction)
+            params = _keyframe_params(
+                _lerp(bri0, bri1, fraction),
+                [_lerp(a, b, fraction) for a, b in zip(xy0, xy1)])
+            # Rounded from absolute times so that the transitions don't
+            # drift from the schedule
+            params['transitiontime'] = round(end_time * 10) - round(time_ * 10)
+            commands.append((time_, params))
+    return commands
+
+
+def plan_steps(start_bri, final_bri, fade_time, min_interval=0):
+    """Return the commands (see plan_fade) of a fade that steps through the
+    brightness levels one at a time, sending at most one command every
+    min_interval seconds
+    """
+    if start_bri == final_bri:
+        return []
+    step_time = fade_time / abs(final_bri - start_bri)
+    num_commands = max(1, int(fade_time / max(step_time, min_interval)))
+    transitiontime = max(1, round(min_interval * 10))
+    commands = []
+    for i in range(1, num_commands + 1):
+        time_ = fade_time * i / num_commands
+        level = round(start_bri + copysign(time_ / step_time,
+                                           final_bri - start_bri))
+        commands.append((time_, dict(level_params(level),
+                                     transitiontime=transitiontime)))
+    return commands
+
+
+def plan_deviation(plan, start_bri, final_bri, fade_time):
+    """Return the greatest differences between the light states a fade plan
+    (see plan_fade or plan_steps) passes through and the incandescent
+    levels of the fade at the same times, as a tuple (brightness
+    difference, distance in CIE xy). Only levels at which the light is
+    on are compared.
+    """
+    if start_bri == final_bri:
+        return 0, 0
+    state = (0, start_bri, inc_xy(max(start_bri, MIN['inc'])))
+    # Linear pieces of the planned fade, as (start, end) states
+    pieces = []
+    for time_, params in plan:
+        if not params['on']:
+            bri, xy = 0, state[2]
+        elif 'inc' in params:
+            bri = params['inc']
+            xy = inc_xy(bri)
+        else:
+            bri = params['bri']
+            xy = params.get('xy', state[2])
+        end = (time_ + params['transitiontime'] / 10, bri, xy)
+        pieces.append(((time_, state[1], state[2]), end))
+        state = end
+
+    bri_error = xy_error = 0
+    step = 1 if final_bri > start_bri else -1
+    for level in range(max(start_bri, MIN['inc']),
+                       max(final_bri, MIN['inc']) + step, step):
+        time_ = fade_time * (level - start_bri) / (final_bri - start_bri)
+        (time0, bri0, xy0), (time1, bri1, xy1) = next(
+            (piece for piece in pieces if piece[1][0] >= time_), pieces[-1])
+        fraction = (min(max((time_ - time0) / (time1 - time0), 0), 1)
+                    if time1 > time0 else 1)
+        x, y = inc_xy(level)
+        bri_error = max(bri_error, abs(_lerp(bri0, bri1, fraction) - level))
+        xy_error = max(xy_error, hypot(x - _lerp(xy0[0], xy1[0], fraction),
+                                       y - _lerp(xy0[1], xy1[1], fraction)))
+    return bri_error, xy_error
+
+
+def plan_checked_fade(start_bri, final_bri, fade_time,
+                      max_error=DEFAULT_MAX_COLOR_ERROR, min_interval=0):
+    """Return a tuple (commands, deviation) of the commands of a fade
+    planned by plan_fade, checked against the step-by-step fade of
+    plan_steps, and their plan_deviation.
+
+    A plan whose brightness strays from the incandescent levels by more
+    than MAX_BRI_ERROR, or whose color strays by more than max_error
+    (or in either case, by more than the step-by-step fade does, if
+    that is more), is planned again with half the color error, as
+    rounding transition times to deciseconds can push it past the
+    limit. If that doesn't help after PLAN_RETRIES times, the
+    step-by-step fade is returned instead.
+    """
+    steps = plan_steps(start_bri, final_bri, fade_time, min_interval)
+    steps_bri_error, steps_xy_error = plan_deviation(
+        steps, start_bri, final_bri, fade_time)
+    bri_tolerance = max(MAX_BRI_ERROR, steps_bri_error)
+    xy_tolerance = max(max_error, steps_xy_error)
+    plan_error = max_error
+    for _ in range(PLAN_RETRIES + 1):
+        plan = plan_fade(start_bri, final_bri, fade_time, plan_error,
+                         min_interval)
+        bri_error, xy_error = plan_deviation(
+            plan, start_bri, final_bri, fade_time)
+        if bri_error <= bri_tolerance and xy_error <= xy_tolerance:
+            return plan, (bri_error, xy_error)
+        plan_error /= 2
+    return steps, (steps_bri_error, steps_xy_error)
 
 
 class IncandescentFadeProgram(BaseProgram):
@@ -32,14 +248,50 @@ class IncandescentFadeProgram(BaseProgram):
     def add_light_state_opt(self):
         self.add_restore_opt()
 
+    def start_level(self):
+        """Return a function that converts a starting brightness level
+        argument to an int, or to None if it is CURRENT
+        """
+        level = self.int_within_range(MIN['inc']-1, MAX['inc'])
+
+        def start_level_validator(str_):
+            if str_ == CURRENT:
+                return None
+            return level(str_)
+
+        return start_level_validator
+
+    def light_levels(self):
+        """Return a function that converts a LIGHT=START:FINAL argument to a
+        tuple (light, start level, final level), where light is a light
+        ID (int) or name (str), and the start level is None if it is
+        CURRENT
+        """
+        start_level = self.start_level()
+        final_level = self.int_within_range(MIN['inc']-1, MAX['inc'])
+
+        def light_levels_validator(str_):
+            light, sep, levels = str_.rpartition('=')
+            start, colon, final = levels.partition(':')
+            if not (light and sep and colon):
+                raise argparse.ArgumentTypeError(
+                    'must be LIGHT=START:FINAL: %s' % str_)
+            try:
+                light = int(light)
+            except ValueError:
+                pass
+            return light, start_level(start), final_level(final)
+
+        return light_levels_validator
+
     def add_opts(self):
         BaseProgram.add_opts(self)
 
         self.opt_parser.add_argument(
-            'start_brightness',
-            type=self.int_within_range(MIN['inc']-1, MAX['inc']),
-            help='the starting brightness level (%d–%d); %d is off' % (
-                MIN['inc'], MAX['inc'], MIN['inc']-1))
+            'start_brightness', type=self.start_level(),
+            help='''the starting brightness level (%d–%d); %d is off, and "%s" starts
+                 each light from its present level''' % (
+                     MIN['inc'], MAX['inc'], MIN['inc']-1, CURRENT))
         self.opt_parser.add_argument(
             'final_brightness',
             type=self.int_within_range(MIN['inc']-1, MAX['inc']),
@@ -48,51 +300,116 @@ class IncandescentFadeProgram(BaseProgram):
         self.opt_parser.add_argument(
             'fade_time', type=self.positive_float(),
             help='number of seconds to perform the fade')
+        self.opt_parser.add_argument(
+            '-L', '--light-levels',
+            dest='light_levels', action='append', nargs='+',
+            type=self.light_levels(), default=[],
+            metavar='LIGHT=START:FINAL',
+            help='''fade the light with ID or name LIGHT from START to FINAL instead
+                 (START may be "%s"); the light is used in addition to any
+                 given with -l or -ln''' % CURRENT)
+        self.opt_parser.add_argument(
+            '-st', '--stagger',
+            dest='stagger', type=self.non_negative_float(), default=0,
+            metavar='SECONDS',
+            help='''start each light's fade this many seconds after the previous
+                 light's''')
+        self.opt_parser.add_argument(
+            '--max-color-error',
+            dest='max_color_error', type=self.positive_float(),
+            default=DEFAULT_MAX_COLOR_ERROR, metavar='DISTANCE',
+            help='''greatest difference in CIE xy color allowed between the fade and a
+                 real incandescent lamp at the same level; larger values fade
+                 with fewer commands (default: %(default)s)''')
+        self.opt_parser.add_argument(
+            '--stepwise',
+            dest='stepwise', action='store_true',
+            help='''step through each brightness level with a command of its own,
+                 instead of letting the bridge fade between a few planned
+                 levels''')
 
         self.add_power_fail_opt()
 
-    def _set_light_incan(self, level, transitiontime):
-        """Set lights to the given brightness of “incandescent bulb” color, or
-        turn them off if brightness level is one less than the minimum
-        value normally considered valid on the Hue bridge.
-        """
-        if level >= MIN['inc']:
-            cmd = {'on': True, 'inc': level}
-        else:
-            cmd = {'on': False}
-        self.bridge.set_light(self.lights, cmd,
-                              transitiontime=transitiontime)
-
-    def fade(self, start_bri, final_bri, fade_time):
-        """Perform an incandescent-like dimmer fade from brightness level
-        start_bri to final_bri (which may be lower or higher than
-        start_bri) over a total period of fade_time seconds.
-        """
-        self._set_light_incan(start_bri, 0)
+    def get_lights(self):
+        self.levels = {}
+        if not self.opts.light_levels:
+            return BaseProgram.get_lights(self)
+
+        level_args = [levels for level_list in self.opts.light_levels
+                      for levels in level_list]
+        light_lists = list(self.opts.lights or [])
+        light_lists.append([
+            light for light, _, _ in level_args
+            if not any(light in light_list for light_list in light_lists)])
+        index = self.bridge.get_light_index()
+        lights = self.resolve_lights(light_lists, index)
+        for light, start, final in level_args:
+            light_id = self._resolve_light(light, index)
+            if light_id is not None:
+                self.levels[light_id] = (start, final)
+        return lights
+
+    @staticmethod
+    def present_level(state):
+        """Return the incandescent brightness level of a light state dict"""
+        if state is None or not state.get('on'):
+            return MIN['inc'] - 1
+        return state.get('bri', MIN['inc'])
+
+    def plan(self, start_bri, final_bri, min_interval):
+        """Return the commands of one light's fade (see plan_fade)"""
+        if self.opts.stepwise:
+            return plan_steps(start_bri, final_bri, self.opts.fade_time,
+                              min_interval)
+        plan, deviation = plan_checked_fade(
+            start_bri, final_bri, self.opts.fade_time,
+            self.opts.max_color_error, min_interval)
+        self.log.info('Fading from %d to %d in %d commands instead of %d '
+                      'steps; greatest difference from incandescent '
+                      'levels: %.1f brightness, %.4f xy', start_bri,
+                      final_bri, len(plan), abs(final_bri - start_bri),
+                      *deviation)
+        return plan
+
+    def main(self):
+        # Each light's commands are kept this far apart, so that all of
+        # the lights' together stay within the bridge's command rate
+        cmd_interval = self.bridge.min_command_interval(
+            MIN_BRIDGE_CMD_INTERVAL, len(self.lights))
+        default_levels = (self.opts.start_brightness,
+                          self.opts.final_brightness)
+        fades = [(light,) + self.levels.get(light, default_levels)
+                 for light in self.lights]
+
+        # Lights fading from their present levels are left as they are
+        self.bridge.play_timeline(merge_timeline(
+            (0, light, dict(level_params(start), transitiontime=0))
+            for light, start, _ in fades if start is not None))
+        if any(start is None for _, start, _ in fades):
+            states = self.bridge.get_light_states()
+            fades = [(light, self.present_level(states.get(int(light)))
+                      if start is None else start, final)
+                     for light, start, final in fades]
         # Wait a short while, because apparently the last transition
         # time can get overridden if a new command with a different
         # transition time is sent too soon to the same light
-        sleep(MIN_BRIDGE_CMD_INTERVAL)
-
-        num_steps = abs(start_bri - final_bri)
-        step_time = fade_time / num_steps
-        start_time = time()
-
-        while True:
-            elapsed_time = min(time() - start_time, fade_time)
-            bri = round(start_bri + copysign(elapsed_time / step_time,
-                                             final_bri - start_bri))
-            self.log.info('Setting brightness %d', bri)
-            self._set_light_incan(
-                bri, transitiontime=int(MIN_BRIDGE_CMD_INTERVAL * 10))
-            if elapsed_time >= fade_time:
-                break
-            time_to_next_step = step_time - ((time() - start_time) % step_time)
-            sleep(max(MIN_BRIDGE_CMD_INTERVAL, time_to_next_step))
+        clock.sleep(cmd_interval)
 
-    def main(self):
-        self.fade(self.opts.start_brightness, self.opts.final_brightness,
-                  self.opts.fade_time)
+        plans = {}
+        commands = []
+        for i, (light, start, final) in enumerate(fades):
+            if (start, final) not in plans:
+                plans[start, final] = self.plan(start, final, cmd_interval)
+            commands.extend((i * self.opts.stagger + time_, light, params)
+                            for time_, params in plans[start, final])
+        timeline = merge_timeline(commands)
+        self.log.info('%d commands for %d lights merged into %d',
+                      len(commands), len(fades), len(timeline))
+
+        start_time = clock.monotonic()
+        self.bridge.play_timeline(timeline, start_time)
+        sleep_until(start_time + self.opts.fade_time
+                    + (len(fades) - 1) * self.opts.stagger)
 
 
 def main():
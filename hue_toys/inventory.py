@@ -0,0 +1,192 @@
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent cache of the lights connected to Hue bridges, so that
+programs can resolve light names and check light capabilities without
+downloading the full light list every time they start
+
+The cache is a JSON file kept in the same directory as the phue config
+file, holding one entry per bridge address:
+
+    {"<bridge address>": {"fetched": <Unix time>,
+                          "lights": {"<light ID>": {<light summary>}}}}
+
+The Hue API offers no inexpensive way to find out whether the set of
+lights has changed, so entries are trusted until they reach MAX_AGE or
+until a program finds that a light is missing from the bridge or from
+the cache, or that the bridge describes a light differently (with
+another name, type or model, as when it has been renamed or another
+light has been paired under its ID). Lights looked up by name in a
+list loaded from the cache file are checked this way with a request
+for the light alone, once per session (see
+ExtendedBridge.check_light_names), as a name that has since moved to
+another light would otherwise resolve to the wrong one.
+"""
+
+import json
+import logging
+import os
+import time
+
+INVENTORY_FILE_NAME = '.hue_toys_inventory'
+
+MAX_AGE = 24 * 60 * 60
+"""Seconds after which a cached light list is fetched again"""
+
+logger = logging.getLogger(__name__)
+
+
+def light_summary(data):
+    """Return the inventory entry for a light given its description from
+    the Hue API
+    """
+    control = data.get('capabilities', {}).get('control', {})
+    ct = control.get('ct')
+    return {
+        'name': data['name'],
+        'type': data.get('type'),
+        'modelid': data.get('modelid'),
+        'startup': 'startup' in data.get('config', {}),
+        'colorgamut': control.get('colorgamut'),
+        'ct': [ct['min'], ct['max']] if ct else None,
+    }
+
+
+class Inventory:
+    """The cached light list of one bridge
+
+    Attributes:
+    lights: Dict mapping light ID strings to light summaries (see
+        light_summary), or None if there is no up-to-date cached list
+    from_file: Whether lights was loaded from the cache file rather
+        than fetched from the bridge during this session
+    checked: Set of IDs of the lights found to match their summaries
+        during this session
+    """
+
+    def __init__(self, path, bridge_address, max_age=MAX_AGE):
+        self.path = path
+        self.bridge_address = bridge_address
+        self.lights = None
+        self.from_file = False
+        self.checked = set()
+
+        entry = self._read().get(bridge_address)
+        if entry is not None and time.time() - entry['fetched'] <= max_age:
+            self.lights = entry['lights']
+            self.from_file = True
+
+    @classmethod
+    def for_bridge(cls, bridge, max_age=MAX_AGE):
+        """Return the Inventory of the given phue Bridge, kept next to its
+        config file
+        """
+        path = os.path.join(os.path.dirname(bridge.config_file_path),
+                            INVENTORY_FILE_NAME)
+        return cls(path, bridge.ip, max_age)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entry):
+        data = self._read()
+        if entry is None:
+            data.pop(self.bridge_address, None)
+        else:
+            data[self.bridge_address] = entry
+        # Write to a temporary file and rename it, so that concurrently
+        # started programs never see a partially written cache
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning("Can't write light inventory cache: %s", e)
+
+    def update(self, light_data):
+        """Replace the cached light list with the summaries of the lights in
+        light_data (the result of a bulk get_light call) and save it
+        """
+        self.lights = {light_id: light_summary(data)
+                       for light_id, data in light_data.items()}
+        self.from_file = False
+        self._write({'fetched': time.time(), 'lights': self.lights})
+
+    def invalidate(self):
+        """Discard the cached light list, so that it is fetched from the
+        bridge again the next time it is needed
+        """
+        self.lights = None
+        self.from_file = False
+        self.checked.clear()
+        self._write(None)
+
+    def get(self, light):
+        """Return the summary of the light with the given ID or name, or None
+        if it isn't in the cached list. A light name missing from a list
+        loaded from the cache file discards the list, as the light may
+        have been added or renamed since.
+        """
+        if self.lights is None:
+            return None
+        try:
+            return self.lights[str(int(light))]
+        except KeyError:
+            return None
+        except ValueError:
+            for summary in self.lights.values():
+                if summary['name'] == light:
+                    return summary
+        if self.from_file:
+            logger.info('Light %s not in cached light list; discarding it',
+                        light)
+            self.invalidate()
+        return None
+
+    def check_all(self, light_data):
+        """Compare the cached light list with light_data (the result of a bulk
+        get_light call) just fetched from the bridge, and replace it if
+        it differs
+        """
+        lights = {light_id: light_summary(data)
+                  for light_id, data in light_data.items()}
+        if lights != self.lights:
+            if self.lights is not None:
+                logger.info('Light list changed; updating cached light list')
+            self.update(light_data)
+
+    def check(self, light_id, data):
+        """Compare the cached summary of the light with the given ID with its
+        description data just fetched from the bridge. If the light isn't
+        in the cached list, or has another name, type or model, discard
+        the list and return False; otherwise return True.
+        """
+        if self.lights is None:
+            return True
+        summary = self.lights.get(str(light_id))
+        if summary is not None and all(
+                summary[key] == data.get(key)
+                for key in ('name', 'type', 'modelid')):
+            self.checked.add(str(light_id))
+            return True
+        logger.info('Light %s differs from cached light list; discarding it',
+                    light_id)
+        self.invalidate()
+        return False
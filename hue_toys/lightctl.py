@@ -15,11 +15,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time
+from collections import OrderedDict, defaultdict
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import queue
+import shlex
+import socketserver
+import sys
+import threading
 
-from hue_toys.base import (BaseProgram, default_run)
+from phue import PhueRequestTimeout
+
+from hue_toys.base import (
+    ArgumentParserExit, BaseProgram, NonExitingArgumentParser, default_run)
+from hue_toys.lightctl_client import (
+    SOCKET_NAME, connect, default_socket_path)
 from hue_toys.phue_helper import (
-    DEFAULT_TRANSITION_TIME, MIN, MAX, iconv_ct, decisleep)
+    DEFAULT_TRANSITION_TIME, MIN, MAX, Scheduler, clock,
+    iconv_ct, decisleep)
 
 
 TRANSITION_OVERHEAD = 4
@@ -29,6 +44,108 @@ execution delays
 """
 
 
+RESOURCE_NOT_AVAILABLE = 3
+"""Hue API error type returned for commands to nonexistent lights"""
+
+COMMAND_PARAMS = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'ctk', 'inc',
+                  'transitiontime')
+"""Light parameters that can be set by command options"""
+
+INCREMENT_PARAMS = {'bri': 'bri_inc', 'hue': 'hue_inc', 'sat': 'sat_inc',
+                    'ct': 'ct_inc'}
+"""Light parameters whose relative changes are sent as the bridge's own
+increment parameters, mapped to the names of those parameters"""
+
+INCREMENTED_PARAMS = {inc: param for param, inc in INCREMENT_PARAMS.items()}
+"""Increment parameters mapped to the light parameters they change"""
+
+BRIDGE_ERRORS = (ConnectionError, OSError, PhueRequestTimeout)
+"""Exceptions raised when the bridge can't be reached"""
+
+RELATIVE_STATE_PARAMS = {'ctk': 'ct', 'inc': 'bri'}
+"""Light parameters whose relative values are resolved against a
+different setting of the light's state, mapped to that setting"""
+
+COALESCE_WINDOW = .005
+"""Seconds for which the daemon collects further requests after receiving
+one, so that commands arriving together are merged and sent as a batch"""
+
+STATE_MAX_AGE = .5
+"""Maximum age in seconds of the light states the daemon uses for
+relative adjustments before fetching them again"""
+
+DEFAULT_WATCH_INTERVAL = 1.0
+"""Default seconds between polls of the light states in watch mode"""
+
+DAEMON_BRIDGE_RETRIES = 2
+DAEMON_BRIDGE_RETRY_WAIT = .5
+"""Number of times and seconds after which the daemon retries a failed
+bridge request before reporting the error to the client"""
+
+BRIDGE_OPTS = ('bridge_address', 'bridge_username', 'bridge_config',
+               'simulated_lights', 'record_file', 'airtime_budget',
+               'time_warp')
+"""Option destinations that can't be changed in daemon requests or batch
+files"""
+
+
+def add_increment(param, value, increment):
+    """Return the value of light parameter param after adding increment to
+    value, wrapped around for hue and otherwise limited to the range of
+    the parameter, as the bridge does for increment parameters
+    """
+    if param == 'hue':
+        return (value + increment) % (MAX['hue'] + 1)
+    return max(min(value + increment, MAX[param]), MIN[param])
+
+
+def limit_increment(param, increment):
+    """Return the given increment of light parameter param limited to the
+    range accepted by the bridge, with the same effect
+    """
+    if param == 'hue':
+        # Wraps around, so only the remainder matters
+        span = MAX['hue'] + 1
+        return (increment + span // 2) % span - span // 2
+    span = MAX[param] - MIN[param]
+    return max(min(increment, span), -span)
+
+
+class DaemonRequest:
+    """A command received by the lightctl daemon, and its outcome"""
+
+    def __init__(self, args):
+        self.args = args
+        self.done = threading.Event()
+        self.status = 0
+        self.output = ''
+        self.errors = ''
+        self.wait = 0
+        self.missing_lights = 0
+
+    def reply(self):
+        return {'status': self.status, 'output': self.output,
+                'errors': self.errors, 'wait': self.wait}
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Pass a client's request to the daemon's queue and send back the
+    outcome once it has been handled
+    """
+
+    def handle(self):
+        try:
+            args = json.loads(self.rfile.readline().decode('utf-8'))['args']
+        except (ValueError, KeyError, TypeError):
+            return
+        if not isinstance(args, list):
+            return
+        request = DaemonRequest([str(arg) for arg in args])
+        self.server.requests.put(request)
+        request.done.wait()
+        self.wfile.write(json.dumps(request.reply()).encode('utf-8') + b'\n')
+
+
 class LightControlProgram(BaseProgram):
     """Command-line utility to control Hue lights"""
 
@@ -37,11 +154,44 @@ with a + or - to add or subtract the value from the light's current
 setting instead of setting it directly to that value. Color temperature
 will be limited to Hue's supported range of 153–500 mired or 2000–6535
 Kelvin if such relative inputs are used, though setting absolute values
-outside this range are allowed and will be simulated if necessary.'''
+outside this range are allowed and will be simulated if necessary.
+Relative brightness, hue, saturation and mired color temperature changes
+are carried out by the bridge itself, from each light's latest setting
+at the time; hue wraps around instead of stopping at the end of its
+range.'''
+
+    usage_batch_msg = '''A --batch file holds one command per line, written as lightctl options
+(without bridge options); blank lines and text after a # are ignored.
+Lines without light options apply to the lights given on the command
+line, and lines without -t use its transition time. Every line is
+checked before anything is sent. The resulting settings are merged for
+each light, so later lines override or add to earlier ones, and a
+setting shared by all lights, or by exactly the lights of a group, may
+be sent to the group in a single command.'''
+
+    usage_watch_msg = '''With --watch, the states of all lights are fetched in one request per
+interval, and a line of JSON is printed for each setting of the given
+lights (or all lights) that differs from the previous poll, such as
+
+{"time": 1500000000.123, "light": 1, "attr": "bri", "value": 200, "old": 100}
+
+where "time" is the Unix time of the poll. The first poll reports every
+setting, with an "old" value of null, and a light that disappears from
+the bridge is reported once with an "attr" of "removed".'''
+
+    # A one-shot command shouldn't cost an extra request; a missing light
+    # is reported from the bridge's response instead
+    defer_light_validation = True
+
+    # Light states fetched for relative adjustments by the daemon and
+    # batch modes (see get_light_states)
+    light_states = None
+    light_states_time = None
 
     def get_usage_epilog(self):
         return '\n\n'.join(
             [self.usage_no_lights_msg, self.usage_relative_args,
+             self.usage_batch_msg, self.usage_watch_msg,
              self.usage_first_run_msg])
 
     def add_light_state_opt(self):
@@ -108,12 +258,41 @@ outside this range are allowed and will be simulated if necessary.'''
             action='store_true',
             help='wait for the transition time to elapse before exiting')
 
-    def handle_relative(self, light_id, param, value):
+        daemon_group = self.opt_parser.add_mutually_exclusive_group()
+        daemon_group.add_argument(
+            '--daemon',
+            action='store_true',
+            help='''keep running and carry out commands sent by "lightctl --client",
+                 keeping the bridge connection and light list ready''')
+        daemon_group.add_argument(
+            '--client',
+            action='store_true',
+            help='''hand the command to a running lightctl daemon for quicker
+                 response, or carry it out directly if none is running''')
+        daemon_group.add_argument(
+            '--batch',
+            dest='batch_file', metavar='FILE',
+            help='''carry out the commands in %(metavar)s ("-" for standard input), one
+                 per line using the options above, all together''')
+        daemon_group.add_argument(
+            '--watch',
+            dest='watch_interval', nargs='?', type=self.positive_float(),
+            const=DEFAULT_WATCH_INTERVAL, metavar='SECONDS',
+            help='''print changes to the lights' settings as lines of JSON, polling
+                 every %%(metavar)s seconds (default: %s)'''
+            % DEFAULT_WATCH_INTERVAL)
+        self.opt_parser.add_argument(
+            '--socket',
+            dest='socket_path', metavar='PATH',
+            help='''UNIX socket for --daemon and --client (default:
+                 $XDG_RUNTIME_DIR/%s, or /tmp/hue_toys_lightctl-UID.sock)'''
+            % SOCKET_NAME)
+
+    def handle_relative(self, state, param, value):
         """Take a relative value to change light parameter param by and return
         the effective absolute value that that parameter should be set
-        to to effect the change.
+        to to effect the change, given the light's current state.
         """
-        state = self.bridge.get_light(light_id)['state']
         if param == 'ctk':
             new_value = iconv_ct(state['ct']) + value
             new_value = max(min(new_value, MAX['ctk']), MIN['ctk'])
@@ -125,31 +304,595 @@ outside this range are allowed and will be simulated if necessary.'''
             new_value = max(min(state[param] + value, MAX[param]), MIN[param])
         return new_value
 
-    def main(self):
+    @staticmethod
+    def unsupported_param(params, state):
+        """Return the first setting of a light's state that command params
+        need for a relative value but the light doesn't have (such as
+        the color temperature of a dimmable light), or None
+        """
+        for param, (_, relative) in params.items():
+            if relative and param not in INCREMENT_PARAMS:
+                state_param = RELATIVE_STATE_PARAMS.get(param, param)
+                if state_param not in state:
+                    return state_param
+        return None
+
+    def warn_unsupported(self, light, param):
+        """Print a warning that a relative value can't be applied to the given
+        light, which lacks the light parameter param
+        """
+        print("%s: warning: light %s has no '%s' setting to adjust"
+              % (sys.argv[0], light, param), file=sys.stderr)
+
+    def report_missing_light(self, light):
+        """Warn about a light the bridge doesn't have, and discard the cached
+        light list, which may be out of date
+        """
+        self.warn_no_such_light(light)
+        if self.bridge.inventory is not None:
+            self.bridge.inventory.invalidate()
+
+    @staticmethod
+    def get_command_params(opts):
+        """Return a dict mapping each light parameter given in the parsed
+        options opts to a tuple (value, relative)
+        """
+        params = {}
+        for param in COMMAND_PARAMS:
+            value = getattr(opts, param)
+            if value is None:
+                continue
+            if not isinstance(value, tuple):
+                value = (value, False)
+            params[param] = value
+        return params
+
+    @staticmethod
+    def needs_state(params):
+        """Return whether command params include any relative values that
+        can't be sent as increments and so need the light's current state
+        """
+        return any(relative and param not in INCREMENT_PARAMS
+                   for param, (_, relative) in params.items())
+
+    def light_command(self, params, state=None):
+        """Return the command to send to a light for the given command params,
+        sending relative values as increments where possible and
+        resolving the rest against the light's state
+        """
         cmd = {}
+        for param, (value, relative) in params.items():
+            if relative and param in INCREMENT_PARAMS:
+                cmd[INCREMENT_PARAMS[param]] = limit_increment(param, value)
+                continue
+            if relative:
+                value = self.handle_relative(state, param, value)
+            cmd[param] = value
+        return cmd
+
+    @staticmethod
+    def update_state(state, cmd):
+        """Update a light state dict with the effect of a command"""
+        for param, value in cmd.items():
+            if param in INCREMENTED_PARAMS:
+                param = INCREMENTED_PARAMS[param]
+                if param in state:
+                    state[param] = add_increment(param, state[param], value)
+            elif param == 'inc':
+                state['bri'] = value
+            elif param in state:
+                state[param] = value
+
+    def build_commands(self, entries, states=None):
+        """Resolve the commands of a sequence of (key, params, lights) entries,
+        in order, for each of their lights. Relative values are taken
+        from states (a dict mapping light IDs to states, as returned by
+        get_light_states), which is updated as each command is applied
+        so that later adjustments add to earlier ones. Return a tuple
+        (commands, missing, unsupported) of a list of (light, command,
+        key) tuples, a list of (key, light) pairs for lights that aren't
+        in states, and a list of (key, light, param) tuples for lights
+        whose states lack the setting param needed by a relative value.
+        """
+        commands = []
+        missing = []
+        unsupported = []
+        for key, params, lights in entries:
+            for light in lights:
+                state = None if states is None else states.get(light)
+                if self.needs_state(params):
+                    if state is None:
+                        missing.append((key, light))
+                        continue
+                    param = self.unsupported_param(params, state)
+                    if param is not None:
+                        unsupported.append((key, light, param))
+                        continue
+                cmd = self.light_command(params, state)
+                if state is not None:
+                    self.update_state(state, cmd)
+                commands.append((light, cmd, key))
+        return commands, missing, unsupported
+
+    @staticmethod
+    def merge_commands(commands):
+        """Merge a sequence of (light, command) pairs into an OrderedDict
+        mapping each light to a single command, in which parameters from
+        later commands for the same light take precedence. Increments
+        are added to earlier values or increments of their parameter.
+        """
+        merged = OrderedDict()
+        for light, cmd in commands:
+            light_cmd = merged.setdefault(light, {})
+            for param, value in cmd.items():
+                target = INCREMENTED_PARAMS.get(param)
+                if target == 'bri' and 'inc' in light_cmd:
+                    target = 'inc'
+                if target is None:
+                    light_cmd[param] = value
+                    light_cmd.pop(INCREMENT_PARAMS.get(
+                        'bri' if param == 'inc' else param), None)
+                elif target in light_cmd:
+                    light_cmd[target] = add_increment(
+                        target, light_cmd[target], value)
+                else:
+                    light_cmd[param] = limit_increment(
+                        target, light_cmd.get(param, 0) + value)
+        return merged
 
-        for light in self.lights:
-            for param in ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'ctk',
-                          'inc', 'transitiontime'):
-                value = getattr(self.opts, param)
-                if isinstance(value, tuple):
-                    value, relative = getattr(self.opts, param)
-                    if relative:
-                        value = self.handle_relative(light, param, value)
-                if value is not None:
-                    cmd[param] = value
-
-            if not cmd or cmd.keys() == {'transitiontime'}:
-                self.opt_parser.error('no action specified')
-            else:
-                self.bridge.set_light(light, cmd)
+    def send_command(self, light, cmd):
+        """Send a command to a light. Return False if the bridge doesn't have
+        the light, else True.
+        """
+        result = self.bridge.set_light(light, cmd)
+        return not any(item['error']['type'] == RESOURCE_NOT_AVAILABLE
+                       for item in result[0]
+                       if isinstance(item, dict) and 'error' in item)
+
+    @staticmethod
+    def get_wait_time(opts):
+        """Return the number of deciseconds to wait for the transition given
+        in the parsed options opts to finish
+        """
+        if opts.transitiontime is None:
+            transition_time = DEFAULT_TRANSITION_TIME
+        else:
+            transition_time = opts.transitiontime
+        return transition_time + TRANSITION_OVERHEAD
+
+    def main(self):
+        if self.opts.daemon:
+            self.serve()
+            return
+        if self.opts.batch_file is not None:
+            self.run_batch()
+            return
+        if self.opts.watch_interval is not None:
+            self.watch()
+            return
+
+        params = self.get_command_params(self.opts)
+        if params.keys() <= {'transitiontime'}:
+            self.opt_parser.error('no action specified')
+
+        # Only settings the bridge can't adjust by itself need the
+        # current state, which is then read for all lights at once
+        states = self.get_light_states() if self.needs_state(params) else None
+        commands, missing, unsupported = self.build_commands(
+            [(None, params, self.lights)], states)
+        missing_lights = len(missing) + len(unsupported)
+        for _, light in missing:
+            self.report_missing_light(light)
+        for _, light, param in unsupported:
+            self.warn_unsupported(light, param)
+
+        for light, cmd in self.merge_commands(
+                (light, cmd) for light, cmd, _ in commands).items():
+            if not self.send_command(light, cmd):
+                self.report_missing_light(light)
+                missing_lights += 1
+
+        if missing_lights == len(self.lights):
+            self.opt_parser.error('no lights available')
 
         if self.opts.wait:
-            if self.opts.transitiontime is None:
-                transition_time = DEFAULT_TRANSITION_TIME
-            else:
-                transition_time = self.opts.transitiontime
-            decisleep(transition_time + TRANSITION_OVERHEAD)
+            decisleep(self.get_wait_time(self.opts))
+
+    def serve(self):
+        """Run the daemon: accept commands from clients on the UNIX socket and
+        carry them out until terminated
+        """
+        path = self.opts.socket_path or default_socket_path()
+        if os.path.exists(path):
+            sock = connect(path)
+            if sock is not None:
+                sock.close()
+                self.opt_parser.error(
+                    'a lightctl daemon is already listening on %s' % path)
+            # Left over from a daemon that didn't exit cleanly
+            os.unlink(path)
+
+        self.bridge.keep_alive = True
+        self.bridge.retries = DAEMON_BRIDGE_RETRIES
+        self.bridge.retry_wait = DAEMON_BRIDGE_RETRY_WAIT
+        self.request_parser = self.make_request_parser()
+
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(
+                path, DaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+        server.requests = queue.Queue()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.log.info('Listening on %s', path)
+
+        try:
+            while True:
+                batch = [server.requests.get()]
+                deadline = clock.monotonic() + COALESCE_WINDOW
+                while True:
+                    remaining = deadline - clock.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(server.requests.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                try:
+                    self.handle_batch(batch)
+                except Exception as e:
+                    # Not tied to any one request; keep serving
+                    for request in batch:
+                        if not request.status:
+                            self.fail_request(request, e)
+                finally:
+                    for request in batch:
+                        request.done.set()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.unlink(path)
+
+    def make_request_parser(self):
+        """Return a NonExitingArgumentParser with the program's options, for
+        commands that don't come from the command line
+        """
+        main_parser = self.opt_parser
+        self.init_arg_parser(NonExitingArgumentParser)
+        request_parser, self.opt_parser = self.opt_parser, main_parser
+        return request_parser
+
+    def parse_request(self, request):
+        """Parse the arguments of a daemon request and return a tuple (opts,
+        params, lights), printing warnings and raising
+        ArgumentParserExit if the command can't be carried out
+        """
+        parser = self.request_parser
+        opts = parser.parse_args(request.args)
+        if opts.daemon:
+            parser.error('a daemon request cannot start another daemon')
+        if any(getattr(opts, dest) is not None for dest in BRIDGE_OPTS):
+            parser.error('bridge options cannot be used with a lightctl daemon')
+        if opts.refresh_inventory and self.bridge.inventory is not None:
+            self.bridge.inventory.invalidate()
+
+        params = self.get_command_params(opts)
+        if params.keys() <= {'transitiontime'}:
+            parser.error('no action specified')
+
+        if opts.lights and self.bridge.inventory is not None:
+            index = self.bridge.get_light_index()
+            if any(self._resolve_light(light, index) is None
+                   for sublist in opts.lights for light in sublist):
+                # The light list may have changed since the daemon
+                # started
+                self.bridge.inventory.invalidate()
+        lights = self.resolve_lights(opts.lights)
+        if not lights:
+            parser.error('no lights available')
+        return opts, params, lights
+
+    def get_light_states(self):
+        """Return a dict mapping light IDs to their current states, fetching
+        them all in one request (or reading them from the state table)
+        unless they were fetched very recently
+        """
+        now = clock.monotonic()
+        if (self.light_states_time is None
+                or now - self.light_states_time > STATE_MAX_AGE):
+            self.light_states = self.bridge.get_light_states()
+            self.light_states_time = now
+        return self.light_states
+
+    def fail_request(self, request, error):
+        """Report to the client of a daemon request an error that kept it
+        from being carried out
+        """
+        if not isinstance(error, BRIDGE_ERRORS):
+            self.log.error('Error handling request %s', request.args,
+                           exc_info=error)
+        request.status = 1
+        request.errors += '%s: error: %s\n' % (self.request_parser.prog, error)
+
+    def handle_batch(self, batch):
+        """Carry out a batch of daemon requests that arrived together, merging
+        their commands for each light. A request that fails is reported
+        to its own client, without affecting the others.
+        """
+        parsed = []
+        for request in batch:
+            output, errors = io.StringIO(), io.StringIO()
+            try:
+                with redirect_stdout(output), redirect_stderr(errors):
+                    parsed.append((request,) + self.parse_request(request))
+            except ArgumentParserExit as e:
+                request.status = e.status
+            except Exception as e:
+                self.fail_request(request, e)
+            request.output += output.getvalue()
+            request.errors += errors.getvalue()
+
+        states = None
+        if any(self.needs_state(params) for _, _, params, _ in parsed):
+            try:
+                states = self.get_light_states()
+            except Exception as e:
+                for request, opts, params, lights in parsed:
+                    if self.needs_state(params):
+                        self.fail_request(request, e)
+                parsed = [entry for entry in parsed
+                          if not self.needs_state(entry[2])]
+
+        commands = []
+        for entry in list(parsed):
+            request, opts, params, lights = entry
+            try:
+                request_commands, missing, unsupported = self.build_commands(
+                    [(request, params, lights)], states)
+            except Exception as e:
+                self.fail_request(request, e)
+                parsed.remove(entry)
+                continue
+            commands.extend(request_commands)
+            errors = io.StringIO()
+            with redirect_stderr(errors):
+                for _, light in missing:
+                    self.warn_no_such_light(light)
+                for _, light, param in unsupported:
+                    self.warn_unsupported(light, param)
+            request.errors += errors.getvalue()
+            request.missing_lights += len(missing) + len(unsupported)
+        light_requests = defaultdict(list)
+        for light, cmd, request in commands:
+            light_requests[light].append(request)
+
+        merged = self.merge_commands(
+            (light, cmd) for light, cmd, request in commands)
+        failed = set()
+        for light, cmd in merged.items():
+            errors = io.StringIO()
+            try:
+                with redirect_stderr(errors):
+                    found = self.send_command(light, cmd)
+                    if not found:
+                        self.report_missing_light(light)
+            except Exception as e:
+                for request in light_requests[light]:
+                    if request not in failed:
+                        failed.add(request)
+                        self.fail_request(request, e)
+                continue
+            for request in light_requests[light]:
+                request.errors += errors.getvalue()
+                if not found:
+                    request.missing_lights += 1
+
+        for request, opts, params, lights in parsed:
+            if request in failed:
+                continue
+            if request.missing_lights == len(lights):
+                errors = io.StringIO()
+                with redirect_stderr(errors):
+                    try:
+                        self.request_parser.error('no lights available')
+                    except ArgumentParserExit as e:
+                        request.status = e.status
+                request.errors += errors.getvalue()
+            elif opts.wait:
+                request.wait = self.get_wait_time(opts) / 10
+
+    @staticmethod
+    def light_snapshot(light_data):
+        """Return a dict mapping each watched attribute of a light to its
+        value, given the light's description from the Hue API
+        """
+        snapshot = dict(light_data.get('state', {}))
+        snapshot['name'] = light_data.get('name')
+        return snapshot
+
+    def watch(self):
+        """Poll the states of all lights every --watch interval and print a
+        line of JSON for each setting of the selected lights that has
+        changed since the previous poll, until terminated
+        """
+        if self.get_command_params(self.opts):
+            self.opt_parser.error('light settings cannot be given with --watch')
+        watched = ({str(light) for light in self.lights} if self.opts.lights
+                   else None)
+        self.bridge.keep_alive = True
+
+        previous = {}
+        for _ in Scheduler().every(self.opts.watch_interval * 10):
+            light_data = self.bridge.get_light()
+            if not isinstance(light_data, dict):
+                # Error response
+                self.log.warning('Bridge error: %s', light_data)
+                continue
+            now = round(clock.time(), 3)
+            snapshots = {light: self.light_snapshot(data)
+                         for light, data in light_data.items()
+                         if watched is None or light in watched}
+
+            lines = []
+            for light in sorted(snapshots, key=int):
+                old_snapshot = previous.get(light, {})
+                for attr, value in sorted(snapshots[light].items()):
+                    old = old_snapshot.get(attr)
+                    if attr not in old_snapshot or value != old:
+                        lines.append((light, attr, value, old))
+            for light in sorted(previous.keys() - snapshots.keys(), key=int):
+                lines.append((light, 'removed', True, None))
+            for light, attr, value, old in lines:
+                print(json.dumps(OrderedDict([
+                    ('time', now), ('light', int(light)), ('attr', attr),
+                    ('value', value), ('old', old)])))
+            sys.stdout.flush()
+            previous = snapshots
+
+    def report_batch_error(self, lineno, message):
+        """Print an error message about a line of the batch file"""
+        name = ('<stdin>' if self.opts.batch_file == '-'
+                else self.opts.batch_file)
+        print('%s: %s:%d: error: %s' % (self.opt_parser.prog, name, lineno,
+                                        message), file=sys.stderr)
+
+    def read_batch_file(self):
+        """Return the list of lines of the --batch file"""
+        try:
+            if self.opts.batch_file == '-':
+                return sys.stdin.readlines()
+            with open(self.opts.batch_file) as f:
+                return f.readlines()
+        except OSError as e:
+            self.opt_parser.error("can't read batch file: %s" % e)
+
+    def parse_batch_line(self, parser, args):
+        """Parse the argument list of a batch file line and return a tuple
+        (opts, params), raising ArgumentParserExit if it is invalid. The
+        command line's transition time is used if the line gives none.
+        """
+        opts = parser.parse_args(args)
+        if opts.daemon or opts.client or opts.batch_file is not None:
+            parser.error('--daemon, --client and --batch cannot be used in a '
+                         'batch file')
+        if (any(getattr(opts, dest) is not None for dest in BRIDGE_OPTS)
+                or opts.refresh_inventory):
+            parser.error('bridge options cannot be used in a batch file')
+        if opts.transitiontime is None:
+            opts.transitiontime = self.opts.transitiontime
+        params = self.get_command_params(opts)
+        if params.keys() <= {'transitiontime'}:
+            parser.error('no action specified')
+        return opts, params
+
+    def send_merged_commands(self, merged):
+        """Send the commands in merged (a mapping of light IDs to commands).
+        A command that is identical for a set of lights is sent once to
+        a group with exactly those lights instead, if there is one and
+        that takes less airtime than sending it to each light (see
+        ExtendedBridge.command_group). If the group refuses it, it is sent
+        to each light after all. Return a list of the lights the bridge
+        turned out not to have.
+        """
+        lights_by_cmd = OrderedDict()
+        for light, cmd in merged.items():
+            key = json.dumps(cmd, sort_keys=True)
+            lights_by_cmd.setdefault(key, (cmd, []))[1].append(light)
+
+        missing = []
+        for cmd, lights in lights_by_cmd.values():
+            group_id = self.bridge.command_group(cmd, lights)
+            if group_id is not None:
+                self.log.info('Sending %s to group %d (lights %s)', cmd,
+                              group_id, ', '.join(str(l) for l in lights))
+                if self.bridge.try_set_group(group_id, cmd):
+                    continue
+            for light in lights:
+                if not self.send_command(light, dict(cmd)):
+                    missing.append(light)
+        return missing
+
+    def run_batch(self):
+        """Carry out the commands in the --batch file. All lines are checked
+        before anything is sent; the commands are then merged for each
+        light and sent at the pace allowed by the airtime budget.
+        """
+        params = self.get_command_params(self.opts)
+        if params.keys() - {'transitiontime'}:
+            self.opt_parser.error('light settings cannot be given with --batch')
+
+        parser = self.make_request_parser()
+        parsed = []
+        num_errors = 0
+        for lineno, line in enumerate(self.read_batch_file(), 1):
+            try:
+                args = shlex.split(line, comments=True)
+            except ValueError as e:
+                self.report_batch_error(lineno, str(e))
+                num_errors += 1
+                continue
+            if not args:
+                continue
+            try:
+                with redirect_stdout(io.StringIO()), \
+                        redirect_stderr(io.StringIO()):
+                    opts, params = self.parse_batch_line(parser, args)
+            except ArgumentParserExit as e:
+                self.report_batch_error(
+                    lineno, e.message or 'help cannot be shown in a batch file')
+                num_errors += 1
+                continue
+            parsed.append((lineno, opts, params))
+
+        # Resolve the lights of all lines from one light list, fetched
+        # again only if the cached one lacks a light that was named or
+        # a name has moved to another light
+        index = self.bridge.get_light_index()
+        light_args = [light for _, opts, _ in parsed if opts.lights
+                      for sublist in opts.lights for light in sublist]
+        if self.bridge.inventory is not None and (
+                any(self._resolve_light(light, index) is None
+                    for light in light_args)
+                or not self.bridge.check_light_names(
+                    [light for light in light_args
+                     if not isinstance(light, int)], index)):
+            index = self.bridge.get_light_index(refresh=True)
+        entries = []
+        for lineno, opts, params in parsed:
+            lights = (self.resolve_lights(opts.lights, index) if opts.lights
+                      else self.lights)
+            if not lights:
+                self.report_batch_error(lineno, 'no lights available')
+                num_errors += 1
+            entries.append((lineno, params, lights))
+
+        if num_errors:
+            self.opt_parser.exit(2, '%s: %d errors in batch file; nothing sent\n'
+                                 % (self.opt_parser.prog, num_errors))
+        if not entries:
+            return
+
+        states = None
+        if any(self.needs_state(params) for _, params, _ in entries):
+            states = self.get_light_states()
+        commands, missing, unsupported = self.build_commands(entries, states)
+        for lineno, light in missing:
+            self.report_missing_light(light)
+        for lineno, light, param in unsupported:
+            self.warn_unsupported(light, param)
+        merged = self.merge_commands(
+            (light, cmd) for light, cmd, lineno in commands)
+        self.log.info('%d lines merged into commands for %d lights',
+                      len(entries), len(merged))
+        for light in self.send_merged_commands(merged):
+            self.report_missing_light(light)
+
+        wait_times = [self.get_wait_time(opts) for _, opts, _ in parsed
+                      if opts.wait or self.opts.wait]
+        if wait_times:
+            decisleep(max(wait_times))
 
 
 def main():
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Entry point of lightctl. With --client, the command line is handed to a
+running "lightctl --daemon" over its UNIX socket without loading the
+rest of the program or connecting to the bridge; otherwise, or if no
+daemon is listening, lightctl is run normally.
+
+Protocol: the client sends one line of JSON, {"args": [<arguments>]},
+and the daemon answers with one line of JSON holding the exit status,
+the text to print to stdout and stderr, and the number of seconds to
+wait afterward (for -w/--wait):
+
+    {"status": 0, "output": "", "errors": "", "wait": 0}
+
+Keep this module's imports to the few standard library modules it
+needs, as its startup time is the point.
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+
+SOCKET_NAME = 'hue_toys_lightctl.sock'
+
+
+def default_socket_path():
+    """Return the path of the daemon socket to use if none is given: in
+    $XDG_RUNTIME_DIR if set, or else a per-user name in /tmp
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    return '/tmp/hue_toys_lightctl-%d.sock' % os.getuid()
+
+
+def socket_path_arg(args):
+    """Return the value of the --socket option in argument list args, or
+    None if it isn't given
+    """
+    path = None
+    for i, arg in enumerate(args):
+        if arg == '--socket' and i + 1 < len(args):
+            path = args[i + 1]
+        elif arg.startswith('--socket='):
+            path = arg[len('--socket='):]
+    return path
+
+
+def connect(path):
+    """Return a socket connected to the daemon listening at path, or None if
+    there isn't one
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(args, path):
+    """Have the daemon at socket path run lightctl with argument list args,
+    print its output and return its exit status, or return None if no
+    daemon is listening
+    """
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock:
+        sock.sendall(json.dumps({'args': args}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        print('%s: error: lightctl daemon closed the connection'
+              % sys.argv[0], file=sys.stderr)
+        return 1
+    reply = json.loads(line.decode('utf-8'))
+    sys.stdout.write(reply['output'])
+    sys.stderr.write(reply['errors'])
+    if reply['wait']:
+        time.sleep(reply['wait'])
+    return reply['status']
+
+
+def main():
+    args = sys.argv[1:]
+    if '--client' in args and '--daemon' not in args:
+        status = forward(args, socket_path_arg(args) or default_socket_path())
+        if status is not None:
+            sys.exit(status)
+
+    from hue_toys.lightctl import main as lightctl_main
+    lightctl_main()
+
+
+if __name__ == '__main__':
+    main()
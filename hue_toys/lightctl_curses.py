@@ -15,21 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from collections import OrderedDict
 import curses
 import logging
 import threading
-from time import sleep, time
 import queue
 
 from hue_toys.base import BaseProgram, default_run
 from hue_toys.phue_helper import MIN, MAX, WIDTH, tungsten_cct, iconv_ct
 
 
-MIN_BRIDGE_CMD_INTERVAL = .4
-"""Minimum allowed time in seconds between light commands sent to Hue bridge"""
-
-
 # Display layout:
 #  0         1         2         3         4         5        6
 #  012345678901234567890123456789012345678901234567890123456790
@@ -372,37 +367,46 @@ class BridgeUpdateThread(threading.Thread):
         self.bridge_lock = bridge_lock
         self.queue = light_update_queue
 
-        self.__pending_cmds = defaultdict(dict)
+        self.__pending_cmds = OrderedDict()
+
+    def __next_delay(self):
+        """Return the number of seconds until the oldest pending command fits
+        within the bridge's airtime budget, or None if there are no
+        pending commands
+        """
+        if not self.__pending_cmds:
+            return None
+        cmd = next(iter(self.__pending_cmds.values()))
+        return self.bridge.airtime_delay(cmd)
 
     def __update_bridge(self):
-        """Send a pending command to the bridge, if one is available. Return
-        True if there was a command to process, False otherwise.
+        """Send the oldest pending command to the bridge, if one is
+        available. Return True if there was a command to process, False
+        otherwise.
         """
         try:
-            light_id, cmd = self.__pending_cmds.popitem()
+            light_id, cmd = self.__pending_cmds.popitem(last=False)
         except KeyError:
             return False
-        else:
-            with self.bridge_lock:
-                self.bridge.set_light(light_id, cmd)
-            return True
+        with self.bridge_lock:
+            self.bridge.set_light(light_id, cmd)
+        return True
 
     def run(self):
         """Start processing. Collect commands from event queue in the form
-        (light_id, parameter, value) as they come in, rolling the
-        updates into bridge update commands at the proper interval. A
-        queue item of None signals the thread to shut down once all
-        pending items sent before None have been processed.
+        (light_id, parameter, value) as they come in, merging the
+        updates for each light into bridge update commands that are
+        sent as the bridge's airtime budget allows. A queue item of None
+        signals the thread to shut down once all pending items sent
+        before None have been processed.
         """
-        cmd_interval = MIN_BRIDGE_CMD_INTERVAL
-        last_update_time = 0
         while True:
-            if time() - last_update_time >= cmd_interval:
-                if self.__update_bridge():
-                    last_update_time = time()
+            wait_time = self.__next_delay()
+            if wait_time == 0:
+                self.__update_bridge()
+                continue
 
             # Wait for event until next bridge update is due
-            wait_time = cmd_interval - ((time() - last_update_time) % cmd_interval)
             try:
                 event = self.queue.get(timeout=wait_time)
             except queue.Empty:
@@ -411,12 +415,12 @@ class BridgeUpdateThread(threading.Thread):
                 if event is None:
                     break
                 light_id, param, value = event
-                self.__pending_cmds[light_id][param] = value
+                self.__pending_cmds.setdefault(light_id, {})[param] = value
                 self.queue.task_done()
 
         # Shutdown time, flush remaining bridge updates and quit
         while self.__update_bridge():
-            sleep(cmd_interval)
+            pass
 
 
 
@@ -0,0 +1,302 @@
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Control of lights spread over several Hue bridges as if they were on
+one
+
+A single bridge can handle only so many lights and commands per second,
+so a large installation may be split among several. A MultiBridge wraps
+an ExtendedBridge for each of them and routes each call to the bridges
+of the lights involved. Lights are identified by BridgeLight objects,
+written as "BRIDGE:ID". Each bridge gets its own worker thread, so
+commands to different bridges are sent concurrently, each at the pace of
+its own bridge's airtime budget.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import re
+
+from hue_toys.phue_helper import ExtendedBridge
+
+_LIGHT_ADDRESS_RE = re.compile(r'^lights/(.+):(\d+)(/.*)?$')
+
+
+@functools.total_ordering
+class BridgeLight(int):
+    """ID of a light on one of several bridges. It acts as the light's ID on
+    its own bridge when used as an int, but compares, hashes and is
+    converted to a string together with the bridge's name, as
+    "BRIDGE:ID".
+    """
+
+    def __new__(cls, bridge_name, light_id):
+        self = int.__new__(cls, light_id)
+        self.bridge_name = bridge_name
+        return self
+
+    def _key(self):
+        return (self.bridge_name, int(self))
+
+    def __str__(self):
+        return '%s:%d' % self._key()
+
+    def __repr__(self):
+        return 'BridgeLight(%r, %d)' % self._key()
+
+    def __eq__(self, other):
+        # Never equal to a plain light ID, which doesn't say which
+        # bridge it is on
+        return isinstance(other, BridgeLight) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        if not isinstance(other, BridgeLight):
+            return NotImplemented
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+class MultiBridge:
+    """Stand-in for an ExtendedBridge that controls the lights of several
+    bridges, given as an OrderedDict mapping bridge names to
+    ExtendedBridge objects. The light IDs it takes and returns are
+    BridgeLight objects. Only the methods that effect programs use are
+    provided.
+    """
+
+    inventory = None
+
+    normalized_light_state = staticmethod(ExtendedBridge.normalized_light_state)
+
+    def __init__(self, bridges):
+        self.bridges = bridges
+        self.workers = {name: ThreadPoolExecutor(max_workers=1)
+                        for name in bridges}
+
+    @property
+    def keep_alive(self):
+        return all(bridge.keep_alive for bridge in self.bridges.values())
+
+    @keep_alive.setter
+    def keep_alive(self, value):
+        for bridge in self.bridges.values():
+            bridge.keep_alive = value
+
+    def _run(self, calls):
+        """Make calls, an OrderedDict mapping bridge names to functions taking
+        no arguments, on their bridges' worker threads at the same time,
+        and return an OrderedDict of their results
+        """
+        if len(calls) == 1:
+            # Not worth a thread switch
+            name, call = next(iter(calls.items()))
+            return OrderedDict([(name, call())])
+        futures = OrderedDict((name, self.workers[name].submit(call))
+                              for name, call in calls.items())
+        return OrderedDict((name, future.result())
+                           for name, future in futures.items())
+
+    @staticmethod
+    def _by_bridge(light_ids):
+        """Return an OrderedDict mapping bridge names to lists of the IDs on
+        that bridge of the given light or sequence of lights
+        """
+        if isinstance(light_ids, BridgeLight):
+            light_ids = [light_ids]
+        split = OrderedDict()
+        for light in light_ids:
+            split.setdefault(light.bridge_name, []).append(int(light))
+        return split
+
+    def __getitem__(self, light):
+        return self.bridges[light.bridge_name][int(light)]
+
+    def get_light_index(self, refresh=False):
+        """Return a dict mapping light names to their BridgeLights. Names are
+        included both qualified with their bridge names ("BRIDGE:NAME")
+        and, where they are unique among the bridges, alone. The
+        qualified IDs ("BRIDGE:ID") are included as well.
+        """
+        indexes = self._run(OrderedDict(
+            (name, functools.partial(bridge.get_light_index, refresh))
+            for name, bridge in self.bridges.items()))
+        return self._merge_indexes(indexes)
+
+    def cached_light_index(self):
+        """Return the light index (see get_light_index) from the bridges'
+        light inventory caches, or None if any of them isn't available
+        """
+        indexes = OrderedDict((name, bridge.cached_light_index())
+                              for name, bridge in self.bridges.items())
+        if any(index is None for index in indexes.values()):
+            return None
+        return self._merge_indexes(indexes)
+
+    @staticmethod
+    def _merge_indexes(indexes):
+        merged = {}
+        name_counts = {}
+        for index in indexes.values():
+            for light_name in index:
+                name_counts[light_name] = name_counts.get(light_name, 0) + 1
+        for bridge_name, index in indexes.items():
+            for light_name, light_id in index.items():
+                light = BridgeLight(bridge_name, int(light_id))
+                merged['%s:%s' % (bridge_name, light_name)] = light
+                merged[str(light)] = light
+                if name_counts[light_name] == 1:
+                    merged[light_name] = light
+        return merged
+
+    def light_info(self, light_id):
+        return self.bridges[light_id.bridge_name].light_info(int(light_id))
+
+    def get_light(self, light_id=None, parameter=None):
+        """Return the result of get_light from the light's bridge, or if no
+        light is given, the descriptions of all lights of all bridges,
+        keyed by their "BRIDGE:ID" strings
+        """
+        if light_id is not None:
+            return self.bridges[light_id.bridge_name].get_light(
+                int(light_id), parameter)
+        results = self._run(OrderedDict(
+            (name, bridge.get_light) for name, bridge in self.bridges.items()))
+        light_data = {}
+        for name, lights in results.items():
+            if not isinstance(lights, dict):
+                # Error response
+                continue
+            for light_id, data in lights.items():
+                light_data[str(BridgeLight(name, int(light_id)))] = data
+        return light_data
+
+    def api(self, address, body=None, method=None):
+        """Make a direct call to the Hue API of the bridge of the light in
+        address, which must start with "lights/BRIDGE:ID"
+        """
+        match = _LIGHT_ADDRESS_RE.match(address)
+        if match is None or match.group(1) not in self.bridges:
+            raise ValueError('address does not name a light on one of the '
+                             'bridges: %s' % address)
+        bridge_name, light_id, rest = match.groups()
+        return self.bridges[bridge_name].api(
+            'lights/%s%s' % (light_id, rest or ''), body, method)
+
+    def _set_lights(self, method_name, light_id, parameter, value=None,
+                    **kwargs):
+        calls = OrderedDict()
+        for name, light_ids in self._by_bridge(light_id).items():
+            # Each bridge translates its own copy of the parameters
+            bridge_parameter = (dict(parameter) if isinstance(parameter, dict)
+                                else parameter)
+            calls[name] = functools.partial(
+                getattr(self.bridges[name], method_name), light_ids,
+                bridge_parameter, value, **kwargs)
+        return [result for results in self._run(calls).values()
+                for result in results]
+
+    def set_light(self, light_id, parameter, value=None, transitiontime=None):
+        return self._set_lights('set_light', light_id, parameter, value,
+                                transitiontime=transitiontime)
+
+    def set_light_optimized(self, light_id, parameter, value=None,
+                            transitiontime=None, clear_cache=False):
+        return self._set_lights('set_light_optimized', light_id, parameter,
+                                value, transitiontime=transitiontime,
+                                clear_cache=clear_cache)
+
+    def light_latency(self, light_ids):
+        return max([self.bridges[name].light_latency(bridge_light_ids)
+                    for name, bridge_light_ids
+                    in self._by_bridge(light_ids).items()] or [0])
+
+    def frame_dispatch_time(self, light_ids, max_connections=1):
+        return max([self.bridges[name].frame_dispatch_time(
+                        bridge_light_ids, max_connections)
+                    for name, bridge_light_ids
+                    in self._by_bridge(light_ids).items()] or [0])
+
+    def _send_frames(self, commands, send):
+        """Split a frame of commands by bridge and call send(bridge, frame)
+        with each bridge's part, all at the same time. Return a list of
+        the result of each command.
+        """
+        frames = OrderedDict()
+        for i, (light, params) in enumerate(commands):
+            frames.setdefault(light.bridge_name, []).append(
+                (i, int(light), params))
+        calls = OrderedDict(
+            (name, functools.partial(
+                send, self.bridges[name],
+                [(light, params) for _, light, params in frame]))
+            for name, frame in frames.items())
+        results = [None] * len(commands)
+        for name, frame_results in self._run(calls).items():
+            for (i, _, _), result in zip(frames[name], frame_results):
+                results[i] = result
+        return results
+
+    def send_frame(self, commands, optimized=False, max_connections=1):
+        """Send a frame of commands (see ExtendedBridge.send_frame), to all
+        bridges at the same time, using up to max_connections
+        connections to each. Return a list of the result of each
+        command.
+        """
+        return self._send_frames(
+            commands, lambda bridge, frame: bridge.send_frame(
+                frame, optimized, max_connections))
+
+    def send_frame_at(self, deadline, commands, optimized=False,
+                      max_connections=1, smoothing=0):
+        """Send a frame of commands timed to take effect at deadline (see
+        ExtendedBridge.send_frame_at), each bridge timing its own
+        """
+        return self._send_frames(
+            commands, lambda bridge, frame: bridge.send_frame_at(
+                deadline, frame, optimized, max_connections, smoothing))
+
+    def collect_light_states(self, light_ids, state=None,
+                             include_default_state=True):
+        if state is None:
+            state = {}
+        calls = OrderedDict()
+        for name, bridge_light_ids in self._by_bridge(light_ids).items():
+            bridge_state = {int(light): light_state
+                            for light, light_state in state.items()
+                            if light.bridge_name == name}
+            calls[name] = functools.partial(
+                self.bridges[name].collect_light_states, bridge_light_ids,
+                bridge_state, include_default_state)
+        for name, bridge_state in self._run(calls).items():
+            for light_id, light_state in bridge_state.items():
+                state[BridgeLight(name, light_id)] = light_state
+        return state
+
+    def restore_light_states(self, light_ids, state, transitiontime=4):
+        calls = OrderedDict()
+        for name, bridge_light_ids in self._by_bridge(light_ids).items():
+            bridge_state = {int(light): light_state
+                            for light, light_state in state.items()
+                            if light.bridge_name == name}
+            calls[name] = functools.partial(
+                self.bridges[name].restore_light_states, bridge_light_ids,
+                bridge_state, transitiontime)
+        self._run(calls)
@@ -17,13 +17,23 @@
 from https://github.com/studioimaginaire/phue
 """
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+import copy
+import http.client
+import itertools
+import json
 import logging
+import os
 import random
+import re
+import socket
+import threading
 import time
 
 # https://github.com/studioimaginaire/phue
-from phue import Bridge, is_string, PhueRequestTimeout
+from phue import (
+    Bridge, Light, is_string, PhueException, PhueRegistrationException,
+    PhueRequestTimeout)
 
 
 MIN = {'bri': 1, 'hue': 0, 'sat': 0, 'xy': 0.0, 'ct': 153, 'ctk': 2000,
@@ -45,13 +55,83 @@ DEFAULT_TRANSITION_TIME = 4
 not specified
 """
 
+DEFAULT_SIMULATED_LIGHTS = 8
+"""Default number of lights provided by a SimulatedBridge"""
+
+BRIDGE_REQUEST_TIMEOUT = 10
+"""Seconds to wait for the bridge to respond to a request"""
+
 DEFAULT_BRIDGE_RETRIES = 8640
 DEFAULT_BRIDGE_RETRY_WAIT = 10
 """Default values of 'retries' and 'retry_wait' arguments to
 ExtendedBridge.__init__"""
 
+SETTINGS_KEY = 'hue_toys'
+"""Key of the entry holding hue_toys' own settings within a bridge's
+entry in the phue config file"""
+
+ZIGBEE_FRAME_TIME = .004
+"""Rough radio airtime in seconds taken by one ZigBee command frame,
+including the bridge's retransmissions and the light's acknowledgment"""
+
+GROUP_AIRTIME_FACTOR = 8
+"""How many times more airtime a group command takes than the same
+command sent to one light, as broadcasts are repeated by every router
+in the mesh"""
+
+CONFIG_FRAMES = 6
+"""Number of frames estimated for a light config write (such as the
+startup settings), which the bridge performs as several attribute
+writes and reads"""
+
+DEFAULT_AIRTIME_BUDGET = .08
+"""Default seconds of estimated airtime per second that commands may
+use, if the bridge's maximum command rate hasn't been measured with
+bridge_stress"""
+
+DEFAULT_LIGHT_LATENCY = .05
+"""Seconds assumed for the latency of a light's commands until it has
+been measured"""
+
+LATENCY_SMOOTHING = .2
+"""Weight given to each new measurement in the running estimate of a
+light's command latency"""
+
+ADAPTIVE_MAX_LOAD = .8
+ADAPTIVE_MIN_LOAD = .5
+"""Fractions of a cycle spent waiting on the bridge above which an
+AdaptiveCycle is lengthened, and below which it may be shortened"""
+
+ADAPTIVE_LENGTHEN_FACTOR = 1.25
+ADAPTIVE_SHORTEN_FACTOR = .9
+"""Factors an AdaptiveCycle's cycle time is multiplied by when it is
+lengthened or shortened"""
+
+ADAPTIVE_CALM_CYCLES = 5
+ADAPTIVE_MAX_BACKOFF = 16
+"""Number of cycles in a row with room to spare after which an
+AdaptiveCycle is shortened, and the most that number is multiplied by
+as shortening it keeps overloading the bridge"""
+
+BRIDGE_BUSY_ERROR = 901
+"""Hue API error type returned when the bridge is too busy"""
+
 logger = logging.getLogger(__name__)
 
+_COMMAND_ADDRESS_RE = re.compile(r'^/api/[^/]+/(lights|groups)/(\d+)/(?:state|action)$')
+"""Matches API addresses of light state and group action commands"""
+
+_AIRTIME_ADDRESS_RE = re.compile(r'^/api/[^/]+/(lights|groups)/\d+/(state|action|config)$')
+"""Matches API addresses of commands that cause radio traffic"""
+
+# Parameters sent in the same frame: on/off and brightness are combined
+# into one level command, and any color parameters into one color
+# command
+_LEVEL_PARAMS = {'on', 'bri', 'bri_inc', 'inc'}
+_COLOR_PARAMS = {'hue', 'sat', 'xy', 'ct', 'hue_inc', 'sat_inc', 'xy_inc',
+                 'ct_inc', 'ctk', 'inc'}
+_OTHER_FRAME_PARAMS = {'alert', 'effect', 'scene'}
+
 
 def kelvin_to_xy(kelvin):
     """Return an approximate CIE [x,y] color value for the given kelvin
@@ -98,22 +178,333 @@ def iconv_ct(color_temp):
     return int(conv_ct(color_temp))
 
 
+class Clock:
+    """The source of time used by the effects and the bridge layer. By
+    default it follows the real clocks, but it can be switched into a
+    time-warp mode (see warp()) in which simulated time passes faster
+    than real time, or jumps straight to the next deadline that a
+    sleeping thread is waiting for.
+
+    monotonic() and time() correspond to time.monotonic() and
+    time.time(), respectively.
+    """
+
+    JUMP = float('inf')
+    """Time-warp rate that makes simulated time jump to the next deadline"""
+
+    JUMP_SETTLE_TIME = .01
+    """Real time in seconds to wait, in JUMP mode, for other threads that
+    have not yet slept on the clock to catch up before jumping ahead
+    """
+
+    def __init__(self):
+        self.rate = None
+        self._cond = threading.Condition()
+        self._sleepers = {}
+
+    def warp(self, rate):
+        """Make simulated time pass 'rate' times as fast as real time from now
+        on, or, if rate is Clock.JUMP, advance only when every thread is
+        sleeping on this clock, and then straight to the earliest
+        deadline. (In JUMP mode, threads that are running or blocked on
+        anything else, such as idle worker threads, are only given
+        JUMP_SETTLE_TIME to sleep on this clock before time jumps, so
+        timelines are only guaranteed to be exact for effects whose
+        timing is driven by a single thread.)
+        """
+        with self._cond:
+            virtual_now, wall_now = self.monotonic(), self.time()
+            self._real_base = time.monotonic()
+            self._virtual_base = self._now = virtual_now
+            self._wall_base = wall_now
+            self.rate = rate
+            self._cond.notify_all()
+
+    def monotonic(self):
+        if self.rate is None:
+            return time.monotonic()
+        if self.rate == self.JUMP:
+            return self._now
+        return (self._virtual_base
+                + (time.monotonic() - self._real_base) * self.rate)
+
+    def time(self):
+        if self.rate is None:
+            return time.time()
+        return self._wall_base + (self.monotonic() - self._virtual_base)
+
+    def localtime(self):
+        """Return the current local time as a time.struct_time"""
+        return time.localtime(self.time())
+
+    def sleep_until(self, deadline):
+        """Sleep until the monotonic() clock reaches deadline. In real time,
+        the remaining time is recomputed from the absolute deadline
+        whenever the sleep is interrupted, so time spent suspended
+        (e.g., by SIGSTOP) counts toward the sleep, and the call returns
+        as soon as possible after SIGCONT if the deadline passed in the
+        meantime. Normally, only a single wakeup is needed.
+        """
+        if self.rate == self.JUMP:
+            self._jump_until(deadline)
+            return
+        while True:
+            remaining = deadline - self.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining / (self.rate or 1))
+
+    def sleep(self, seconds):
+        self.sleep_until(self.monotonic() + seconds)
+
+    def _jump_until(self, deadline):
+        thread = threading.current_thread()
+        with self._cond:
+            self._sleepers[thread] = deadline
+            self._last_change = time.monotonic()
+            try:
+                while self._now < deadline:
+                    # Only threads parked here are counted, as a thread
+                    # that once slept on the clock may since have gone
+                    # idle elsewhere (in a thread pool, for instance)
+                    settling = (
+                        threading.active_count() > len(self._sleepers)
+                        and time.monotonic() - self._last_change < self.JUMP_SETTLE_TIME)
+                    if not settling:
+                        next_deadline = min(self._sleepers.values())
+                        if next_deadline > self._now:
+                            self._now = next_deadline
+                            self._cond.notify_all()
+                            continue
+                    # Let threads that are due wake up, and poll so that
+                    # threads that exit without sleeping again are
+                    # noticed
+                    self._cond.wait(self.JUMP_SETTLE_TIME)
+            finally:
+                del self._sleepers[thread]
+                self._last_change = time.monotonic()
+
+
+clock = Clock()
+"""The Clock used by all time-dependent code in this package"""
+
+
+def sleep_until(deadline):
+    """Sleep until the clock.monotonic() clock reaches deadline (see
+    Clock.sleep_until)
+    """
+    clock.sleep_until(deadline)
+
+
 def decisleep(deciseconds):
     """Sleep for the given number of deciseconds (seconds/10) using a
     monotonic clock source unaffected by process suspension (e.g.,
-    SIGSTOP). time.sleep() (in CPython, at least) would sleep for the
+    SIGSTOP). time.sleep() (in CPython, at least) may sleep for the
     given time *plus* the total time the process spent suspended. This
     routine instead counts the time suspended toward the sleep interval,
     so that if the process is suspended briefly and then resumed, it
     will still sleep for close to the expected real time (or resume
     immediately upon receiving SIGCONT, if it remained suspended past
-    the time the sleep was due to end). Sleep precision is within 0.1
-    second.
+    the time the sleep was due to end).
+    """
+    clock.sleep(deciseconds/10)
+
+
+def command_airtime(params, group=False, config=False):
+    """Estimate and return the radio airtime in seconds taken by a command
+    with the given parameter dict. group should be true if it is a group
+    action command, and config if it is a light config command.
+    Extended parameters understood by ExtendedBridge.set_light are
+    accepted.
+    """
+    if config:
+        frames = CONFIG_FRAMES
+    else:
+        keys = set(params)
+        frames = (bool(keys & _LEVEL_PARAMS) + bool(keys & _COLOR_PARAMS)
+                  + len(keys & _OTHER_FRAME_PARAMS))
+    airtime = frames * ZIGBEE_FRAME_TIME
+    if group:
+        airtime *= GROUP_AIRTIME_FACTOR
+    return airtime
+
+
+def merge_timeline(commands):
+    """Return the timeline of the commands in a sequence of (time, light_id,
+    params) triples: a list of (time, params, light_ids) triples in
+    order of time, in which the commands with the same time and the same
+    parameter dict are merged into one for all of their lights
+    """
+    merged = OrderedDict()
+    for time_, light, params in commands:
+        key = (time_, json.dumps(params, sort_keys=True))
+        merged.setdefault(key, (time_, params, []))[2].append(light)
+    return sorted(merged.values(), key=lambda command: command[0])
+
+
+class AirtimeBudget:
+    """Token bucket limiting the estimated radio airtime used by commands
+    to 'budget' seconds per second. Up to one second's worth may be used
+    in a burst. Safe to share among threads.
     """
-    start_time = time.monotonic()
-    end_time = start_time + deciseconds/10
-    while time.monotonic() < end_time:
-        time.sleep(.05)
+
+    def __init__(self, budget=DEFAULT_AIRTIME_BUDGET):
+        self.budget = budget
+        self.available = budget
+        self.last_update = clock.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = clock.monotonic()
+        self.available = min(
+            self.budget,
+            self.available + (now - self.last_update) * self.budget)
+        self.last_update = now
+
+    def delay(self, airtime):
+        """Return the number of seconds to wait before a command taking
+        airtime seconds would fit within the budget
+        """
+        with self.lock:
+            self._refill()
+            return max(0, (min(airtime, self.budget) - self.available)
+                       / self.budget)
+
+    def acquire(self, airtime):
+        """Use airtime seconds of the budget, first sleeping for as long as
+        needed to stay within it. Callers are served in order.
+        """
+        with self.lock:
+            self._refill()
+            wait = max(0, (min(airtime, self.budget) - self.available)
+                       / self.budget)
+            self.available -= airtime
+        if wait:
+            clock.sleep(wait)
+
+
+class Scheduler:
+    """Pace a loop on absolute clock.monotonic() deadlines, so that time spent
+    sending commands between waits is absorbed into the period instead
+    of adding to it.
+
+    Example (send a frame every 10 deciseconds):
+
+        for _ in Scheduler().every(10):
+            send_frame()
+
+    If a deadline has already passed by the time it is waited for (the
+    loop body took longer than the period, for instance because the
+    bridge was slow to respond), the schedule is resynced to the
+    current time rather than sending a burst of late frames to catch
+    up. Any overrun resyncs it, however small.
+    """
+
+    def __init__(self):
+        self.deadline = clock.monotonic()
+
+    def reset(self):
+        """Restart the schedule from the current time"""
+        self.deadline = clock.monotonic()
+
+    def wait(self, deciseconds):
+        """Advance the deadline by the given number of deciseconds past the
+        previous one (or to the current time, if that is already later)
+        and sleep until it is reached
+        """
+        self.deadline += deciseconds/10
+        now = clock.monotonic()
+        if self.deadline < now:
+            logger.debug('Scheduler overrun by %.3fs; resyncing',
+                         now - self.deadline)
+            self.deadline = now
+        sleep_until(self.deadline)
+
+    def every(self, deciseconds):
+        """Return an iterator that yields immediately, then once every
+        'deciseconds' tenths of a second thereafter
+        """
+        self.reset()
+        while True:
+            yield
+            self.wait(deciseconds)
+
+
+class AdaptiveCycle:
+    """Cycle time of an effect loop that follows the load on the bridge,
+    starting from min_cycle_time deciseconds. Each command sent during
+    a cycle is reported with record. At the end of each cycle,
+    end_cycle lengthens the cycle time if waiting for the bridge took
+    up too much of the cycle or the bridge reported being busy, and
+    shortens it again (never below min_cycle_time) once it has kept up
+    with room to spare for a while.
+    """
+
+    def __init__(self, min_cycle_time):
+        self.min_cycle_time = min_cycle_time
+        self.cycle_time = min_cycle_time
+        self.calm_cycles = 0
+        self.calm_cycles_needed = ADAPTIVE_CALM_CYCLES
+        self.last_change = None
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self.busy_time = 0.0
+        self.commands = 0
+        self.errors = 0
+
+    def record(self, seconds, results):
+        """Count the commands whose results (as returned by
+        ExtendedBridge.send_frame) are given and that took the given
+        number of seconds to send
+        """
+        self.busy_time += seconds
+        self.commands += len(results)
+        self.errors += sum(
+            1 for result in results if isinstance(result, list)
+            for item in result
+            if isinstance(item, dict)
+            and item.get('error', {}).get('type') == BRIDGE_BUSY_ERROR)
+
+    def end_cycle(self):
+        """Adjust the cycle time for the load measured during the cycle just
+        finished, and return it
+        """
+        # A cycle time of 0 means as fast as possible; rate it as if it
+        # were one decisecond, the least a nonzero one can be
+        load = self.busy_time / (max(self.cycle_time, 1) / 10)
+        old_cycle_time = self.cycle_time
+        if self.errors or load > ADAPTIVE_MAX_LOAD:
+            # If shortening the cycle overloaded the bridge again, wait
+            # longer before trying it next time, so as not to keep
+            # swinging back and forth around the bridge's limit
+            if self.last_change == 'shorten':
+                self.calm_cycles_needed = min(
+                    self.calm_cycles_needed * 2,
+                    ADAPTIVE_CALM_CYCLES * ADAPTIVE_MAX_BACKOFF)
+            self.cycle_time = max(self.cycle_time * ADAPTIVE_LENGTHEN_FACTOR,
+                                  self.cycle_time + 1)
+            self.last_change = 'lengthen'
+            self.calm_cycles = 0
+        elif load < ADAPTIVE_MIN_LOAD and self.cycle_time > self.min_cycle_time:
+            self.calm_cycles += 1
+            if self.calm_cycles >= self.calm_cycles_needed:
+                self.cycle_time = max(
+                    self.cycle_time * ADAPTIVE_SHORTEN_FACTOR,
+                    self.min_cycle_time)
+                self.last_change = 'shorten'
+                self.calm_cycles = 0
+        else:
+            self.calm_cycles = 0
+
+        if self.cycle_time != old_cycle_time:
+            logger.info(
+                'Cycle time %.2fs -> %.2fs (load %d%%, %d busy errors); '
+                'now %.1f commands/s',
+                old_cycle_time / 10, self.cycle_time / 10, load * 100,
+                self.errors, self.commands / max(self.cycle_time / 10, .1))
+        self._reset_counts()
+        return self.cycle_time
 
 
 def random_hue():
@@ -305,10 +696,44 @@ class ExtendedBridge(Bridge):
 
     retry_wait: Number of seconds to wait between retries if bridge
     connection error occurs
+
+    recorder: Object (such as a command_log.CommandLogWriter) whose
+    record_light and record_group methods will be passed the ID and
+    parameters of every light state and group action command sent to
+    the bridge, or None
+
+    airtime_budget: AirtimeBudget that commands are paced by, according
+    to their estimated radio airtime, or None to send them right away
+
+    inventory: inventory.Inventory caching the bridge's light list, or
+    None to always fetch it from the bridge
+
+    keep_alive: If true, reuse HTTP connections to the bridge instead of
+    opening a new one for each request (useful for long-running
+    programs that need quick responses). One connection is kept for
+    each request that has been in flight at the same time.
+
+    The time each light state command takes to be acknowledged by the
+    bridge is measured, and a running estimate of each light's latency
+    is kept for send_frame_at.
+
+    state_table: state_table.StateTableReader to take the states of
+    lights from while it is up to date instead of requesting them, or
+    None to always request them
     """
     def __init__(self, *args, **kwargs):
         self.retries = kwargs.pop('retries', DEFAULT_BRIDGE_RETRIES)
         self.retry_wait = kwargs.pop('retry_wait', DEFAULT_BRIDGE_RETRY_WAIT)
+        self.recorder = kwargs.pop('recorder', None)
+        self.airtime_budget = kwargs.pop('airtime_budget', None)
+        self.inventory = kwargs.pop('inventory', None)
+        self.keep_alive = kwargs.pop('keep_alive', False)
+        self.state_table = kwargs.pop('state_table', None)
+        self._idle_connections = []
+        self._connection_lock = threading.Lock()
+        self._frame_executor = None     # (executor, max_workers)
+        self._light_latency = {}
+        self._group_members = None
         Bridge.__init__(self, *args, **kwargs)
 
         self._cached_light_state = defaultdict(dict)
@@ -323,6 +748,258 @@ class ExtendedBridge(Bridge):
         else:
             return True
 
+    def _index_lights(self, lights):
+        """Fill phue's light object caches from dict lights, mapping light ID
+        strings to dicts with at least a 'name' item, and return a dict
+        mapping each light's name to its ID
+        """
+        self.lights_by_id.clear()
+        self.lights_by_name.clear()
+        for light_id, data in lights.items():
+            light = Light(self, int(light_id))
+            self.lights_by_id[int(light_id)] = light
+            self.lights_by_name[data['name']] = light
+        return {name: light.light_id
+                for name, light in self.lights_by_name.items()}
+
+    def cached_light_index(self):
+        """Return a dict mapping each light's name to its ID from the light
+        inventory cache without making any request, or None if there is
+        no up-to-date cached light list
+        """
+        if self.inventory is None or self.inventory.lights is None:
+            return None
+        return self._index_lights(self.inventory.lights)
+
+    def get_light_index(self, refresh=False):
+        """Return a dict mapping each light's name to its ID, taken from the
+        light inventory cache if it is up to date, or else fetched in a
+        single request. phue's light object caches (used for indexing
+        the bridge and by get_light_objects) are filled in from the
+        same list. If refresh is true, a light list that was loaded from
+        the cache file is fetched again.
+        """
+        if self.inventory is not None and self.inventory.lights is not None:
+            if not (refresh and self.inventory.from_file):
+                return self._index_lights(self.inventory.lights)
+        lights = Bridge.get_light(self)
+        if self.inventory is not None:
+            self.inventory.update(lights)
+        return self._index_lights(lights)
+
+    def check_light_names(self, names, index):
+        """Check that each light named in the sequence names still has the ID
+        it has in index (a name-to-ID index taken from the light
+        inventory), if that was loaded from the cache file, fetching the
+        description of each light not yet checked during this session.
+        Return False, discarding the inventory, if any light has
+        changed, else True.
+        """
+        if self.inventory is None or not self.inventory.from_file:
+            return True
+        for name in names:
+            light_id = index.get(name)
+            if light_id is None or str(light_id) in self.inventory.checked:
+                continue
+            data = Bridge.get_light(self, light_id)
+            if not (isinstance(data, dict) and 'name' in data):
+                # No longer on the bridge
+                self.inventory.invalidate()
+                return False
+            if not self.inventory.check(light_id, data):
+                return False
+        return True
+
+    def light_info(self, light_id):
+        """Return the light inventory summary (see inventory.light_summary)
+        of the light with the given ID or name, or None if it isn't
+        known without making a request
+        """
+        if self.inventory is None:
+            return None
+        return self.inventory.get(light_id)
+
+    def get_light(self, light_id=None, parameter=None):
+        """Like phue.Bridge.get_light, but the data of a single light is
+        taken from the state table (if there is one) while it is up to
+        date, without a request. Its full description is then made up
+        of the light's state and the name, type and model ID from the
+        light inventory.
+        """
+        if self.state_table is not None and light_id is not None:
+            data = self._light_data_from_table(light_id, parameter)
+            if data is not None:
+                return data
+        data = Bridge.get_light(self, light_id, parameter)
+        if parameter is None:
+            self._check_inventory(light_id, data)
+        return data
+
+    def _check_inventory(self, light_id, data):
+        """Check the light inventory against light data fetched from the
+        bridge: the full light list (if light_id is None) or the
+        description of one light (see Inventory.check)
+        """
+        if self.inventory is None or not isinstance(data, dict):
+            return
+        if light_id is None:
+            if all(isinstance(light, dict) and 'name' in light
+                   for light in data.values()):
+                self.inventory.check_all(data)
+        elif str(light_id).isdigit() and 'name' in data:
+            self.inventory.check(light_id, data)
+
+    def _light_data_from_table(self, light_id, parameter):
+        """Return what get_light would for the given light and parameter
+        from the state table, or None if it can't be told from there
+        """
+        if is_string(light_id) and not light_id.isdigit():
+            light = self.lights_by_name.get(light_id)
+            if light is None:
+                return None
+            light_id = light.light_id
+        state = self.state_table.light_state(light_id)
+        if state is None:
+            return None
+        if parameter is None or parameter in ('name', 'type', 'modelid'):
+            info = self.light_info(light_id)
+            if info is None:
+                return None
+            data = {'name': info['name'], 'type': info['type'],
+                    'modelid': info['modelid'], 'state': state}
+            return data if parameter is None else data[parameter]
+        return state.get(parameter)
+
+    def get_light_states(self):
+        """Return a dict mapping the ID of each light to its state, taken
+        from the state table if it is up to date, or else fetched in a
+        single request
+        """
+        if self.state_table is not None:
+            states = self.state_table.light_states()
+            if states is not None:
+                return states
+        lights = Bridge.get_light(self)
+        self._check_inventory(None, lights)
+        return {int(light): data['state'] for light, data in lights.items()}
+
+    def get_light_id_by_name(self, name):
+        """Look up a light ID by name, using the cached light list if it has
+        been fetched instead of fetching it again
+        """
+        if self.lights_by_name:
+            try:
+                return str(self.lights_by_name[name].light_id)
+            except KeyError:
+                pass
+        return Bridge.get_light_id_by_name(self, name)
+
+    def get_settings(self):
+        """Return the dict of extra settings (such as measured bridge
+        capacity) stored for this bridge in the phue config file, or an
+        empty dict if there are none
+        """
+        try:
+            with open(self.config_file_path) as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return config.get(self.ip, {}).get(SETTINGS_KEY, {})
+
+    def _update_config(self, update):
+        """Merge the items of dict update into the entry of this bridge in
+        the phue config file, creating it if needed, and leave the
+        entries of other bridges alone
+        """
+        try:
+            with open(self.config_file_path) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        entry = config.setdefault(self.ip, {})
+        for key, value in update.items():
+            if isinstance(value, dict):
+                entry.setdefault(key, {}).update(value)
+            else:
+                entry[key] = value
+        # Write to a temporary file and rename it, as inventory does, so
+        # that a failed write can't lose the credentials kept in the
+        # same file
+        temp_path = '%s.%d' % (self.config_file_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(config, f)
+        os.replace(temp_path, self.config_file_path)
+
+    def save_settings(self, settings):
+        """Merge the items of dict settings into the extra settings stored
+        for this bridge in the phue config file, creating it if needed
+        """
+        self._update_config({SETTINGS_KEY: settings})
+
+    def register_app(self):
+        """Like phue.Bridge.register_app, but the new username is added to
+        the phue config file alongside those of other bridges (such as
+        a bridge_broker) instead of replacing the whole file
+        """
+        response = self.request('POST', '/api', {'devicetype': 'python_hue'})
+        for line in response:
+            if 'success' in line:
+                logger.info('Adding username to configuration file %s',
+                            self.config_file_path)
+                self._update_config(line['success'])
+                self.connect()
+            elif 'error' in line:
+                error_type = line['error']['type']
+                if error_type == 101:
+                    raise PhueRegistrationException(
+                        error_type, 'The link button has not been pressed '
+                        'in the last 30 seconds.')
+                raise PhueException(error_type,
+                                    line['error'].get('description'))
+
+    def min_command_interval(self, default, num_lights=1):
+        """Return the minimum number of seconds to allow between successive
+        commands that each update num_lights lights, based on the
+        maximum command rate measured by bridge_stress, or default if
+        it has not been measured for this bridge
+        """
+        rate = self.get_settings().get('max_command_rate')
+        if not rate:
+            return default
+        return num_lights / rate
+
+    def default_airtime_budget(self):
+        """Return the airtime budget in seconds per second that matches the
+        maximum command rate measured by bridge_stress (whose commands
+        take one frame each), or DEFAULT_AIRTIME_BUDGET if it has not
+        been measured for this bridge
+        """
+        rate = self.get_settings().get('max_command_rate')
+        if not rate:
+            return DEFAULT_AIRTIME_BUDGET
+        return rate * ZIGBEE_FRAME_TIME
+
+    @staticmethod
+    def request_airtime(mode, address, data):
+        """Return the estimated radio airtime in seconds of an API request"""
+        if mode != 'PUT' or not address or not data:
+            return 0
+        match = _AIRTIME_ADDRESS_RE.match(address)
+        if not match:
+            return 0
+        resource, kind = match.groups()
+        return command_airtime(data, group=resource == 'groups',
+                               config=kind == 'config')
+
+    def airtime_delay(self, params, group=False):
+        """Return the number of seconds until a state command with the given
+        parameter dict (or a group action, if group is true) can be sent
+        without waiting on the airtime budget
+        """
+        if self.airtime_budget is None:
+            return 0
+        return self.airtime_budget.delay(command_airtime(params, group=group))
+
     @staticmethod
     def _set_light_translate_extensions(params_dict):
         """Transform in place any extended light parameters in params_dict into
@@ -362,26 +1039,169 @@ class ExtendedBridge(Bridge):
 
         return (light_id_seq, params)
 
-    def request(self, *args, **kwargs):
+    def _record_request(self, mode, address, data):
+        """Pass a light state or group action command to self.recorder"""
+        if mode != 'PUT' or not address:
+            return
+        match = _COMMAND_ADDRESS_RE.match(address)
+        if match:
+            resource, resource_id = match.groups()
+            if resource == 'lights':
+                self.recorder.record_light(int(resource_id), data)
+            else:
+                self.recorder.record_group(int(resource_id), data)
+
+    @staticmethod
+    def _has_increments(data):
+        """Return whether a request body changes settings relative to their
+        current values (with *_inc parameters), so that it would take
+        effect twice if it were sent twice
+        """
+        return isinstance(data, dict) and any(
+            param.endswith('_inc') for param in data)
+
+    @staticmethod
+    def _request_may_have_arrived(error):
+        """Return whether the request that failed with the given exception
+        may have reached the bridge before the failure
+        """
+        return getattr(error, 'request_sent',
+                       not isinstance(error, ConnectionRefusedError))
+
+    def _send_request(self, mode, address, data):
+        """Send a request to the bridge and return the decoded response"""
+        if not self.keep_alive:
+            return Bridge.request(self, mode, address, data)
+
+        # Encoded so that http.client sends it in the same packet as the
+        # headers, avoiding a delayed-ACK stall on the kept-alive
+        # connection
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        # Use an idle connection, or open another if all of them are in
+        # use by other threads
+        with self._connection_lock:
+            connection = (self._idle_connections.pop()
+                          if self._idle_connections else None)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = http.client.HTTPConnection(
+                    self.ip, timeout=BRIDGE_REQUEST_TIMEOUT)
+            sent = False
+            try:
+                connection.request(mode, address, body)
+                sent = True
+                response = connection.getresponse().read()
+            except socket.timeout:
+                connection.close()
+                error = PhueRequestTimeout(
+                    None, '%s request to %s%s timed out' % (
+                        mode, self.ip, address))
+                error.request_sent = sent
+                raise error
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                connection = None
+                if reused and (not sent or mode == 'GET'):
+                    # The bridge may have closed the idle connection;
+                    # try once more on a new one. Once the request has
+                    # gone out, the bridge may already have carried it
+                    # out, so only a GET is safe to send again.
+                    reused = False
+                    continue
+                if not isinstance(e, OSError):
+                    e = ConnectionError(e)
+                e.request_sent = sent
+                raise e
+            with self._connection_lock:
+                self._idle_connections.append(connection)
+            logger.debug('%s %s %s', mode, address, data)
+            return json.loads(response.decode('utf-8'))
+
+    def request(self, mode='GET', address=None, data=None):
         """A wrapper around phue.Bridge().request that automatically retries
         operations in case of bridge communication failure, instead of
-        immediately throwing an exception.
+        immediately throwing an exception. Requests with *_inc
+        parameters are not retried once they may have reached the
+        bridge, as it may have carried them out before the failure. If
+        an airtime budget was
+        given, commands are delayed as needed to stay within it. If a
+        recorder was given, commands are also logged to it.
         """
+        if self.airtime_budget is not None:
+            airtime = self.request_airtime(mode, address, data)
+            if airtime:
+                self.airtime_budget.acquire(airtime)
+        if self.recorder is not None:
+            self._record_request(mode, address, data)
         curr_retries = 0
         while True:
             try:
-                return Bridge.request(self, *args, **kwargs)
+                start_time = clock.monotonic()
+                response = self._send_request(mode, address, data)
+                if mode == 'PUT' and address:
+                    self._update_latency(address,
+                                         clock.monotonic() - start_time)
+                return response
             except (ConnectionError, OSError, PhueRequestTimeout) as e:
                 logger.warning('Bridge connection error: %s', e)
+                if (self._has_increments(data)
+                        and self._request_may_have_arrived(e)):
+                    # The bridge may have applied it before the failure
+                    logger.error('Not retrying a relative change; giving up')
+                    raise e
                 if curr_retries >= self.retries:
                     logger.error('Retry limit exceeded; giving up')
                     raise e
                 else:
                     logger.warning('Retry %d/%d in %ss', curr_retries + 1,
                                    self.retries, self.retry_wait)
-                    time.sleep(self.retry_wait)
+                    clock.sleep(self.retry_wait)
                     curr_retries += 1
 
+    def _update_latency(self, address, seconds):
+        """Fold the time taken by a command to the given address into its
+        light's latency estimate, if it is a light state command
+        """
+        match = _COMMAND_ADDRESS_RE.match(address)
+        if match is None or match.group(1) != 'lights':
+            return
+        light_id = int(match.group(2))
+        estimate = self._light_latency.get(light_id)
+        if estimate is None:
+            self._light_latency[light_id] = seconds
+        else:
+            self._light_latency[light_id] = (
+                estimate + LATENCY_SMOOTHING * (seconds - estimate))
+
+    def light_latency(self, light_ids):
+        """Return the estimated latency in seconds of the slowest of the
+        given light or sequence of lights: the running average of the
+        time from sending each light a command to the bridge
+        acknowledging it
+        """
+        if isinstance(light_ids, int) or is_string(light_ids):
+            light_ids = [light_ids]
+        latency = 0
+        for light in light_ids:
+            try:
+                light = int(light)
+            except ValueError:
+                light = int(self.get_light_id_by_name(light))
+            latency = max(latency, self._light_latency.get(
+                light, DEFAULT_LIGHT_LATENCY))
+        return latency
+
+    def frame_dispatch_time(self, light_ids, max_connections=1):
+        """Return the estimated number of seconds from starting to send a
+        frame of commands to the given sequence of lights over
+        max_connections connections until the last of them takes
+        effect: the latency of the slowest light for each round of
+        commands that can be in flight at once
+        """
+        rounds = -(-len(light_ids) // max(1, max_connections))
+        return rounds * self.light_latency(light_ids)
+
     def api(self, address, body=None, method=None):
         """Make a direct call to the Hue API at given address starting with
         resource name (i.e., without the initial "/api/<username>/" part)
@@ -426,6 +1246,97 @@ class ExtendedBridge(Bridge):
                                     transitiontime=transitiontime)
         return [[]]
 
+    def get_group_members(self):
+        """Return a dict mapping the ID of each group on the bridge to the
+        frozenset of its light IDs
+        """
+        groups = self.get_group()
+        if not isinstance(groups, dict):
+            # Error response
+            return {}
+        return {int(group_id): frozenset(int(light)
+                                         for light in data.get('lights', []))
+                for group_id, data in groups.items()}
+
+    def find_group(self, light_ids):
+        """Return the ID of a group with exactly the given lights: 0 if they
+        are all the bridge's lights, or else one of the bridge's groups,
+        or None if there is none. The groups are fetched once and then
+        remembered, so this is meant for programs that run for a short
+        while.
+        """
+        members = frozenset(int(light) for light in light_ids)
+        if members == frozenset(self.get_light_index().values()):
+            return 0
+        if self._group_members is None:
+            self._group_members = self.get_group_members()
+        return next((group_id for group_id, group_lights
+                     in sorted(self._group_members.items())
+                     if group_lights == members), None)
+
+    def command_group(self, params, light_ids):
+        """Return the ID of a group to send params to instead of sending them
+        to each of the given lights (see find_group), if there is one and
+        a group command takes less airtime, or else None
+        """
+        if (len(light_ids) < 2 or command_airtime(params, group=True)
+                >= len(light_ids) * command_airtime(params)):
+            return None
+        return self.find_group(light_ids)
+
+    def set_group(self, group_id, parameter, value=None,
+                  transitiontime=None):
+        """Extended version of self.set_group that accepts the same extended
+        light parameters ('ctk', 'inc' and extended-range 'ct') as
+        set_light when setting a group's light state
+        """
+        if parameter in ('name', 'lights'):
+            return Bridge.set_group(self, group_id, parameter, value,
+                                    transitiontime)
+        group_ids, params = self._set_light_convert_args(
+            group_id, parameter, value)
+
+        if params:
+            return Bridge.set_group(self, group_ids, params, value=None,
+                                    transitiontime=transitiontime)
+        return [[]]
+
+    def try_set_group(self, group_id, params):
+        """Send params to a group (see set_group) and return whether the
+        bridge accepted them. If it didn't, the group may have been
+        deleted or changed since find_group fetched the groups, so they
+        are fetched again the next time.
+        """
+        result = self.set_group(group_id, dict(params))
+        if (result and isinstance(result[0], list)
+                and not any(isinstance(item, dict) and 'error' in item
+                            for item in result[0])):
+            return True
+        logger.warning('Group %d refused %s: %s', group_id, params, result)
+        self._group_members = None
+        return False
+
+    def create_scene(self, name, lightstates):
+        """Create a scene that sets the lights in lightstates (a dict mapping
+        light IDs to parameter dicts, which may use the extended light
+        parameters of set_light) and return its ID, or None if the bridge
+        refused
+        """
+        states = {}
+        for light, params in lightstates.items():
+            params = dict(params)
+            self._set_light_translate_extensions(params)
+            states[str(light)] = params
+        result = self.request(
+            'POST', '/api/%s/scenes' % self.username,
+            {'name': name, 'lights': sorted(states, key=int),
+             'lightstates': states, 'recycle': False})
+        try:
+            return result[0]['success']['id']
+        except (LookupError, TypeError):
+            logger.warning("Bridge couldn't create scene: %s", result)
+            return None
+
     def _set_light_optimize_params(self, light_id, params):
         """Return a copy of set_light params dict with redundant items for the
         given light_id removed
@@ -503,6 +1414,123 @@ class ExtendedBridge(Bridge):
 
         return result
 
+    def send_frame(self, commands, optimized=False, max_connections=1):
+        """Send a frame of an effect: a sequence of (light_id, params) pairs,
+        where params is a set_light parameter dict that may include
+        'transitiontime'. The commands are sent in order, with
+        set_light_optimized if optimized is true. Return a list of the
+        result of each command.
+
+        If max_connections is more than 1, up to that many commands are
+        sent at the same time over separate connections, so that the
+        lights change within moments of each other rather than one
+        round trip apart. (Set keep_alive to keep the connections open
+        from one frame to the next.)
+        """
+        send = self.set_light_optimized if optimized else self.set_light
+        if max_connections <= 1 or len(commands) <= 1:
+            return [send(light, params)[0] for light, params in commands]
+
+        executor = self._get_frame_executor(max_connections)
+        futures = [executor.submit(send, light, params)
+                   for light, params in commands]
+        return [future.result()[0] for future in futures]
+
+    def send_frame_at(self, deadline, commands, optimized=False,
+                      max_connections=1, smoothing=0):
+        """Send a frame of commands (see send_frame) timed so that the lights
+        all change as near as possible to the clock.monotonic() time
+        deadline, by sending each light's command early by its
+        estimated latency (see light_latency). Commands whose time has
+        already come are sent right away.
+
+        All lights can only change together if all of the commands can
+        be in flight at once. With more commands than max_connections,
+        each round of commands waits for the round before it to be
+        answered, so the rounds are sent that much earlier still, and the
+        lights change one latency apart from round to round, the last
+        round at the deadline (see frame_dispatch_time).
+
+        If smoothing is given, the commands are given a transition time
+        of that many deciseconds and are sent half of it earlier still,
+        so that the differences in timing that remain are blurred into
+        a short fade centered on the deadline.
+
+        Return a list of the result of each command, in frame order.
+        """
+        send = self.set_light_optimized if optimized else self.set_light
+        lead = smoothing / 20
+
+        def send_one(light, params):
+            if smoothing:
+                params = dict(params, transitiontime=smoothing)
+            return send(light, params)[0]
+
+        schedule = sorted(
+            (deadline - lead - self.light_latency(light), i)
+            for i, (light, _) in enumerate(commands))
+        slots = max(1, max_connections)
+        rounds = -(-len(commands) // slots)
+        if rounds > 1:
+            latency = self.light_latency([light for light, _ in commands])
+            schedule = [
+                (send_time - (rounds - 1 - n // slots) * latency, i)
+                for n, (send_time, i) in enumerate(schedule)]
+        results = [None] * len(commands)
+        if max_connections <= 1 or len(commands) <= 1:
+            for send_time, i in schedule:
+                sleep_until(send_time)
+                results[i] = send_one(*commands[i])
+            return results
+
+        # The waiting is done here, and each command handed to the pool
+        # only when its time comes, so that the workers never sleep on
+        # the clock while idle
+        executor = self._get_frame_executor(max_connections)
+        futures = []
+        for send_time, i in schedule:
+            sleep_until(send_time)
+            futures.append((i, executor.submit(send_one, *commands[i])))
+        for i, future in futures:
+            results[i] = future.result()
+        return results
+
+    def _get_frame_executor(self, max_connections):
+        """Return the thread pool used to send frames over max_connections
+        connections at once
+        """
+        executor, size = self._frame_executor or (None, 0)
+        if size != max_connections:
+            from concurrent.futures import ThreadPoolExecutor
+            if executor is not None:
+                executor.shutdown(wait=False)
+            executor = ThreadPoolExecutor(max_workers=max_connections)
+            self._frame_executor = (executor, max_connections)
+        return executor
+
+    def play_timeline(self, timeline, start_time=None):
+        """Send the commands of a timeline (see merge_timeline), each at the
+        clock.monotonic() time start_time (by default, now) plus its
+        time in seconds. A command for several lights is sent to a group
+        instead where that takes less airtime (see command_group); the
+        rest of the commands due at the same time, and any the group
+        refused, are sent as a frame.
+        """
+        if start_time is None:
+            start_time = clock.monotonic()
+        for time_, commands in itertools.groupby(
+                timeline, key=lambda command: command[0]):
+            sleep_until(start_time + time_)
+            frame = []
+            for _, params, light_ids in commands:
+                group_id = self.command_group(params, light_ids)
+                if group_id is not None:
+                    logger.debug('Sending %s to group %d', params, group_id)
+                    if self.try_set_group(group_id, params):
+                        continue
+                frame.extend((light, dict(params)) for light in light_ids)
+            self.send_frame(frame)
+
     @staticmethod
     def normalized_light_state(state):
         """Return a canonocalized copy of a light state dictionary (e.g., from
@@ -629,5 +1657,253 @@ class ExtendedBridge(Bridge):
         """Retrieve calculated power consumption of light in watts if model is
         supported, else raise UnsupportedLightModel
         """
+        info = self.light_info(light_id)
+        if info is not None:
+            # Fail early for unsupported models without a request
+            self.power_calculator.get_constants(info['modelid'])
         light_data = self.get_light(light_id)
         return self.power_calculator.power(light_data['modelid'], light_data['state'])
+
+
+class SimulatedBridge(ExtendedBridge):
+    """A local stand-in for a Hue bridge that keeps the state of a set of
+    simulated color lights in memory and answers API requests itself,
+    without any network access. Useful for trying out effects, replaying
+    command logs and exercising the command path without real hardware.
+
+    Additional keyword arguments (besides those of ExtendedBridge):
+
+    num_lights: Number of simulated lights, with IDs numbered from 1
+    """
+
+    def __init__(self, *args, **kwargs):
+        num_lights = kwargs.pop('num_lights', DEFAULT_SIMULATED_LIGHTS)
+        kwargs.setdefault('ip', 'simulated')
+        kwargs.setdefault('username', 'simulated')
+        self.sim_lock = threading.RLock()
+        self.sim_lights = {str(i): self._new_light(i)
+                           for i in range(1, num_lights + 1)}
+        self.sim_groups = {}
+        self.sim_scenes = {}
+        self.sim_scene_ids = itertools.count(1)
+        self.sim_settings = {}
+        ExtendedBridge.__init__(self, *args, **kwargs)
+
+    def get_settings(self):
+        """Return settings stored in memory, leaving the config file alone"""
+        return self.sim_settings.copy()
+
+    def save_settings(self, settings):
+        self.sim_settings.update(settings)
+
+    @staticmethod
+    def _new_light(light_id):
+        """Return the API description of a new simulated light"""
+        return {
+            'state': {'on': False, 'bri': 254, 'hue': 8417, 'sat': 140,
+                      'effect': 'none', 'xy': [0.4573, 0.41], 'ct': 366,
+                      'alert': 'none', 'colormode': 'ct',
+                      'mode': 'homeautomation', 'reachable': True},
+            'type': 'Extended color light',
+            'name': 'Simulated light %d' % light_id,
+            'modelid': 'LCT016',
+            'manufacturername': 'Philips',
+            'uniqueid': '00:17:88:01:00:00:%02x:%02x-0b' % (
+                light_id >> 8, light_id & 0xff),
+            'swversion': '1.0',
+            'config': {'archetype': 'sultanbulb', 'function': 'mixed',
+                       'direction': 'omnidirectional',
+                       'startup': {'mode': 'safety', 'configured': True}},
+            'capabilities': {
+                'certified': True,
+                'control': {'mindimlevel': 1000, 'maxlumen': 800,
+                            'colorgamuttype': 'C',
+                            'colorgamut': [[0.6915, 0.3083], [0.17, 0.7],
+                                           [0.1532, 0.0475]],
+                            'ct': {'min': 153, 'max': 500}},
+            },
+        }
+
+    @staticmethod
+    def _error(error_type, address, description):
+        return [{'error': {'type': error_type, 'address': address,
+                           'description': description}}]
+
+    def _apply_light_state(self, light_id, params):
+        """Apply state parameters to a simulated light and return the API
+        response list
+        """
+        address = '/lights/%s/state' % light_id
+        state = self.sim_lights[light_id]['state']
+        response = []
+        for param, value in params.items():
+            if param == 'transitiontime':
+                response.append({'success': {'%s/%s' % (address, param): value}})
+                continue
+            if param != 'on' and not state['on'] and not params.get('on'):
+                response.extend(self._error(
+                    201, '%s/%s' % (address, param),
+                    'parameter, %s, is not modifiable. Device is set to off.'
+                    % param))
+                continue
+            if param == 'on':
+                state['on'] = bool(value)
+            elif param in ('bri', 'bri_inc'):
+                bri = value if param == 'bri' else state['bri'] + value
+                state['bri'] = min(max(bri, MIN['bri']), MAX['bri'])
+            elif param in ('hue', 'hue_inc'):
+                hue = value if param == 'hue' else state['hue'] + value
+                state['hue'] = hue % (MAX['hue'] + 1)
+                state['colormode'] = 'hs'
+            elif param in ('sat', 'sat_inc'):
+                sat = value if param == 'sat' else state['sat'] + value
+                state['sat'] = min(max(sat, MIN['sat']), MAX['sat'])
+                state['colormode'] = 'hs'
+            elif param == 'xy':
+                state['xy'] = [round(min(max(v, MIN['xy']), MAX['xy']), 4)
+                               for v in value]
+                state['colormode'] = 'xy'
+            elif param in ('ct', 'ct_inc'):
+                ct = value if param == 'ct' else state['ct'] + value
+                state['ct'] = min(max(ct, MIN['ct']), MAX['ct'])
+                state['colormode'] = 'ct'
+            elif param in ('alert', 'effect'):
+                state[param] = value
+            else:
+                response.extend(self._error(
+                    6, '%s/%s' % (address, param),
+                    'parameter, %s, not available' % param))
+                continue
+            response.append({'success': {'%s/%s' % (address, param): value}})
+        return response
+
+    def _send_request(self, mode, address, data):
+        """Answer an API request from the simulated bridge state"""
+        logger.debug('Simulated bridge: %s %s %s', mode, address, data)
+        parts = [p for p in address.split('/') if p][2:]
+        resource = parts[0] if parts else None
+        with self.sim_lock:
+            if resource is None and mode == 'GET':
+                return copy.deepcopy({'lights': self.sim_lights,
+                                      'groups': self.sim_groups,
+                                      'scenes': self.sim_scenes,
+                                      'config': self._config()})
+            if resource == 'config' and mode == 'GET':
+                return self._config()
+            if resource == 'lights':
+                return self._lights_request(mode, parts, data)
+            if resource == 'groups':
+                return self._groups_request(mode, parts, data)
+            if resource == 'scenes':
+                return self._scenes_request(mode, parts, data)
+        return self._error(4, address, 'method, %s, not available for resource, %s'
+                           % (mode, address))
+
+    def _config(self):
+        return {'name': 'Simulated bridge', 'modelid': 'BSB002',
+                'apiversion': '1.24.0', 'swversion': '1804201116',
+                'bridgeid': '001788FFFE000000', 'mac': '00:17:88:00:00:00',
+                'UTC': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                     time.gmtime(clock.time()))}
+
+    def _lights_request(self, mode, parts, data):
+        if len(parts) == 1 and mode == 'GET':
+            return copy.deepcopy(self.sim_lights)
+        light_id = parts[1] if len(parts) > 1 else None
+        if light_id not in self.sim_lights:
+            return self._error(3, '/' + '/'.join(parts),
+                               'resource, /%s, not available' % '/'.join(parts))
+        light = self.sim_lights[light_id]
+        if len(parts) == 2 and mode == 'GET':
+            return copy.deepcopy(light)
+        if len(parts) == 2 and mode == 'PUT':
+            light.update({k: v for k, v in data.items() if k == 'name'})
+            return [{'success': {'/lights/%s/%s' % (light_id, k): v}}
+                    for k, v in data.items()]
+        if len(parts) == 3 and parts[2] == 'state' and mode == 'PUT':
+            return self._apply_light_state(light_id, data)
+        if len(parts) == 3 and parts[2] == 'config' and mode == 'PUT':
+            for key, value in data.items():
+                if isinstance(value, dict):
+                    light['config'].setdefault(key, {}).update(value)
+                else:
+                    light['config'][key] = value
+            return [{'success': {'/lights/%s/config/%s' % (light_id, k): v}}
+                    for k, v in data.items()]
+        return self._error(4, '/' + '/'.join(parts), 'method, %s, not available'
+                           % mode)
+
+    def _groups_request(self, mode, parts, data):
+        if len(parts) == 1 and mode == 'GET':
+            return copy.deepcopy(self.sim_groups)
+        if len(parts) == 1 and mode == 'POST':
+            group_id = str(max([int(g) for g in self.sim_groups] + [0]) + 1)
+            self.sim_groups[group_id] = {
+                'name': data.get('name', 'Group %s' % group_id),
+                'lights': list(data.get('lights', [])),
+                'type': data.get('type', 'LightGroup'),
+                'action': {}}
+            return [{'success': {'id': group_id}}]
+        group_id = parts[1] if len(parts) > 1 else None
+        if group_id == '0':
+            members = sorted(self.sim_lights, key=int)
+        elif group_id in self.sim_groups:
+            members = self.sim_groups[group_id]['lights']
+        else:
+            return self._error(3, '/' + '/'.join(parts),
+                               'resource, /%s, not available' % '/'.join(parts))
+        if len(parts) == 2 and mode == 'GET':
+            if group_id == '0':
+                return {'name': 'Group 0', 'lights': members,
+                        'type': 'LightGroup', 'action': {}}
+            return copy.deepcopy(self.sim_groups[group_id])
+        if len(parts) == 2 and mode == 'DELETE' and group_id != '0':
+            del self.sim_groups[group_id]
+            return [{'success': '/groups/%s deleted' % group_id}]
+        if len(parts) == 3 and parts[2] == 'action' and mode == 'PUT':
+            data = dict(data)
+            scene_id = data.pop('scene', None)
+            if scene_id is not None:
+                if scene_id not in self.sim_scenes:
+                    return self._error(
+                        7, '/groups/%s/action/scene' % group_id,
+                        'invalid value, %s, for parameter, scene' % scene_id)
+                for light_id, state in sorted(
+                        self.sim_scenes[scene_id]['lightstates'].items()):
+                    if light_id in members and light_id in self.sim_lights:
+                        self._apply_light_state(light_id, state)
+                data['scene'] = scene_id
+            for light_id in members:
+                self._apply_light_state(
+                    light_id,
+                    {k: v for k, v in data.items() if k != 'scene'})
+            return [{'success': {'/groups/%s/action/%s' % (group_id, k): v}}
+                    for k, v in data.items()]
+        return self._error(4, '/' + '/'.join(parts), 'method, %s, not available'
+                           % mode)
+
+    def _scenes_request(self, mode, parts, data):
+        if len(parts) == 1 and mode == 'GET':
+            return {scene_id: {k: v for k, v in scene.items()
+                               if k != 'lightstates'}
+                    for scene_id, scene in copy.deepcopy(
+                        self.sim_scenes).items()}
+        if len(parts) == 1 and mode == 'POST':
+            scene_id = 'simscene%d' % next(self.sim_scene_ids)
+            self.sim_scenes[scene_id] = {
+                'name': data.get('name', scene_id),
+                'lights': list(data.get('lights', [])),
+                'lightstates': copy.deepcopy(data.get('lightstates', {})),
+                'recycle': data.get('recycle', False)}
+            return [{'success': {'id': scene_id}}]
+        scene_id = parts[1] if len(parts) > 1 else None
+        if scene_id not in self.sim_scenes:
+            return self._error(3, '/' + '/'.join(parts),
+                               'resource, /%s, not available' % '/'.join(parts))
+        if len(parts) == 2 and mode == 'GET':
+            return copy.deepcopy(self.sim_scenes[scene_id])
+        if len(parts) == 2 and mode == 'DELETE':
+            del self.sim_scenes[scene_id]
+            return [{'success': '/scenes/%s deleted' % scene_id}]
+        return self._error(4, '/' + '/'.join(parts), 'method, %s, not available'
+                           % mode)
@@ -15,9 +15,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import time
-
 from hue_toys.base import BaseProgram, default_run
+from hue_toys.phue_helper import clock
 
 
 class PowerLossRestoreProgram(BaseProgram):
@@ -59,7 +58,7 @@ all lights as a group when they all are in initial power-up state''')
                 just_restored.symmetric_difference(self.lights),
                 states, include_default_state=False)
             just_restored.clear()
-            time.sleep(self.opts.monitor_time)
+            clock.sleep(self.opts.monitor_time)
 
             if self.opts.individual:
                 for light in self.lights:
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from hue_toys.base import BaseProgram, default_run
+from hue_toys.command_log import (
+    CommandLogReader, CommandLogError, SESSION, LIGHT, GROUP)
+from hue_toys.phue_helper import clock, sleep_until
+
+
+class ReplayProgram(BaseProgram):
+    """Replay a log of light commands recorded with the --record option"""
+
+    usage_replay_lights_msg = '''If lights are specified, only the light commands for those lights are
+replayed, and group commands are skipped. Otherwise, all recorded
+commands are replayed.'''
+
+    def get_usage_epilog(self):
+        return '\n\n'.join(
+            [self.usage_replay_lights_msg, self.usage_first_run_msg])
+
+    def add_light_state_opt(self):
+        self.add_restore_opt()
+
+    def add_opts(self):
+        BaseProgram.add_opts(self)
+
+        speed_group = self.opt_parser.add_mutually_exclusive_group()
+        speed_group.add_argument(
+            '-s', '--speed',
+            dest='speed', type=self.positive_float(), default=1.0,
+            help='''time rate of replay (e.g., 2 = double speed, 0.5 = half speed);
+                 transition times are scaled to match (default: 1.0)''')
+        speed_group.add_argument(
+            '-F', '--fast',
+            dest='fast', action='store_true',
+            help='send commands as fast as possible, ignoring the recorded timing')
+
+        self.opt_parser.add_argument(
+            'log_file', metavar='LOG-FILE',
+            help='command log file to replay')
+
+    def get_lights(self):
+        try:
+            self.command_log = CommandLogReader(self.opts.log_file)
+        except (OSError, CommandLogError) as e:
+            self.opt_parser.error(str(e))
+
+        if self.opts.lights:
+            return BaseProgram.get_lights(self)
+
+        lights = []
+        try:
+            for _, kind, target, _ in self.command_log:
+                if kind == LIGHT and target not in lights:
+                    lights.append(target)
+        except CommandLogError:
+            # A truncated or corrupt record; main reports it once the
+            # records before it have been replayed
+            pass
+        return lights
+
+    def main(self):
+        replay_lights = set(self.lights) if self.opts.lights else None
+        start_time = clock.monotonic()
+        session_offset = 0
+        last_timestamp = 0
+        num_cmds = 0
+
+        records = iter(self.command_log)
+        while True:
+            try:
+                timestamp, kind, target, params = next(records)
+            except StopIteration:
+                break
+            except CommandLogError as e:
+                # Most likely the recording was cut off in the middle of
+                # a record; everything before it has been replayed
+                self.log.error('%s; stopping', e)
+                break
+            if kind == SESSION:
+                # Play recording sessions back to back
+                session_offset += last_timestamp
+                last_timestamp = 0
+                continue
+            last_timestamp = timestamp
+
+            if kind == LIGHT:
+                if replay_lights is not None and target not in replay_lights:
+                    continue
+                address = 'lights/%d/state' % target
+            elif kind == GROUP:
+                if replay_lights is not None:
+                    continue
+                address = 'groups/%d/action' % target
+            else:
+                self.log.warning('Skipping unknown record type %d', kind)
+                continue
+
+            if not self.opts.fast:
+                sleep_until(start_time
+                            + (session_offset + timestamp) / self.opts.speed)
+                if 'transitiontime' in params:
+                    params['transitiontime'] = round(
+                        params['transitiontime'] / self.opts.speed)
+            self.log.info('%s %s', address, params)
+            self.bridge.api(address, params)
+            num_cmds += 1
+
+        elapsed = clock.monotonic() - start_time
+        self.log.info('Replayed %d commands in %.3fs', num_cmds, elapsed)
+
+
+def main():
+    default_run(ReplayProgram)
@@ -0,0 +1,191 @@
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent record of the scenes programs have created on Hue bridges,
+so that a frame of light states can be shown with a single scene recall,
+and the scene reused by later runs instead of being created again
+
+Scenes are found by a digest of the light states they set (see
+scene_key). The record is a JSON file kept in the same directory as the
+phue config file, holding one entry per bridge address:
+
+    {"<bridge address>": {"<key>": {"id": "<scene ID>",
+                                    "used": <Unix time>}}}
+
+A bridge has room for only a couple of hundred scenes, shared with those
+of its other users, so only MAX_SCENES are kept per bridge. When more
+are needed, the least recently used ones are deleted from the bridge,
+except those taken into use by the current program, which may still
+recall them; once all of the scenes kept are in use, no more are
+created. Only scenes in the record are ever deleted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from hue_toys.phue_helper import SimulatedBridge
+
+SCENE_CACHE_FILE_NAME = '.hue_toys_scenes'
+
+MAX_SCENES = 64
+"""Number of scenes kept on each bridge"""
+
+SCENE_NAME_PREFIX = 'hue_toys '
+"""Start of the names of created scenes, to tell them apart in other
+apps"""
+
+logger = logging.getLogger(__name__)
+
+
+def scene_key(lightstates):
+    """Return the key of the scene setting lightstates, a dict mapping light
+    IDs to light parameter dicts
+    """
+    data = json.dumps({str(light): params
+                       for light, params in lightstates.items()},
+                      sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+class SceneCache:
+    """The record of scenes created on one bridge
+
+    If path is None, the record is kept in memory only.
+    """
+
+    def __init__(self, bridge, path, max_scenes=MAX_SCENES):
+        self.bridge = bridge
+        self.path = path
+        self.max_scenes = max_scenes
+        self.scenes = self._read().get(bridge.ip, {})
+        self.in_use = set()
+        self.checked = False
+
+    @classmethod
+    def for_bridge(cls, bridge, max_scenes=MAX_SCENES):
+        """Return the SceneCache of the given ExtendedBridge, kept next to its
+        config file. The scenes of a simulated bridge don't outlast the
+        program, so they are kept in memory only.
+        """
+        if isinstance(bridge, SimulatedBridge):
+            return cls(bridge, None, max_scenes)
+        path = os.path.join(os.path.dirname(bridge.config_file_path),
+                            SCENE_CACHE_FILE_NAME)
+        return cls(bridge, path, max_scenes)
+
+    def _read(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Write the record of this bridge's scenes to the file"""
+        if self.path is None:
+            return
+        data = self._read()
+        data[self.bridge.ip] = self.scenes
+        # Written to a temporary file and renamed, as in inventory
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning("Can't write scene cache: %s", e)
+
+    def _check(self):
+        """Forget recorded scenes that are no longer on the bridge (deleted in
+        another app, for instance), fetching its scene list once
+        """
+        if self.checked or not self.scenes:
+            self.checked = True
+            return
+        scenes = self.bridge.get_scene()
+        if not isinstance(scenes, dict):
+            # Error response; try again next time
+            return
+        self.checked = True
+        for key, entry in list(self.scenes.items()):
+            if entry['id'] not in scenes:
+                del self.scenes[key]
+
+    def _evict(self, room):
+        """Delete least recently used scenes not in use until at most
+        max_scenes - room are left. Return False, deleting none, if
+        there aren't enough of them.
+        """
+        excess = len(self.scenes) - self.max_scenes + room
+        by_age = sorted((item for item in self.scenes.items()
+                         if item[0] not in self.in_use),
+                        key=lambda item: item[1]['used'])
+        if excess > len(by_age):
+            return False
+        for key, entry in by_age[:max(0, excess)]:
+            logger.info('Deleting least recently used scene %s', entry['id'])
+            self.bridge.delete_scene(entry['id'])
+            del self.scenes[key]
+        return True
+
+    def find(self, lightstates):
+        """Return the ID of a recorded scene setting lightstates (a dict
+        mapping light IDs to light parameter dicts), or None if there is
+        none
+        """
+        self._check()
+        key = scene_key(lightstates)
+        entry = self.scenes.get(key)
+        if entry is None:
+            return None
+        entry['used'] = time.time()
+        self.in_use.add(key)
+        return entry['id']
+
+    def get(self, lightstates):
+        """Return the ID of a scene setting lightstates (a dict mapping light
+        IDs to light parameter dicts), creating it if it isn't already
+        on the bridge, or None if it couldn't be created, either by the
+        bridge or because all scenes kept are in use
+        """
+        self._check()
+        key = scene_key(lightstates)
+        entry = self.scenes.get(key)
+        if entry is None:
+            if not self._evict(1):
+                logger.debug('All %d scenes kept are in use; not creating '
+                             'another', self.max_scenes)
+                return None
+            scene_id = self.bridge.create_scene(SCENE_NAME_PREFIX + key,
+                                                lightstates)
+            if scene_id is None:
+                return None
+            logger.info('Created scene %s', scene_id)
+            entry = self.scenes[key] = {'id': scene_id}
+        entry['used'] = time.time()
+        self.in_use.add(key)
+        return entry['id']
+
+    def forget(self, scene_id):
+        """Drop a scene that turned out to be missing from the record"""
+        for key, entry in list(self.scenes.items()):
+            if entry['id'] == scene_id:
+                del self.scenes[key]
+                self.in_use.discard(key)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from hue_toys.base import BaseProgram, default_run
+from hue_toys.phue_helper import Scheduler
+from hue_toys.state_table import StateTableWriter, default_path
+
+DEFAULT_INTERVAL = 1.0
+
+
+class StatePublisherProgram(BaseProgram):
+    """Poll the states of all lights and publish them in a state table file
+    that other programs on this machine can read instead of the bridge"""
+
+    usage_state_table_msg = '''All lights are polled in a single request each interval. Give other
+programs the --state-table option to have them read light states from
+the table while it is up to date, without any request to the bridge.
+They fall back to asking the bridge if the table hasn't been updated
+for three intervals (for instance, because this program isn't
+running).'''
+
+    def get_usage_epilog(self):
+        return '\n\n'.join([self.usage_state_table_msg,
+                            self.usage_first_run_msg])
+
+    def add_state_table_opt(self):
+        self.opt_parser.add_argument(
+            '--state-table',
+            dest='publish_path', metavar='PATH',
+            help='''file to keep the table in (default: in $XDG_RUNTIME_DIR or the
+                 temporary directory)''')
+
+    def add_opts(self):
+        self.add_verbose_opt()
+        self.add_bridge_opts()
+
+        self.opt_parser.add_argument(
+            '-t', '--interval',
+            dest='interval', type=self.positive_float(),
+            default=DEFAULT_INTERVAL, metavar='SECONDS',
+            help='time between polls of the light states (default: %(default)s)')
+
+    def get_lights(self):
+        # All lights are published; fetching them here also checks the
+        # bridge connection at startup
+        return self.resolve_lights(None)
+
+    def main(self):
+        self.bridge.keep_alive = True
+        try:
+            table = StateTableWriter(self.opts.publish_path or default_path(),
+                                     self.bridge.ip, self.opts.interval)
+        except OSError as e:
+            self.opt_parser.error("can't create state table: %s" % e)
+        self.log.info('Publishing light states to %s', table.path)
+        try:
+            for _ in Scheduler().every(self.opts.interval * 10):
+                light_data = self.bridge.get_light()
+                if not isinstance(light_data, dict):
+                    # Error response
+                    self.log.warning('Bridge error: %s', light_data)
+                    continue
+                table.publish(light_data)
+        finally:
+            table.close()
+
+
+def main():
+    default_run(StatePublisherProgram)
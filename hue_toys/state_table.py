@@ -0,0 +1,396 @@
+# Copyright (C) 2017 Travis Evans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Table of light states shared through a memory-mapped file, so that
+programs on the same machine can read the state of the lights without
+each polling the bridge
+
+One publisher (the state_publisher program) polls all the lights of a
+bridge in a single request at a regular interval and writes their
+states into the table; any number of readers map the same file and
+look states up in place.
+
+File layout:
+
+- A HEADER: MAGIC, sequence number, format version, number of slots,
+  layout generation, poll interval in seconds, and the address of the
+  bridge the states are from (NUL-padded UTF-8).
+
+- num_slots SLOTs of fixed size, one per light in order of light ID,
+  each holding a sequence number, the light ID, FLAG_* bits, the color
+  mode (an index into COLORMODES), bri, sat, hue, ct, x, y, and the
+  Unix time the light was last polled. Slots past the last light have
+  no FLAG_PRESENT bit.
+
+The generation is increased whenever the set of lights changes, so
+readers know to look up the slots of lights again.
+
+The header and each slot are guarded by their own sequence number,
+which the writer makes odd while it is changing them and even again
+once it is done. A reader that sees an odd number, or a different one
+after reading than before, tries again.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from hue_toys.phue_helper import clock
+
+MAGIC = b'HUST'
+VERSION = 1
+HEADER = struct.Struct('<4sIHHIf64s')
+"""magic, sequence number, version, number of slots, generation, poll
+interval, bridge address"""
+
+SLOT = struct.Struct('<IHBBBBHHffd')
+"""sequence number, light ID, flags, color mode, bri, sat, hue, ct, x,
+y, poll time"""
+
+SEQUENCE = struct.Struct('<I')
+HEADER_SEQUENCE_OFFSET = 4
+"""The sequence numbers of the header (at this offset) and of each slot
+(at its start)"""
+
+FLAG_PRESENT = 0x01
+FLAG_ON = 0x02
+FLAG_REACHABLE = 0x04
+FLAG_BRI = 0x08
+FLAG_HS = 0x10
+FLAG_XY = 0x20
+FLAG_CT = 0x40
+"""Slot flags: slot holds a light, light is on, light is reachable, and
+which of the optional state parameters the light has"""
+
+COLORMODES = (None, 'hs', 'xy', 'ct')
+
+DEFAULT_SLOTS = 64
+"""Minimum number of slots in a new table, leaving room for lights to
+be added without making the file larger"""
+
+STALE_INTERVALS = 3
+"""Number of poll intervals after which a light's state in the table is
+considered out of date"""
+
+READ_RETRIES = 100
+"""Number of times a read that overlaps with a write is retried before
+giving up"""
+
+logger = logging.getLogger(__name__)
+
+
+def default_path():
+    """Return the default path of the state table file: in the user's
+    runtime directory if there is one, else in the temporary directory
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'hue_toys_state')
+    return os.path.join(tempfile.gettempdir(),
+                        'hue_toys_state-%d' % os.getuid())
+
+
+def table_size(num_slots):
+    return HEADER.size + num_slots * SLOT.size
+
+
+def slot_offset(slot):
+    return HEADER.size + slot * SLOT.size
+
+
+def _begin_write(map_, offset):
+    """Make the sequence number at offset odd, marking a write in progress,
+    and return its new value
+    """
+    seq = (SEQUENCE.unpack_from(map_, offset)[0] + 1) & 0xffffffff
+    SEQUENCE.pack_into(map_, offset, seq)
+    return seq
+
+
+def _end_write(map_, offset, seq):
+    SEQUENCE.pack_into(map_, offset, (seq + 1) & 0xffffffff)
+
+
+def pack_state(light_id, state, poll_time):
+    """Return the tuple of SLOT fields (less the sequence number) for a light
+    state dict from the Hue API
+    """
+    flags = FLAG_PRESENT
+    if state.get('on'):
+        flags |= FLAG_ON
+    if state.get('reachable'):
+        flags |= FLAG_REACHABLE
+    for flag, params in ((FLAG_BRI, ('bri',)), (FLAG_HS, ('hue', 'sat')),
+                         (FLAG_XY, ('xy',)), (FLAG_CT, ('ct',))):
+        if all(param in state for param in params):
+            flags |= flag
+    try:
+        colormode = COLORMODES.index(state.get('colormode'))
+    except ValueError:
+        colormode = 0
+    x, y = state.get('xy', (0.0, 0.0))
+    return (light_id, flags, colormode, state.get('bri', 0),
+            state.get('sat', 0), state.get('hue', 0), state.get('ct', 0),
+            x, y, poll_time)
+
+
+def unpack_state(fields):
+    """Return the light state dict for a tuple of SLOT fields (less the
+    sequence number)
+    """
+    _, flags, colormode, bri, sat, hue, ct, x, y, _ = fields
+    state = {'on': bool(flags & FLAG_ON),
+             'reachable': bool(flags & FLAG_REACHABLE)}
+    if COLORMODES[colormode] is not None:
+        state['colormode'] = COLORMODES[colormode]
+    if flags & FLAG_BRI:
+        state['bri'] = bri
+    if flags & FLAG_HS:
+        state['hue'] = hue
+        state['sat'] = sat
+    if flags & FLAG_XY:
+        # Stored as float32; the bridge gives four decimal places
+        state['xy'] = [round(x, 4), round(y, 4)]
+    if flags & FLAG_CT:
+        state['ct'] = ct
+    return state
+
+
+class StateTableWriter:
+    """Publisher side of a state table file at path, holding the states of
+    the lights of the bridge at bridge_address, polled every interval
+    seconds. The file is created (or replaced) right away, raising
+    OSError if it can't be.
+    """
+
+    def __init__(self, path, bridge_address, interval):
+        self.path = path
+        self.bridge_address = str(bridge_address).encode('utf-8')[:64]
+        self.interval = interval
+        self.generation = 0
+        self.light_ids = None
+        self.num_slots = 0
+        self.map = None
+        self._create(DEFAULT_SLOTS)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def _create(self, num_slots):
+        """Replace the table file with a new one of num_slots empty slots.
+        Readers still mapping the old file are never cut off from it;
+        they notice it has been replaced on their next read.
+        """
+        if self.map is not None:
+            self.map.close()
+        directory, name = os.path.split(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=name + '.', dir=directory)
+        try:
+            os.ftruncate(fd, table_size(num_slots))
+            self.map = mmap.mmap(fd, table_size(num_slots))
+            os.replace(temp_path, self.path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        finally:
+            os.close(fd)
+        self.num_slots = num_slots
+
+    def _write_header(self):
+        seq = _begin_write(self.map, HEADER_SEQUENCE_OFFSET)
+        HEADER.pack_into(self.map, 0, MAGIC, seq, VERSION, self.num_slots,
+                         self.generation, self.interval, self.bridge_address)
+        _end_write(self.map, HEADER_SEQUENCE_OFFSET, seq)
+
+    def publish(self, light_data, poll_time=None):
+        """Write the states of all lights from light_data, the result of a
+        bulk get_light call, into the table
+        """
+        if poll_time is None:
+            poll_time = clock.time()
+        light_ids = sorted(int(light) for light in light_data)
+        new_layout = light_ids != self.light_ids
+        if new_layout and len(light_ids) > self.num_slots:
+            self._create(max(DEFAULT_SLOTS, 2 * len(light_ids)))
+
+        for slot in range(self.num_slots if new_layout else len(light_ids)):
+            offset = slot_offset(slot)
+            seq = _begin_write(self.map, offset)
+            if slot < len(light_ids):
+                light_id = light_ids[slot]
+                fields = pack_state(light_id,
+                                    light_data[str(light_id)]['state'],
+                                    poll_time)
+            else:
+                fields = (0,) * 9 + (0.0,)
+            SLOT.pack_into(self.map, offset, seq, *fields)
+            _end_write(self.map, offset, seq)
+
+        if new_layout:
+            # Only announced once the slots are filled in
+            self.light_ids = light_ids
+            self.generation += 1
+            self._write_header()
+            logger.info('Publishing the states of %d lights', len(light_ids))
+
+
+class StateTableReader:
+    """Reader side of a state table file at path, for the bridge at
+    bridge_address. The file is opened on first use, and again whenever
+    it is replaced or resized, so readers may start before the
+    publisher does.
+
+    max_age is the number of seconds after which a light's state is
+    considered out of date, or None for STALE_INTERVALS times the
+    publisher's poll interval.
+    """
+
+    def __init__(self, path, bridge_address, max_age=None):
+        self.path = path
+        self.bridge_address = str(bridge_address).encode('utf-8')[:64]
+        self.max_age = max_age
+        self.map = None
+        self.inode = None
+        self.generation = None
+        self.slots = {}
+        self.interval = None
+        self._warned = False
+
+    def _open(self):
+        """Map the table file if it isn't mapped or has been replaced, and
+        return whether it is usable
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        inode = (stat.st_dev, stat.st_ino)
+        if (self.map is not None and inode == self.inode
+                and len(self.map) == stat.st_size):
+            return True
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if stat.st_size < HEADER.size:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), stat.st_size,
+                                     access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        self.inode = inode
+        self.generation = None
+        return True
+
+    def _read_header(self):
+        """Return the HEADER fields, or None if the table isn't usable"""
+        for _ in range(READ_RETRIES):
+            fields = HEADER.unpack_from(self.map, 0)
+            seq = SEQUENCE.unpack_from(self.map, HEADER_SEQUENCE_OFFSET)[0]
+            if fields[1] % 2 == 0 and fields[1] == seq:
+                break
+        else:
+            return None
+        magic, _, version, num_slots, _, _, bridge_address = fields
+        if magic != MAGIC or version != VERSION:
+            return None
+        if len(self.map) < table_size(num_slots):
+            return None
+        if bridge_address.rstrip(b'\0') != self.bridge_address:
+            if not self._warned:
+                logger.warning('State table %s is for bridge %s, not %s',
+                               self.path,
+                               bridge_address.rstrip(b'\0').decode('utf-8'),
+                               self.bridge_address.decode('utf-8'))
+                self._warned = True
+            return None
+        return fields
+
+    def _read_slot(self, slot):
+        """Return the SLOT fields (less the sequence number) of a slot, or
+        None if they couldn't be read
+        """
+        offset = slot_offset(slot)
+        for _ in range(READ_RETRIES):
+            fields = SLOT.unpack_from(self.map, offset)
+            seq = SEQUENCE.unpack_from(self.map, offset)[0]
+            if fields[0] % 2 == 0 and fields[0] == seq:
+                return fields[1:]
+        return None
+
+    def _refresh_slots(self):
+        """Look up which slot each light is in if the set of lights has
+        changed, and return whether the table is usable
+        """
+        if not self._open():
+            return False
+        header = self._read_header()
+        if header is None:
+            return False
+        _, _, _, num_slots, generation, interval, _ = header
+        self.interval = interval
+        if generation != self.generation:
+            self.slots = {}
+            for slot in range(num_slots):
+                fields = self._read_slot(slot)
+                if fields is not None and fields[1] & FLAG_PRESENT:
+                    self.slots[fields[0]] = slot
+            self.generation = generation
+        return True
+
+    def _fresh(self, fields, now):
+        max_age = self.max_age
+        if max_age is None:
+            max_age = STALE_INTERVALS * self.interval
+        return now - fields[-1] <= max_age
+
+    def light_state(self, light_id):
+        """Return the state dict of the light with the given ID, or None if
+        it isn't in the table or its state is out of date
+        """
+        if not self._refresh_slots():
+            return None
+        light_id = int(light_id)
+        slot = self.slots.get(light_id)
+        if slot is None:
+            return None
+        fields = self._read_slot(slot)
+        if (fields is None or fields[0] != light_id
+                or not fields[1] & FLAG_PRESENT
+                or not self._fresh(fields, clock.time())):
+            # Out of date, or the lights changed since the header was read
+            return None
+        return unpack_state(fields)
+
+    def light_states(self):
+        """Return a dict mapping the ID of every light in the table to its
+        state dict, or None if the table isn't available or any state in
+        it is out of date
+        """
+        if not self._refresh_slots():
+            return None
+        now = clock.time()
+        states = {}
+        for light_id, slot in self.slots.items():
+            fields = self._read_slot(slot)
+            if (fields is None or fields[0] != light_id
+                    or not self._fresh(fields, now)):
+                return None
+            states[light_id] = unpack_state(fields)
+        return states
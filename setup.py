@@ -46,16 +46,21 @@ setup(
     entry_points={
         'console_scripts': [
             'alt_lamp_simulation=hue_toys.alt_lamp_simulation:main',
+            'bridge_broker=hue_toys.bridge_broker:main',
+            'bridge_stress=hue_toys.bridge_stress:main',
             'chasing_colors=hue_toys.chasing_colors:main',
             'coded_clock=hue_toys.coded_clock:main',
             'coded_digits=hue_toys.coded_digits:main',
             'coded_stopwatch=hue_toys.coded_stopwatch:main',
             'fading_colors=hue_toys.fading_colors:main',
             'flashing_colors=hue_toys.flashing_colors:main',
+            'hue_toys=hue_toys.cli:main',
             'incandescent_fade=hue_toys.incandescent_fade:main',
-            'lightctl=hue_toys.lightctl:main',
+            'lightctl=hue_toys.lightctl_client:main',
             'lightctl_curses=hue_toys.lightctl_curses:main',
             'power_fail_restore=hue_toys.power_fail_restore:main',
+            'replay=hue_toys.replay:main',
+            'state_publisher=hue_toys.state_publisher:main',
         ],
     },
 )